@@ -25,7 +25,7 @@ from tastypie.api import Api
 from tastypie.constants import ALL_WITH_RELATIONS, ALL
 from tastypie.utils import trailing_slash
 
-from vr.server import models
+from vr.server import models, hostprocs
 from vr.server.views import do_swarm, do_build, do_deploy
 from vr.server.api.views import auth_required
 from vr.server.utils import yamlize
@@ -301,13 +301,31 @@ class SwarmResource(ReversionModelResource):
         )
         authorization = Authorization()
 
+    @staticmethod
+    def wants_procs(request):
+        # Clients that don't need proc data can skip it with ?procs=0
+        return request is None or request.GET.get('procs') != '0'
+
+    @staticmethod
+    def add_procs(bundle, procs, unreachable):
+        bundle.data['procs'] = [p.as_dict() for p in procs]
+        bundle.data['unreachable_hosts'] = [h.name for h in unreachable]
+
+    def full_dehydrate(self, bundle, for_list=False):
+        # Remember whether this bundle is part of a list, so dehydrate() can
+        # leave the procs to alter_list_data_to_serialize().
+        bundle.for_list = for_list
+        return super(SwarmResource, self).full_dehydrate(bundle, for_list)
+
     def dehydrate(self, bundle):
         # add in proc data
         # TODO: Make these proper attributes so they can be saved by a
         # PUT/POST to the swarm resource.
         bundle.data['procs_uri'] = bundle.data['resource_uri'] + 'procs/'
-        bundle.data['procs'] = [p.as_dict() for p in
-                                bundle.obj.get_procs(check_cache=True)]
+        if (not getattr(bundle, 'for_list', False) and
+                self.wants_procs(bundle.request)):
+            self.add_procs(bundle, *bundle.obj.get_procs_and_unreachable(
+                check_cache=True))
         bundle.data['squad_name'] = bundle.obj.squad.name
 
         # Also add in convenience data
@@ -315,6 +333,17 @@ class SwarmResource(ReversionModelResource):
                            config_name=bundle.obj.config_name)
         return bundle
 
+    def alter_list_data_to_serialize(self, request, data):
+        # Fill in the procs of all the swarms on the page at once, so that
+        # hosts shared by several swarms' squads are only asked once.
+        bundles = data[self._meta.collection_name]
+        if bundles and self.wants_procs(request):
+            all_procs = hostprocs.get_swarm_procs(
+                [bundle.obj for bundle in bundles])
+            for bundle, (procs, unreachable) in zip(bundles, all_procs):
+                self.add_procs(bundle, procs, unreachable)
+        return data
+
     def dehydrate_env_yaml(self, bundle):
         # Explicit dehydrate to avoid this field is stringified with str()
         return yamlize(bundle.obj.env_yaml)
@@ -435,11 +464,17 @@ class TestResultResource(ModelResource):
         authorization = Authorization()
 
 
+def wants_test_results(bundle):
+    # Clients that only need a test run's counts can skip its results with
+    # ?results=0
+    return bundle.request.GET.get('results') != '0'
+
+
 @register_instance
 class TestRunResource(ModelResource):
     testresults = fields.ToManyField(
         'vr.server.api.resources.TestResultResource',
-        'tests', full=True)
+        'tests', full=True, use_in=wants_test_results)
 
     class Meta:
         queryset = models.TestRun.objects.all()
@@ -450,6 +485,11 @@ class TestRunResource(ModelResource):
         )
         authorization = Authorization()
 
+    def dehydrate(self, bundle):
+        # Runs still going haven't saved their counts yet.
+        bundle.data.update(bundle.obj.get_counts())
+        return bundle
+
 
 @register_instance
 class HostResource(ReversionModelResource):
@@ -18,6 +18,10 @@ urlpatterns = patterns(
         name='api_host_procs'),
     url(r'^v1/hosts/' + hostname_re + '/procs/' + procname_re + '/$',
         'host_proc', name='api_host_proc'),
+    url(r'^v1/hosts/' + hostname_re + '/procs/' + procname_re + '/log/$',
+        'proc_log_window', name='api_proc_log_window'),
+    url(r'^v1/hosts/' + hostname_re + '/procs/' + procname_re +
+        '/log/search/$', 'proc_log_search', name='api_proc_log_search'),
     url(r'^v1/swarms/' + swarm_re + '/procs/$', 'swarm_procs',
         name='api_swarm_procs'),
 
@@ -1,9 +1,12 @@
 import xmlrpclib
 import base64
+import itertools
 import json
+import re
 
 from functools import wraps
 
+import requests
 from django.contrib.auth import authenticate
 from django import http
 from django.conf import settings
@@ -11,11 +14,9 @@ from django.http import HttpResponseNotFound
 from django.views.decorators.csrf import csrf_exempt
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
-import sseclient
-import requests
 
-import vr.events
-from vr.server import utils, tasks, events, models
+from vr.server import (
+    utils, tasks, events, eventhub, logtail, models, ports, proclogs)
 from vr.common.models import ProcError
 
 
@@ -99,8 +100,10 @@ def swarm_procs(request, swarm_id):
     Display status of all processes for a given swarm
     """
     swarm = models.Swarm.objects.get(id=swarm_id)
+    procs, unreachable = swarm.get_procs_and_unreachable(check_cache=True)
     return utils.json_response({
-        'objects': [p.as_dict() for p in swarm.get_procs(check_cache=True)]
+        'objects': [p.as_dict() for p in procs],
+        'unreachable_hosts': [h.name for h in unreachable],
     })
 
 
@@ -120,12 +123,8 @@ def host_proc(request, hostname, procname):
 
     if request.method == 'DELETE':
         events.eventify(request.user, 'destroy', proc.name)
-        # check for and remove port lock if present
-        try:
-            pl = models.PortLock.objects.get(host=host, port=proc.port)
-            pl.delete()
-        except models.PortLock.DoesNotExist:
-            pass
+        # release the port's reservation if present
+        ports.release_ports(host, [proc.port])
 
         # The web proc will perform deletions itself instead of sending them to
         # a worker, because otherwise we could be asking a worker to delete
@@ -153,18 +152,105 @@ def host_proc(request, hostname, procname):
     return utils.json_response(proc.as_dict())
 
 
+def _int_param(request, name, default=None):
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return default
+    return int(value)
+
+
+@auth_required
+def proc_log_window(request, hostname, procname):
+    """
+    Return part of a proc's log, in JSON with the log's 'size' and the
+    'offset' of the 'data' returned.
+
+    Gives 'length' bytes from 'offset', which counts back from the end of
+    the log if negative, and by default ends the window at the end of the
+    log.  Or with 'lines', the last that many lines before 'offset'.
+    """
+    host = get_object_or_404(models.Host, name=hostname)
+    log = proclogs.ProcLog(host, procname)
+    try:
+        offset = _int_param(request, 'offset')
+        length = _int_param(request, 'length')
+        lines = _int_param(request, 'lines')
+    except ValueError:
+        return http.HttpResponseBadRequest('Bad offset, length or lines')
+
+    try:
+        if lines is not None:
+            offset, size, data = log.lines(lines, end=offset)
+        else:
+            offset, size, data = log.window(offset, length)
+    except xmlrpclib.Fault as e:
+        return utils.json_response({'fault': e.faultString}, 500)
+
+    return utils.json_response({
+        'offset': offset,
+        'size': size,
+        'data': data.decode('utf-8', 'replace'),
+    })
+
+
+@auth_required
+def proc_log_search(request, hostname, procname):
+    """
+    Search a proc's log for lines matching the regular expression 'q', or
+    the plain text if 'regex' is 0, between the byte offsets 'start' and
+    'end', ignoring case if 'ignore_case' is 1.
+
+    Matches are streamed as they're found, one JSON object per line, with
+    the 'offset' and 'text' of the matching line and the 'start' and 'end'
+    of the match in it.  A last object with 'done' set says how far the
+    search got, and whether it stopped early after 'max_results' matches.
+    """
+    host = get_object_or_404(models.Host, name=hostname)
+    pattern = request.GET.get('q')
+    if not pattern:
+        return http.HttpResponseBadRequest('Missing q')
+    if request.GET.get('regex') == '0':
+        pattern = re.escape(pattern)
+    try:
+        kwargs = {
+            'start': _int_param(request, 'start', 0),
+            'end': _int_param(request, 'end'),
+            'max_results': _int_param(request, 'max_results'),
+        }
+        re.compile(pattern)
+    except (ValueError, re.error):
+        return http.HttpResponseBadRequest('Bad q, start, end or max_results')
+    if kwargs['max_results'] is not None:
+        kwargs['max_results'] = min(
+            kwargs['max_results'], settings.PROC_LOG_SEARCH_MAX_RESULTS)
+
+    results = proclogs.ProcLog(host, procname).search(
+        pattern, ignore_case=request.GET.get('ignore_case') == '1', **kwargs)
+    try:
+        # Fail before streaming if the proc or host isn't there.
+        first = next(results)
+    except xmlrpclib.Fault as e:
+        return utils.json_response({'fault': e.faultString}, 500)
+
+    lines = (json.dumps(result) + '\n'
+             for result in itertools.chain([first], results))
+    return http.StreamingHttpResponse(
+        lines, content_type='application/x-ndjson')
+
+
 @auth_required
 def uptest_latest(request):
     """
     Look up most recent test run and redirect to its record in the API.
     """
     runs = models.TestRun.objects.filter(end__isnull=False).order_by('-start')
-    if not runs:
+    run_id = runs.values_list('id', flat=True).first()
+    if run_id is None:
         return http.HttpResponseNotFound()
     url = reverse('api_dispatch_detail',
                   kwargs={'resource_name': 'testruns',
                           'api_name': 'v1',
-                          'pk': runs[0].id})
+                          'pk': run_id})
 
     # Tack on the query string
     url = "?".join([url, request.META['QUERY_STRING']])
@@ -176,89 +262,55 @@ def event_stream(request):
     """
     Stream worker events out to browser.
     """
-    return streaming_response(vr.events.Listener(
-        settings.EVENTS_PUBSUB_URL,
-        channels=[settings.EVENTS_PUBSUB_CHANNEL],
-        buffer_key=settings.EVENTS_BUFFER_KEY,
-        last_event_id=request.META.get('HTTP_LAST_EVENT_ID')
-    ))
+    if settings.EVENTS_TRANSPORT == 'stream':
+        return streaming_response(events.StreamListener(
+            settings.EVENTS_PUBSUB_URL,
+            settings.EVENTS_STREAM_KEY,
+            last_event_id=request.META.get('HTTP_LAST_EVENT_ID'),
+            backlog=settings.EVENTS_BUFFER_LENGTH,
+        ))
+    hub = eventhub.get_hub()
+    client = hub.listen(settings.EVENTS_PUBSUB_CHANNEL, events.format_event)
+    # Listen first, so no event slips between the buffer and the client.
+    client.backlog = events.get_buffered_events(
+        hub.rcon, request.META.get('HTTP_LAST_EVENT_ID'))
+    return streaming_response(client)
 
 
 @auth_required
 def proc_event_stream(request):
-    return streaming_response(events.ProcListener(
-        settings.EVENTS_PUBSUB_URL,
-        channel=settings.PROC_EVENTS_CHANNEL,
-    ))
-
-
-class ProcTailer(object):
     """
-    Given a hostname, port, and procname, connect to the log tailing endpoint
-    for that proc and yield a string for each line in the log, as they come.
+    Stream proc events out to browser.  Pass 'host' and 'app' (each as often
+    as needed) or the id of a 'dashboard' to only get events from those hosts
+    or about procs of those apps.  Quick state changes of a proc are sent as
+    just the latest one.
     """
-
-    def __init__(self, hostname, port, procname, username=None, password=None):
-        self.hostname = hostname
-        self.port = port
-        self.procname = procname
-        self.username = username
-        self.password = password
-        self.buf = u''
-
-        self._connect()
-
-    def _connect(self):
-        url = 'http://{0.hostname}:{0.port}/logtail/{0.procname}'.format(self)
-
-        auth = None
-        if self.username:
-            auth = (self.username, self.password)
-
-        self.resp = requests.get(
-            url, stream=True, auth=auth)
-        self.resp.raise_for_status()
-        self.content = self.resp.iter_content(decode_unicode=True)
-
-    def __iter__(self):
-        while True:
-            yield self.next()
-
-    def next(self):
-        while '\n' not in self.buf:
-            self.buf += next(self.content)
-        head, _, tail = self.buf.partition('\n')
-        self.buf = tail
-        return head + '\n'
-
-    def close(self):
-        # Close the connection
-        self.resp.raw._fp.close()
-        # Release the connection from the pool
-        self.resp.raw.release_conn()
-
-
-class SSETailer(ProcTailer):
-    """
-    Given a hostname, port, and procname, yield one event per log line.
-    """
-
-    def next(self):
-        # Remove the trailing newline from the data
-        data = super(SSETailer, self).next()[:-1]
-        e = sseclient.Event(data=data)
-        return e.dump()
+    hosts = request.GET.getlist('host')
+    apps = request.GET.getlist('app')
+    if request.GET.get('dashboard'):
+        dashboard = get_object_or_404(
+            models.Dashboard, id=request.GET['dashboard'])
+        apps.extend(dashboard.apps.values_list('name', flat=True))
+    match = events.ProcEventFilter(hosts, apps) if hosts or apps else None
+    return streaming_response(eventhub.get_hub().listen(
+        settings.PROC_EVENTS_CHANNEL,
+        events.format_proc_event,
+        match=match,
+        coalesce=events.proc_event_key,
+    ))
 
 
 @auth_required
 def proc_log_stream(request, hostname, procname):
-    kwargs = dict(
-        hostname=hostname,
-        port=settings.SUPERVISOR_PORT,
-        procname=procname,
-        username=settings.SUPERVISOR_USERNAME,
-        password=settings.SUPERVISOR_PASSWORD,
-    )
-    if request.META['HTTP_ACCEPT'] == 'text/event-stream':
-        return streaming_response(SSETailer(**kwargs))
-    return http.HttpResponse(ProcTailer(**kwargs), content_type='text/plain')
+    sse = request.META['HTTP_ACCEPT'] == 'text/event-stream'
+    try:
+        viewer = logtail.tail(
+            hostname, procname,
+            logtail.format_sse if sse else logtail.format_text)
+    except requests.RequestException as e:
+        return http.HttpResponse(
+            'Could not tail the log: %s' % e, status=502,
+            content_type='text/plain')
+    if sse:
+        return streaming_response(viewer)
+    return http.StreamingHttpResponse(viewer, content_type='text/plain')
@@ -0,0 +1,237 @@
+"""
+Fan Redis pubsub messages out to the server-sent event streams of all the
+clients of a web process.
+
+Each process subscribes once to each channel its clients listen to, all on
+one Redis connection, and puts every message on each client's own bounded
+queue.  A client that falls EVENT_HUB_QUEUE_SIZE messages behind is cut off
+rather than left to hold up the others.  Browsers reconnect on their own.
+
+A channel's messages can also be coalesced: only the latest of the messages
+about the same thing within EVENT_HUB_COALESCE_WINDOW seconds is sent.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+from six.moves import queue
+
+from vr.server import models
+
+logger = logging.getLogger('velociraptor.eventhub')
+
+# Seconds to wait for a message before checking for new channels to
+# subscribe to.
+POLL_INTERVAL = 1
+
+# Seconds to wait before resubscribing after losing Redis.
+RETRY_INTERVAL = 5
+
+KEEPALIVE = ':\n'
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class Client(object):
+    """
+    One client's view of a channel: an iterator of server-sent events, for
+    a StreamingHttpResponse, which closes it when the client goes away.
+
+    Set `backlog` to a list of events to send before the live ones, e.g.
+    those missed since the client's Last-Event-ID.  Any of them that also
+    arrive live aren't sent twice.
+
+    If given, `match` is called with each message, decoded from JSON, and
+    only those it returns true for are sent.
+    """
+
+    def __init__(self, hub, channel, match=None):
+        self.hub = hub
+        self.channel = channel
+        self.match = match
+        self.backlog = []
+        self.queue = queue.Queue(settings.EVENT_HUB_QUEUE_SIZE)
+        self.dropped = False
+
+    def put(self, event):
+        """
+        Queue `event` for the client.  Return False if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            return False
+        return True
+
+    def __iter__(self):
+        # Leave a keepalive first so the response headers go out at once.
+        yield KEEPALIVE
+        seen = set(self.backlog)
+        for event in self.backlog:
+            yield event
+        self.backlog = []
+
+        while not self.dropped:
+            try:
+                event = self.queue.get(timeout=settings.EVENT_HUB_KEEPALIVE)
+            except queue.Empty:
+                yield KEEPALIVE
+                continue
+            if event in seen:
+                seen.discard(event)
+                continue
+            yield event
+
+    def close(self):
+        self.hub.remove(self)
+
+
+class Hub(object):
+    """
+    Broadcast the messages on Redis pubsub channels to Clients, from one
+    subscription per channel.  Each channel has a `formatter` to turn its
+    messages into server-sent events, once for all the channel's clients,
+    or into None for messages not to send.  A channel with a `coalesce`
+    function has its messages held back for EVENT_HUB_COALESCE_WINDOW
+    seconds, and only the latest sent of those it returns the same key
+    for.  Messages it returns None for are sent straight away.
+    """
+
+    def __init__(self, rcon):
+        self.rcon = rcon
+        self.clients = defaultdict(set)
+        self.formatters = {}
+        self.coalesce_keys = {}
+        self.pending = {}
+        self.flush_at = None
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def listen(self, channel, formatter, match=None, coalesce=None):
+        """
+        Return a new Client of `channel`, only sent the messages `match`
+        returns true for, if given.
+        """
+        client = Client(self, channel, match)
+        with self.lock:
+            self.formatters.setdefault(channel, formatter)
+            self.coalesce_keys.setdefault(channel, coalesce)
+            self.clients[channel].add(client)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='event-hub')
+                self._thread.daemon = True
+                self._thread.start()
+        return client
+
+    def remove(self, client):
+        with self.lock:
+            self.clients[client.channel].discard(client)
+
+    def broadcast(self, channel, data):
+        try:
+            event = self.formatters[channel](data)
+        except Exception:
+            logger.exception('Failed to format message on %s: %r', channel,
+                             data)
+            return
+        if event is None:
+            return
+        with self.lock:
+            clients = list(self.clients[channel])
+        message = None
+        for client in clients:
+            if client.match is not None:
+                if message is None:
+                    try:
+                        message = json.loads(data)
+                    except ValueError:
+                        message = {}
+                if not client.match(message):
+                    continue
+            if not client.put(event):
+                logger.info('Dropping slow client of %s', channel)
+                client.dropped = True
+                self.remove(client)
+
+    def receive(self, channel, data):
+        """
+        Broadcast a message, or hold it back to coalesce it with later ones
+        about the same thing.
+        """
+        coalesce = self.coalesce_keys.get(channel)
+        window = settings.EVENT_HUB_COALESCE_WINDOW
+        key = coalesce(data) if coalesce and window else None
+        if key is None:
+            self.broadcast(channel, data)
+            return
+        if not self.pending:
+            self.flush_at = time.time() + window
+        pending = self.pending.setdefault(channel, OrderedDict())
+        # Send the latest message in its place, not the first one's.
+        pending.pop(key, None)
+        pending[key] = data
+
+    def flush(self):
+        """
+        Broadcast the messages held back to coalesce.
+        """
+        pending, self.pending = self.pending, {}
+        for channel, messages in pending.items():
+            for data in messages.values():
+                self.broadcast(channel, data)
+
+    def _listen(self):
+        pubsub = self.rcon.pubsub(ignore_subscribe_messages=True)
+        subscribed = set()
+        try:
+            while True:
+                with self.lock:
+                    wanted = set(self.formatters) - subscribed
+                if wanted:
+                    pubsub.subscribe(*wanted)
+                    subscribed |= wanted
+                timeout = POLL_INTERVAL
+                if self.pending:
+                    timeout = min(timeout, max(0, self.flush_at - time.time()))
+                message = pubsub.get_message(timeout=timeout)
+                if message and message['type'] == 'message':
+                    self.receive(
+                        _text(message['channel']), _text(message['data']))
+                if self.pending and time.time() >= self.flush_at:
+                    self.flush()
+        finally:
+            pubsub.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('Lost event hub subscription.  Retrying.')
+                time.sleep(RETRY_INTERVAL)
+
+
+_hub = None
+_hub_pid = None
+_hub_lock = threading.Lock()
+
+
+def get_hub():
+    """
+    Return this process's Hub, on the events Redis.  A forked child makes
+    its own, since the parent's thread and connection don't come along.
+    """
+    global _hub, _hub_pid
+    with _hub_lock:
+        if _hub is None or _hub_pid != os.getpid():
+            _hub = Hub(models.events_redis)
+            _hub_pid = os.getpid()
+        return _hub
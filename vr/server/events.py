@@ -1,20 +1,31 @@
+import atexit
 import functools
 import json
 import datetime
 import logging
+import os
+import threading
+import time
 
 import six
+from six.moves import queue
 import redis
 import sseclient
 from django.conf import settings
 
 from vr.common import utils
+from vr.common.models import Proc
 from vr.events import Sender
 
+logger = logging.getLogger('velociraptor.events')
+
 
 class EventSender(Sender):
 
-    def publish(self, message, event=None, tags=None, title=None, **kw):
+    def make_message(self, message, event=None, tags=None, title=None, **kw):
+        """
+        Return the event as it goes on the pubsub, ready for send().
+        """
         # Make an object with timestamp, ID, and payload
         data = {
             'time': datetime.datetime.utcnow().isoformat(),
@@ -26,9 +37,317 @@ class EventSender(Sender):
         # Used for optional keys such as the swarm id, trace id, etc.
         data.update(kw)
 
-        payload = json.dumps(data)
-        # Serialize it and stick it on the pubsub
-        super(EventSender, self).publish(payload, event=event)
+        return self.format(json.dumps(data), event=event)
+
+    def send(self, messages):
+        """
+        Put messages made by make_message() on the pubsub and the buffer, in
+        one round trip to Redis.
+        """
+        pipe = self.rcon.pipeline(transaction=False)
+        for message in messages:
+            pipe.publish(self.channel, message)
+            if self.buffer_key:
+                pipe.lpush(self.buffer_key, message)
+        if self.buffer_key:
+            pipe.ltrim(self.buffer_key, 0, self.buffer_length - 1)
+        pipe.execute()
+
+    def publish(self, message, event=None, tags=None, title=None, **kw):
+        self.send([self.make_message(message, event, tags, title, **kw)])
+
+    def close(self):
+        self.rcon.connection_pool.disconnect()
+
+
+class StreamEventSender(EventSender):
+    """
+    Put events on the Redis stream at `stream_key` instead of the pubsub and
+    buffer.  The stream keeps roughly the last `max_len` events, or with
+    `max_age` those from the last `max_age` seconds.  Needs Redis 5, or 6.2
+    for `max_age`.
+    """
+
+    def __init__(self, rcon_or_url, stream_key, max_len=None, max_age=None):
+        super(StreamEventSender, self).__init__(rcon_or_url, stream_key)
+        self.max_len = max_len
+        self.max_age = max_age
+
+    def _trim_args(self):
+        if self.max_age:
+            min_id = int((time.time() - self.max_age) * 1000)
+            return ['MINID', '~', min_id]
+        if self.max_len:
+            return ['MAXLEN', '~', self.max_len]
+        return []
+
+    def send(self, messages):
+        """
+        Add messages made by make_message() to the stream, in one round trip
+        to Redis.
+        """
+        pipe = self.rcon.pipeline(transaction=False)
+        for message in messages:
+            args = self._trim_args() + ['*', 'message', message]
+            pipe.execute_command('XADD', self.channel, *args)
+        pipe.execute()
+
+
+def _new_sender():
+    if settings.EVENTS_TRANSPORT == 'stream':
+        return StreamEventSender(
+            settings.EVENTS_PUBSUB_URL,
+            settings.EVENTS_STREAM_KEY,
+            settings.EVENTS_STREAM_MAX_LEN,
+            settings.EVENTS_STREAM_MAX_AGE,
+        )
+    return EventSender(
+        settings.EVENTS_PUBSUB_URL,
+        settings.EVENTS_PUBSUB_CHANNEL,
+        settings.EVENTS_BUFFER_KEY,
+        settings.EVENTS_BUFFER_LENGTH,
+    )
+
+
+_sender = None
+_sender_pid = None
+_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """
+    Return this process's EventSender, created on first use, whose
+    connection pool is shared by every event the process sends.  A forked
+    child makes its own rather than sharing the parent's sockets.
+    """
+    global _sender, _sender_pid
+    with _sender_lock:
+        if _sender is None or _sender_pid != os.getpid():
+            _sender = _new_sender()
+            _sender_pid = os.getpid()
+        return _sender
+
+
+def reset_sender():
+    """
+    Disconnect and forget this process's EventSender.  The next event will
+    make a new one.
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is not None and _sender_pid == os.getpid():
+            _sender.close()
+        _sender = None
+
+
+def _send(messages):
+    """
+    Send messages with the shared EventSender.  If Redis can't be reached
+    on its connections, drop them all and fall back to sending the messages
+    on a new connection that's closed again straight away.
+    """
+    try:
+        get_sender().send(messages)
+    except (redis.ConnectionError, redis.TimeoutError):
+        logger.warning(
+            'Failed to publish events.  Retrying on a new connection.',
+            exc_info=True)
+        reset_sender()
+        sender = _new_sender()
+        try:
+            sender.send(messages)
+        finally:
+            sender.close()
+
+
+class EventPipeline(object):
+    """
+    Send events from a background thread, so publishing one never waits on
+    Redis.  Events are queued in memory and sent as many at a time as have
+    queued up, up to `batch_size`, each batch in one round trip.
+
+    When `size` events are waiting, new ones are dropped (overflow='drop')
+    or wait for room in the queue (overflow='block').
+    """
+
+    def __init__(self, send, size, batch_size, overflow='drop'):
+        self.send = send
+        self.queue = queue.Queue(size)
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.dropped = 0
+        self._thread = threading.Thread(
+            target=self._run, name='event-pipeline')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, message):
+        try:
+            self.queue.put(message, block=self.overflow == 'block')
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('Event queue full.  %d events dropped so far.',
+                           self.dropped)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.send(batch)
+            except Exception:
+                logger.exception('Failed to publish %d events.', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, timeout):
+        """
+        Wait up to `timeout` seconds for the queued events to be sent.
+        Return whether they all were.
+        """
+        deadline = time.time() + timeout
+        all_done = self.queue.all_tasks_done
+        with all_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                all_done.wait(remaining)
+        return True
+
+
+_pipeline = None
+_pipeline_pid = None
+_pipeline_lock = threading.Lock()
+
+# Seconds to wait for queued events to go out when a process exits.
+FLUSH_TIMEOUT = 5
+
+
+def get_pipeline():
+    """
+    Return this process's EventPipeline, started on first use.  A forked
+    child starts its own, with an empty queue, since threads don't survive
+    a fork and the parent's queued events are the parent's to send.
+    """
+    global _pipeline, _pipeline_pid
+    with _pipeline_lock:
+        if _pipeline is None or _pipeline_pid != os.getpid():
+            _pipeline = EventPipeline(
+                _send,
+                settings.EVENTS_QUEUE_SIZE,
+                settings.EVENTS_BATCH_SIZE,
+                settings.EVENTS_OVERFLOW,
+            )
+            _pipeline_pid = os.getpid()
+        return _pipeline
+
+
+def flush(timeout=FLUSH_TIMEOUT):
+    """
+    Wait up to `timeout` seconds for this process's queued events to be
+    sent.
+    """
+    if _pipeline is not None and _pipeline_pid == os.getpid():
+        if not _pipeline.flush(timeout):
+            logger.warning('Gave up waiting for queued events to be sent.')
+
+
+atexit.register(flush)
+
+
+def publish(message, **kw):
+    """
+    Publish an event.  With EVENTS_ASYNC it's queued for this process's
+    EventPipeline to send; otherwise it's sent right away.
+    """
+    message = get_sender().make_message(message, **kw)
+    if settings.EVENTS_ASYNC:
+        get_pipeline().put(message)
+    else:
+        _send([message])
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class StreamListener(object):
+    """
+    Yield server-sent events for the entries on a Redis stream, like
+    vr.events.Listener does for the pubsub.  Each event's id is its stream
+    entry ID, so a client reconnecting with a Last-Event-ID is sent every
+    event added since then, for as long as the stream keeps them.  Clients
+    without one get the last `backlog` events first.
+    """
+
+    # Milliseconds to wait for new events before sending a keepalive.
+    BLOCK = 15000
+
+    # The most events to fetch per read.
+    COUNT = 100
+
+    def __init__(self, rcon_or_url, stream_key, last_event_id=None,
+                 backlog=100):
+        if isinstance(rcon_or_url, redis.StrictRedis):
+            self.rcon = rcon_or_url
+        elif isinstance(rcon_or_url, six.string_types):
+            self.rcon = redis.StrictRedis(**utils.parse_redis_url(rcon_or_url))
+        self.stream_key = stream_key
+        self.last_event_id = last_event_id
+        self.backlog = backlog
+
+    @staticmethod
+    def _is_entry_id(value):
+        ms, _, seq = (value or '').partition('-')
+        return ms.isdigit() and (not seq or seq.isdigit())
+
+    def _get_backlog(self):
+        entries = self.rcon.execute_command(
+            'XREVRANGE', self.stream_key, '+', '-', 'COUNT', self.backlog)
+        return list(reversed(entries or []))
+
+    def __iter__(self):
+        if self._is_entry_id(self.last_event_id):
+            # XREAD picks up from here, replaying everything missed.
+            last_id = self.last_event_id
+        else:
+            last_id = '0-0'
+            for entry in self._get_backlog():
+                last_id = _text(entry[0])
+                yield self.format(entry)
+
+        while True:
+            reply = self.rcon.execute_command(
+                'XREAD', 'COUNT', self.COUNT, 'BLOCK', self.BLOCK,
+                'STREAMS', self.stream_key, last_id)
+            if not reply:
+                yield ':\n'
+                continue
+            for entry in reply[0][1]:
+                last_id = _text(entry[0])
+                yield self.format(entry)
+
+    def format(self, entry):
+        entry_id, fields = entry
+        if not isinstance(fields, dict):
+            # redis-py < 3 doesn't parse stream replies.
+            fields = dict(zip(fields[::2], fields[1::2]))
+        message = json.loads(_text(fields[b'message']))
+        out = 'id: %s\n' % _text(entry_id)
+        if message.get('event'):
+            out += 'event: %s\n' % message['event']
+        out += 'data: %s\n\n' % message['data']
+        return out
 
     def close(self):
         self.rcon.connection_pool.disconnect()
@@ -64,6 +383,77 @@ class ProcListener(object):
         self.rcon.connection_pool.disconnect()
 
 
+def format_event(data):
+    """
+    Return the server-sent event for a message on EVENTS_PUBSUB_CHANNEL, as
+    vr.events.Listener formats it, or None for a 'flush'.
+    """
+    if data == 'flush':
+        return None
+    parsed = json.loads(data)
+    out = 'id: %s\n' % parsed['id']
+    if parsed.get('event'):
+        out += 'event: %s\n' % parsed['event']
+    # account for earlier version that used 'message'
+    out += 'data: %s\n\n' % (parsed.get('data') or parsed.get('message'))
+    return out
+
+
+def get_buffered_events(rcon, last_event_id=None):
+    """
+    Return the server-sent events for the messages in EVENTS_BUFFER_KEY,
+    oldest first, starting after `last_event_id` if it's still there.
+    """
+    events = []
+    for data in rcon.lrange(settings.EVENTS_BUFFER_KEY, 0, -1):
+        data = _text(data)
+        if json.loads(data)['id'] == last_event_id:
+            break
+        events.append(format_event(data))
+    return events[::-1]
+
+
+def format_proc_event(data):
+    """
+    Return the server-sent event for a message on PROC_EVENTS_CHANNEL, or
+    None for a 'flush'.
+    """
+    if data == 'flush':
+        return None
+    return sseclient.Event(data=data, retry=1000).dump()
+
+
+def proc_event_key(data):
+    """
+    Return the id of the proc a message on PROC_EVENTS_CHANNEL is about,
+    for coalescing its state changes, or None if it has none.
+    """
+    try:
+        return json.loads(data)['id']
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class ProcEventFilter(object):
+    """
+    Match proc events from any of `hosts` about procs of any of `apps`.
+    Empty `hosts` or `apps` match them all.
+    """
+
+    def __init__(self, hosts=(), apps=()):
+        self.hosts = set(hosts)
+        self.apps = set(apps)
+
+    def __call__(self, event):
+        if self.hosts and event.get('host') not in self.hosts:
+            return False
+        if self.apps:
+            app_name = event.get('app_name') or Proc.parse_name(
+                event.get('name', ''))['app_name']
+            return app_name in self.apps
+        return True
+
+
 def eventify(user, action, obj, detail=None, **kw):
     """
     Save a message to the user action log, application log, and events pubsub
@@ -82,17 +472,11 @@ def eventify(user, action, obj, detail=None, **kw):
     logging.info(message)
 
     # put a message on the pubsub
-    sender = EventSender(
-        settings.EVENTS_PUBSUB_URL,
-        settings.EVENTS_PUBSUB_CHANNEL,
-        settings.EVENTS_BUFFER_KEY)
     tags = ['user', action]
     if 'tags' in kw:
         tags += kw['tags']
         del kw['tags']
-    sender.publish(
-        detail or message, tags=tags, title=message, **kw)
-    sender.close()
+    publish(detail or message, tags=tags, title=message, **kw)
 
 
 def eventify_on_error(action):
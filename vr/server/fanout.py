@@ -0,0 +1,178 @@
+"""
+Run an operation against many hosts at once from a single task, using a
+bounded pool of threads.
+
+Fabric keeps its settings (host_string, user, timeouts...) in one global
+``env`` dict, so concurrent remote calls would step on each other.  Threads
+started here get a private overlay of ``env`` instead, which lets each of
+them enter its own ``fab_settings`` block.  (Fabric's own parallel mode
+forks child processes, which Celery's daemonic workers aren't allowed to
+do.)
+"""
+
+import logging
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import fabric.state
+from fabric.utils import _AttributeDict
+from django import db
+
+logger = logging.getLogger('velociraptor.fanout')
+
+# How often to wake up and check for calls that have run out of time.
+POLL_INTERVAL = 1
+
+_local = threading.local()
+
+
+class _ThreadLocalEnv(_AttributeDict):
+    """
+    Fabric env that lets fan-out threads keep private settings.  Threads that
+    haven't been given an overlay read and write the shared dict as usual.
+    """
+
+    @staticmethod
+    def _overlay():
+        return getattr(_local, 'env', None)
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__setitem__(self, key, value)
+        else:
+            overlay[key] = value
+
+    def __delitem__(self, key):
+        overlay = self._overlay()
+        if overlay is None:
+            dict.__delitem__(self, key)
+        else:
+            # Fabric only deletes keys it added itself, which for a fan-out
+            # thread live in the overlay.
+            overlay.pop(key, None)
+
+    def __contains__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return True
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+def install():
+    """
+    Make Fabric's env thread-aware.  Safe to call more than once.
+    """
+    env = fabric.state.env
+    if not isinstance(env, _ThreadLocalEnv):
+        # Plain assignment would just set an env key called __class__.
+        object.__setattr__(env, '__class__', _ThreadLocalEnv)
+
+
+class Report(object):
+    """
+    The outcome of a fan-out: a return value for each key that completed,
+    a traceback for each key that raised, and the keys that timed out.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+        self.timeouts = []
+        self.elapsed = None
+
+    @property
+    def failed(self):
+        return bool(self.errors or self.timeouts)
+
+    def summary(self):
+        return '%d ok, %d failed, %d timed out in %.1f seconds' % (
+            len(self.results), len(self.errors), len(self.timeouts),
+            self.elapsed or 0)
+
+    def as_dict(self):
+        return {
+            'results': self.results,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'elapsed': self.elapsed,
+        }
+
+
+def run(func, keys, concurrency, timeout):
+    """
+    Call func(key) for each of `keys`, with at most `concurrency` calls in
+    flight at once, and return a Report.
+
+    A call that has been running for more than `timeout` seconds is reported
+    as timed out and left to finish in the background.  Fabric's
+    command_timeout is set to the same value inside each call, so a hung
+    remote command won't hold its thread forever.
+    """
+    install()
+    keys = list(keys)
+    report = Report()
+    t0 = time.time()
+    if not keys:
+        report.elapsed = 0
+        return report
+
+    started = {}
+
+    def call(key):
+        _local.env = {'command_timeout': timeout}
+        started[key] = time.time()
+        try:
+            return True, func(key)
+        except Exception:
+            return False, traceback.format_exc()
+        finally:
+            _local.env = None
+            # Worker threads get their own DB connections.  Don't leak them.
+            db.connection.close()
+
+    pool = ThreadPool(min(concurrency, len(keys)))
+    try:
+        pending = [(key, pool.apply_async(call, (key,))) for key in keys]
+        for key, result in pending:
+            while not result.ready():
+                start = started.get(key)
+                if start is not None and time.time() - start > timeout:
+                    break
+                result.wait(POLL_INTERVAL)
+
+            if not result.ready():
+                logger.warning('Timed out after %s seconds: %s', timeout, key)
+                report.timeouts.append(key)
+                continue
+
+            ok, value = result.get()
+            if ok:
+                report.results[key] = value
+            else:
+                logger.warning('Failed on %s: %s', key, value)
+                report.errors[key] = value
+    finally:
+        # Don't join: any timed out calls are still running.
+        pool.close()
+
+    report.elapsed = time.time() - t0
+    return report
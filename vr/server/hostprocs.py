@@ -0,0 +1,287 @@
+"""
+Look up the procs running on each host, concurrently, sharing the Redis cache
+that vr.common's Host keeps of them.
+
+The steps of a swarm each want the list of procs on every host in the squad,
+usually within seconds of each other.  Those that pass refresh=False take a
+host's procs from the cache Host.get_procs(check_cache=True) reads, if they
+were fetched less than PROC_CACHE_TTL seconds ago.  A host's entry is dropped
+when we deploy or delete procs there, and, while the celerybeat process runs
+the listener started by start_listener(), as soon as one of its procs changes
+state (as reported on PROC_EVENTS_CHANNEL).
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from vr.common import models as common_models
+from vr.common.models import Proc
+
+from vr.server import fanout, models
+
+logger = logging.getLogger('velociraptor.hostprocs')
+
+# The redis_cache_prefix of vr.common's Host.
+CACHE_PREFIX = 'host_procs'
+
+# How many times to try a host's supervisor before giving up on it.
+RPC_ATTEMPTS = 3
+
+# Seconds to wait before resubscribing to proc events after losing Redis.
+LISTENER_RETRY_INTERVAL = 5
+
+
+def _cache_key(hostname):
+    return ':'.join([CACHE_PREFIX, hostname])
+
+
+def invalidate(hostname):
+    """
+    Forget the cached procs for `hostname`.
+    """
+    models.events_redis.delete(_cache_key(hostname))
+
+
+class Unreachable(Exception):
+    """
+    Raised when a host's supervisor can't be asked for its procs.
+    """
+
+
+def _fetch(raw_host):
+    """
+    Ask the supervisor of `raw_host`, a vr.common Host, for its procs, and
+    cache them the way Host.get_procs() does.  Unlike Host.get_procs(), raise
+    Unreachable rather than returning no procs if the supervisor can't be
+    asked, so that answer is never cached.
+    """
+    try:
+        infos = common_models._retry(
+            RPC_ATTEMPTS, raw_host.supervisor.getAllProcessInfo)
+    except Exception as exc:
+        raise Unreachable('Failed to get procs from %s: %r' % (
+            raw_host.name, exc))
+
+    infos = dict((info['name'], info) for info in infos)
+    if raw_host.cache_lifetime:
+        with raw_host.redis.pipeline() as pipe:
+            pipe.delete(raw_host.cache_key)
+            if infos:
+                pipe.hmset(raw_host.cache_key, dict(
+                    (name, json.dumps(info)) for name, info in infos.items()))
+                pipe.expire(raw_host.cache_key, raw_host.cache_lifetime)
+            pipe.execute()
+    return infos
+
+
+def _get_procs(host, refresh):
+    raw_host = host.raw_host
+    cached = None
+    if raw_host.cache_lifetime and not refresh:
+        cached = raw_host.redis.hgetall(raw_host.cache_key)
+
+    if cached:
+        infos = [json.loads(value) for value in cached.values()]
+    else:
+        infos = _fetch(raw_host).values()
+
+    return [Proc(raw_host, info) for info in infos]
+
+
+def get_procs(host, refresh=False):
+    """
+    Return the vr.common Procs on `host` (a Host model instance), from the
+    cache if they were fetched less than PROC_CACHE_TTL seconds ago.  With
+    refresh=True the host is always asked, and the cache updated.
+
+    An unreachable host has no procs.  That answer isn't cached.
+    """
+    try:
+        return _get_procs(host, refresh)
+    except Unreachable as exc:
+        logger.warning('%s', exc)
+        return []
+
+
+def get_many(hosts, refresh=False):
+    """
+    Like get_procs(), for several hosts at once.  The hosts are looked up
+    concurrently, PROC_LIST_CONCURRENCY at a time, so one slow host doesn't
+    hold up the others.
+
+    Return a tuple of a dict of Procs keyed by host, for the hosts that
+    answered, and a list of the hosts that failed or took longer than
+    PROC_LIST_HOST_TIMEOUT seconds.
+    """
+    hosts = list(hosts)
+    report = fanout.run(
+        lambda host: _get_procs(host, refresh),
+        hosts,
+        concurrency=settings.PROC_LIST_CONCURRENCY,
+        timeout=settings.PROC_LIST_HOST_TIMEOUT,
+    )
+    unreachable = [host for host in hosts if host not in report.results]
+    return report.results, unreachable
+
+
+def swarm_key(swarm):
+    """
+    Return the (app_name, config_name, proc_name) that identifies the procs
+    belonging to `swarm`.
+    """
+    return swarm.app.name, swarm.config_name, swarm.proc_name
+
+
+class ProcIndex(object):
+    """
+    A snapshot of the procs on a set of hosts, indexed by the swarm they
+    belong to, and within that by release hash and by host, so a swarm's
+    procs can be looked up without scanning every proc.
+
+    `unreachable` holds the names of the hosts whose procs couldn't be
+    listed, and so are missing from the index.
+    """
+
+    def __init__(self, procs=(), unreachable=()):
+        self.unreachable = set(unreachable)
+        self._by_swarm = defaultdict(list)
+        self._by_hash = defaultdict(list)
+        self._by_host = defaultdict(list)
+        self._by_hash_and_host = defaultdict(list)
+        self._host_totals = Counter()
+        self._host_ports = defaultdict(set)
+        for proc in procs:
+            self.add(proc)
+
+    def add(self, proc):
+        key = proc.app_name, proc.config_name, proc.proc_name
+        host = proc.host.name
+        self._by_swarm[key].append(proc)
+        self._by_hash[key, proc.hash].append(proc)
+        self._by_host[key, host].append(proc)
+        self._by_hash_and_host[key, proc.hash, host].append(proc)
+        self._host_totals[host] += 1
+        self._host_ports[host].add(proc.port)
+
+    def get(self, swarm, hostname=None):
+        """
+        Return the procs belonging to `swarm`, optionally only those on the
+        host called `hostname`.
+        """
+        key = swarm_key(swarm)
+        if hostname is None:
+            return list(self._by_swarm.get(key, []))
+        return list(self._by_host.get((key, hostname), []))
+
+    def current(self, swarm, hostname=None):
+        """
+        Return the procs belonging to `swarm` that run its current release,
+        optionally only those on the host called `hostname`.
+        """
+        if not swarm.release:
+            return []
+        key = swarm_key(swarm)
+        if hostname is None:
+            return list(self._by_hash.get((key, swarm.release.hash), []))
+        return list(self._by_hash_and_host.get(
+            (key, swarm.release.hash, hostname), []))
+
+    def stale(self, swarm):
+        """
+        Return the procs belonging to `swarm` that don't run its current
+        release.
+        """
+        current_hash = swarm.release.hash if swarm.release else None
+        return [p for p in self._by_swarm.get(swarm_key(swarm), [])
+                if p.hash != current_hash]
+
+    def count(self, hostname):
+        """
+        Return the number of procs of any swarm on the host called
+        `hostname`.
+        """
+        return self._host_totals[hostname]
+
+    def ports(self, hostname):
+        """
+        Return the set of ports used by procs on the host called `hostname`.
+        """
+        return set(self._host_ports.get(hostname, ()))
+
+
+def get_index(hosts, refresh=False):
+    """
+    Return a ProcIndex of the procs on `hosts`, looked up as by get_many().
+    """
+    hosts = list(hosts)
+    host_procs, unreachable = get_many(hosts, refresh)
+    return ProcIndex(
+        (proc for host in hosts for proc in host_procs.get(host, [])),
+        unreachable=[host.name for host in unreachable],
+    )
+
+
+def get_swarm_procs(swarms, refresh=False):
+    """
+    Like Swarm.get_procs_and_unreachable() for each of `swarms`, but asking
+    each distinct host only once, however many of the swarms' squads it's in.
+
+    Return a list of (procs, unreachable hosts) tuples, in the same order as
+    `swarms`.
+    """
+    hosts = {}
+    swarm_hosts = []
+    for swarm in swarms:
+        squad_hosts = []
+        if swarm.release:
+            squad_hosts = [hosts.setdefault(host.pk, host)
+                           for host in swarm.squad.hosts.all()]
+        swarm_hosts.append((swarm, squad_hosts))
+
+    index = get_index(hosts.values(), refresh)
+
+    return [
+        (
+            [proc for host in squad_hosts
+             for proc in index.get(swarm, host.name)],
+            [host for host in squad_hosts if host.name in index.unreachable],
+        )
+        for swarm, squad_hosts in swarm_hosts
+    ]
+
+
+def _handle_event(data):
+    try:
+        hostname = json.loads(data)['host']
+    except (ValueError, TypeError, KeyError):
+        # Not a proc event, e.g. the 'flush' sent by event stream clients.
+        return
+    invalidate(hostname)
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = models.events_redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.PROC_EVENTS_CHANNEL)
+            for message in pubsub.listen():
+                _handle_event(message['data'])
+        except Exception:
+            logger.exception('Lost proc events subscription.  Retrying.')
+            time.sleep(LISTENER_RETRY_INTERVAL)
+
+
+def start_listener():
+    """
+    Start a thread dropping the cached procs of hosts whose procs change.
+    One is enough for all processes sharing the cache, so only the celerybeat
+    process runs it.
+    """
+    listener = threading.Thread(target=_listen, name='hostprocs-listener')
+    listener.daemon = True
+    listener.start()
+    return listener
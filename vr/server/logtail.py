@@ -0,0 +1,249 @@
+"""
+Tail procs' logs from their hosts' supervisor, sharing one connection per
+proc among everyone watching it.
+
+The first viewer of a proc's log opens a connection to its host's logtail
+endpoint, read from a background thread.  Later viewers of the same proc are
+sent the last LOG_TAIL_BACKLOG lines, then the same lines as everyone else.
+The connection is closed when the last viewer goes away.  A viewer that
+falls LOG_TAIL_QUEUE_SIZE lines behind is cut off rather than left to hold
+up the others.
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+
+import requests
+import sseclient
+from django.conf import settings
+from six.moves import queue
+
+logger = logging.getLogger('velociraptor.logtail')
+
+# Seconds between checks of whether a viewer's tail has ended.
+POLL_INTERVAL = 1
+
+
+def split_lines(chunks):
+    """
+    Yield the lines in an iterable of text chunks, without their newlines.
+    A line split across chunks is joined once, when its end arrives.
+    """
+    partial = []
+    for chunk in chunks:
+        lines = chunk.split('\n')
+        if len(lines) == 1:
+            partial.append(chunk)
+            continue
+        partial.append(lines[0])
+        yield ''.join(partial)
+        for line in lines[1:-1]:
+            yield line
+        partial = [lines[-1]] if lines[-1] else []
+
+
+def format_text(line):
+    return line + '\n'
+
+
+def format_sse(line):
+    return sseclient.Event(data=line).dump()
+
+
+class Viewer(object):
+    """
+    One viewer's iterator of a proc's log lines, each passed through
+    `formatter`, for a StreamingHttpResponse, which closes it when the
+    viewer goes away.
+    """
+
+    def __init__(self, tail, formatter, backlog):
+        self.tail = tail
+        self.formatter = formatter
+        self.backlog = list(backlog)
+        self.queue = queue.Queue(settings.LOG_TAIL_QUEUE_SIZE)
+        self.ended = False
+
+    def put(self, line):
+        """
+        Queue `line` for the viewer.  Return False if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            return False
+        return True
+
+    def __iter__(self):
+        for line in self.backlog:
+            yield self.formatter(line)
+        self.backlog = []
+        while True:
+            try:
+                line = self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.ended:
+                    return
+                continue
+            yield self.formatter(line)
+
+    def close(self):
+        _remove(self)
+
+
+class Tail(object):
+    """
+    A connection to the logtail endpoint of the proc `procname` on
+    `hostname`, whose lines are handed out to Viewers.
+    """
+
+    def __init__(self, hostname, procname):
+        self.hostname = hostname
+        self.procname = procname
+        self.viewers = set()
+        self.backlog = deque(maxlen=settings.LOG_TAIL_BACKLOG)
+        self.lock = threading.Lock()
+        self.resp = None
+        self.stopped = False
+        # Set once the connection is made or has failed, with the error.
+        self.connected = threading.Event()
+        self.error = None
+        self._thread = threading.Thread(
+            target=self._run, name='logtail-%s-%s' % (hostname, procname))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def add_viewer(self, formatter):
+        with self.lock:
+            viewer = Viewer(self, formatter, self.backlog)
+            self.viewers.add(viewer)
+        return viewer
+
+    def remove_viewer(self, viewer):
+        with self.lock:
+            self.viewers.discard(viewer)
+            return len(self.viewers)
+
+    def _connect(self):
+        url = 'http://{0}:{1}/logtail/{2}'.format(
+            self.hostname, settings.SUPERVISOR_PORT, self.procname)
+
+        auth = None
+        if settings.SUPERVISOR_USERNAME:
+            auth = (settings.SUPERVISOR_USERNAME,
+                    settings.SUPERVISOR_PASSWORD)
+
+        self.resp = requests.get(url, stream=True, auth=auth)
+        self.resp.raise_for_status()
+        # Supervisor sends the log chunked, so each chunk comes through as
+        # soon as it's written, however short.
+        return self.resp.iter_content(
+            chunk_size=settings.LOG_TAIL_CHUNK_SIZE, decode_unicode=True)
+
+    def _run(self):
+        try:
+            try:
+                chunks = self._connect()
+            except Exception as exc:
+                # Raised to the viewers' callers by tail().
+                self.error = exc
+                return
+            finally:
+                self.connected.set()
+            if self.stopped:
+                # Everyone left while we were connecting.
+                self._close()
+                return
+            for line in split_lines(chunks):
+                self._broadcast(line)
+        except Exception:
+            if not self.stopped:
+                logger.exception('Lost log tail of %s on %s',
+                                 self.procname, self.hostname)
+        finally:
+            self._end()
+
+    def _broadcast(self, line):
+        with self.lock:
+            self.backlog.append(line)
+            viewers = list(self.viewers)
+        for viewer in viewers:
+            if not viewer.put(line):
+                logger.info('Dropping slow viewer of %s on %s',
+                            self.procname, self.hostname)
+                viewer.ended = True
+                self.remove_viewer(viewer)
+
+    def _end(self):
+        _forget(self)
+        with self.lock:
+            for viewer in self.viewers:
+                viewer.ended = True
+
+    def stop(self):
+        """
+        Close the connection, which ends the tail.
+        """
+        self.stopped = True
+        self._close()
+
+    def _close(self):
+        if self.resp is not None:
+            # Close the connection
+            self.resp.raw._fp.close()
+            # Release the connection from the pool
+            self.resp.raw.release_conn()
+
+
+_tails = {}
+_tails_pid = None
+_tails_lock = threading.Lock()
+
+
+def tail(hostname, procname, formatter=format_text):
+    """
+    Return a Viewer of the log of the proc `procname` on `hostname`,
+    connecting to the host only if nobody in this process is watching that
+    log already.
+
+    Wait for the connection to be made, and raise the error if it fails.
+    """
+    global _tails, _tails_pid
+    with _tails_lock:
+        if _tails_pid != os.getpid():
+            # Forked: the parent's connections and threads aren't ours.
+            _tails = {}
+            _tails_pid = os.getpid()
+        key = hostname, procname
+        log_tail = _tails.get(key)
+        new = log_tail is None
+        if new:
+            log_tail = _tails[key] = Tail(hostname, procname)
+        viewer = log_tail.add_viewer(formatter)
+    if new:
+        log_tail.start()
+    log_tail.connected.wait()
+    if log_tail.error is not None:
+        viewer.close()
+        raise log_tail.error
+    return viewer
+
+
+def _remove(viewer):
+    log_tail = viewer.tail
+    with _tails_lock:
+        if log_tail.remove_viewer(viewer):
+            return
+        if _tails.get((log_tail.hostname, log_tail.procname)) is log_tail:
+            del _tails[log_tail.hostname, log_tail.procname]
+    log_tail.stop()
+
+
+def _forget(log_tail):
+    with _tails_lock:
+        if _tails.get((log_tail.hostname, log_tail.procname)) is log_tail:
+            del _tails[log_tail.hostname, log_tail.procname]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import yaml
+from django.db import migrations, models
+
+
+def count_failures(apps, schema_editor):
+    # Passed results have no failures, so only failed ones need counting.
+    TestResult = apps.get_model('server', 'TestResult')
+    failed = TestResult.objects.filter(passed=False).only('id', 'results')
+    for result in failed.iterator():
+        tests = yaml.safe_load(result.results) or []
+        TestResult.objects.filter(id=result.id).update(
+            failed_count=sum(1 for t in tests if not t['Passed']))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0002_auto_20151127_1936'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testresult',
+            name='failed_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_failures, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0003_testresult_failed_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testrun',
+            name='fail_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='testrun',
+            name='notests_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='testrun',
+            name='pass_count',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0004_testrun_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestResultRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('hostname', models.CharField(max_length=200)),
+                ('procname', models.CharField(max_length=200)),
+                ('pass_count', models.IntegerField(default=0)),
+                ('fail_count', models.IntegerField(default=0)),
+                ('notests_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day'],
+                'db_table': 'deployment_testresultrollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='testresultrollup',
+            unique_together=set([('day', 'hostname', 'procname')]),
+        ),
+    ]
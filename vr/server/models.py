@@ -1,8 +1,9 @@
+import collections
 import datetime
 import hashlib
+import json
 import logging
 import os.path
-import random
 import sys
 import xmlrpclib
 
@@ -206,6 +207,9 @@ class OSImage(models.Model):
         """Return the MD5 hash of the contents of this image's archive file."""
         md5 = hashlib.md5()
         with self.file.file as f:
+            # GridFS works files' md5s out as it stores them.
+            if getattr(f, 'md5', None):
+                return f.md5
             for chunk in iter(lambda: f.read(8192), b''):
                 md5.update(chunk)
 
@@ -485,23 +489,8 @@ class Host(models.Model):
         return next(x for x in all_ports if free(x))
 
     def get_free_port(self):
-
-        used_ports = self.get_used_ports()
-        locked_ports = {p.port for p in PortLock.objects.filter(host=self)}
-        occupied_ports = used_ports.union(locked_ports)
-
-        all_ports = range(settings.PORT_RANGE_START, settings.PORT_RANGE_END)
-        # Shuffle, so that we pick a random port
-        random.shuffle(all_ports)
-
-        for port in all_ports:
-            if port not in occupied_ports:
-                return port
-
-        # No free ports!
-        raise ValueError(
-            'No free ports found on host {}: used={}, locked={}'.format(
-                self, used_ports, locked_ports))
+        from vr.server import ports  # Imported late to avoid circularity
+        return ports.find_free_ports(self, 1)[0]
 
     def get_proc(self, name, check_cache=False):
         """
@@ -527,6 +516,7 @@ class Host(models.Model):
         self.raw_host = common_models.Host(
             self.name, settings.SUPERVISOR_PORT,
             redis_or_url=events_redis,
+            redis_cache_lifetime=settings.PROC_CACHE_TTL,
             supervisor_username=user,
             supervisor_password=pwd,
         )
@@ -660,49 +650,56 @@ class Swarm(models.Model):
     def get_procs(self, check_cache=False):
         """
         Return all running procs on the squad that share this swarm's name and
-        proc name.
+        proc name.  With check_cache=True, each host's procs may come from the
+        shared proc cache.
         """
-        if not self.release:
-            return []
+        return self.get_procs_and_unreachable(check_cache)[0]
 
-        procs = []
-        for host in self.squad.hosts.all():
-            procs += host.get_procs(check_cache=check_cache)
-
-        def is_mine(proc):
-            return (
-                proc.config_name == self.config_name and
-                proc.proc_name == self.proc_name and
-                proc.app_name == self.app.name
-            )
+    def get_procs_and_unreachable(self, check_cache=False):
+        """
+        Like get_procs(), but return a tuple of the procs and a list of the
+        squad's hosts that couldn't be asked for theirs.
+        """
+        from vr.server import hostprocs  # Imported late to avoid circularity
+        return hostprocs.get_swarm_procs([self], refresh=not check_cache)[0]
 
-        return [p for p in procs if is_mine(p)]
+    def get_proc_index(self, check_cache=False):
+        """
+        Return a hostprocs.ProcIndex of all the procs on the squad, for
+        looking up this swarm's current and stale procs.
+        """
+        from vr.server import hostprocs  # Imported late to avoid circularity
+        return hostprocs.get_index(
+            self.squad.hosts.all(), refresh=not check_cache)
 
-    def get_prioritized_hosts(self):
+    def get_prioritized_hosts(self, index=None):
         """
         Return list of hosts in the squad sorted first by number of procs from
-        this swarm, then by total number of procs.
+        this swarm, then by total number of procs.  Hosts whose procs couldn't
+        be listed go last.
+
+        Pass the ProcIndex from get_proc_index() as `index` to reuse it.
         """
+        if index is None:
+            index = self.get_proc_index()
+
         # Make list of all hosts in the squad.  Then we'll sort it.
         squad_hosts = list(self.squad.hosts.all())
 
         for h in squad_hosts:
             # Set a couple temp attributes on each host in the squad, for
             # sorting by.
-            h.all_procs = h.get_procs()
-            h.swarm_procs = [
-                p
-                for p in h.all_procs
-                if p.hash == self.release.hash
-                and p.proc_name == self.proc_name
-            ]
-
-            # On each host, set a tuple in form (x, y), where:
+            h.reachable = h.name not in index.unreachable
+            h.swarm_procs = index.current(self, h.name)
+
+            # On each host, set a tuple in form (u, x, y), where:
+                # u = whether we failed to list this host's procs
                 # x = number of procs running on this host that belong to the
                 # swarm
                 # y = total number of procs running on this host
 
-            h.sortkey = (len(h.swarm_procs), len(h.all_procs))
+            h.sortkey = (
+                not h.reachable, len(h.swarm_procs), index.count(h.name))
 
         squad_hosts.sort(key=lambda h: h.sortkey)
         return squad_hosts
@@ -841,50 +838,82 @@ class TestRun(models.Model):
     start = models.DateTimeField()
     end = models.DateTimeField(null=True)
 
+    # Counts of the run's results, kept by update_counts() when it ends.
+    pass_count = models.IntegerField(null=True)
+    fail_count = models.IntegerField(null=True)
+    notests_count = models.IntegerField(null=True)
+
+    COUNTS = 'pass_count', 'fail_count', 'notests_count'
+
     def __unicode__(self):
         return self.start.isoformat()
 
-    @property
-    def results(self):
+    def count_results(self):
         """
-        Return a serializable compilation/summary of the test run results.
+        Return a dict of the run's counts of results that passed, failed and
+        had no tests, counted with a single query.
+        """
+        def count(**conditions):
+            return models.Sum(models.Case(
+                models.When(then=1, **conditions),
+                default=0,
+                output_field=models.IntegerField(),
+            ))
+        counts = self.tests.aggregate(
+            pass_count=count(passed=True),
+            fail_count=count(passed=False),
+            notests_count=count(testcount=0),
+        )
+        # Summing no rows gives None.
+        return dict((name, counts[name] or 0) for name in self.COUNTS)
+
+    def get_counts(self):
+        """
+        Return the run's counts, as saved when it ended, or as they stand.
+        """
+        if self.pass_count is None:
+            return self.count_results()
+        return dict((name, getattr(self, name)) for name in self.COUNTS)
+
+    def update_counts(self):
         """
+        Count the run's results and keep the counts, to be saved with it.
+        """
+        for name, value in self.count_results().items():
+            setattr(self, name, value)
+
+    def _summary(self, tests):
         end = self.end.isoformat() if self.end else None
         seconds = (self.end - self.start).total_seconds() if end else None
-        return {
+        summary = {
             'start': self.start.isoformat(),
             'end': end,
             'seconds': seconds,
-            'pass_count': self.tests.filter(passed=True).count(),
-            'fail_count': self.tests.filter(passed=False).count(),
-            'notests_count': self.tests.filter(testcount=0).count(),
             'results': {
                 '{t.hostname}-{t.procname}'.format(t=t): t.as_dict()
-                for t in self.tests.all()
+                for t in tests
             }
         }
+        summary.update(self.get_counts())
+        return summary
+
+    @property
+    def results(self):
+        """
+        Return a serializable compilation/summary of the test run results.
+        """
+        return self._summary(self.tests.all())
 
     def get_failures(self):
         """
         Return a serializable compilation/summary of the test run failures.
         """
-        end = self.end.isoformat() if self.end else None
-        seconds = (self.end - self.start).total_seconds() if end else None
-        return {
-            'start': self.start.isoformat(),
-            'end': end,
-            'seconds': seconds,
-            'pass_count': self.tests.filter(passed=True).count(),
-            'fail_count': self.tests.filter(passed=False).count(),
-            'notests_count': self.tests.filter(testcount=0).count(),
-            'results': {
-                '{t.hostname}-{t.procname}'.format(t=t): t.as_dict()
-                for t in self.tests.filter(passed=False)
-            }
-        }
+        return self._summary(self.tests.filter(passed=False))
 
     def has_failures(self):
-        return self.tests.filter(passed=False).count() > 0
+        if self.fail_count is not None:
+            return self.fail_count > 0
+        return self.tests.filter(passed=False).exists()
 
     class Meta:
         ordering = ['-start']
@@ -901,7 +930,9 @@ class TestResult(models.Model):
     procname = models.CharField(max_length=200)
     passed = models.BooleanField(default=False)
     testcount = models.IntegerField(default=0)
-    # YAML dump of test results
+    failed_count = models.IntegerField(default=0)
+    # JSON list of the uptester's results.  Rows saved before we switched
+    # from YAML still hold YAML.
     results = models.TextField()
 
     def __unicode__(self):
@@ -911,16 +942,39 @@ class TestResult(models.Model):
             desc = 'no tests'
         return '%s: %s' % (self.procname, desc)
 
+    @classmethod
+    def from_results(cls, run_id, hostname, procname, results, time=None):
+        """
+        Return an unsaved TestResult for the uptester's `results` for a proc,
+        with its summary columns filled in.
+        """
+        failed_count = sum(1 for t in results if not t['Passed'])
+        return cls(
+            run_id=run_id,
+            time=time or timezone.now(),
+            hostname=hostname,
+            procname=procname,
+            # A proc without uptests hasn't failed any.
+            passed=not failed_count,
+            testcount=len(results),
+            failed_count=failed_count,
+            results=json.dumps(results, separators=(',', ':')),
+        )
+
     def as_dict(self):
-        return yaml.safe_load(self.results)
+        try:
+            return json.loads(self.results)
+        except ValueError:
+            return yaml.safe_load(self.results)
 
     def get_fails(self):
         """
         Return a list of dictionaries like the one returned from as_dict, but
         containing just the failed tests.
         """
-        parsed = yaml.safe_load(self.results)
-        return [t for t in parsed if t['Passed'] is False]
+        if self.passed:
+            return []
+        return [t for t in self.as_dict() if t['Passed'] is False]
 
     def format_fail(self, result):
         """
@@ -937,6 +991,77 @@ class TestResult(models.Model):
         db_table = 'deployment_testresult'
 
 
+class TestResultRollup(models.Model):
+    """
+    How a proc on a host fared in a day's test runs, kept once that day's
+    TestResults are old enough to be deleted.
+    """
+    day = models.DateField()
+    hostname = models.CharField(max_length=200)
+    procname = models.CharField(max_length=200)
+    pass_count = models.IntegerField(default=0)
+    fail_count = models.IntegerField(default=0)
+    notests_count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return '%s@%s on %s: %s passed, %s failed' % (
+            self.procname, self.hostname, self.day, self.pass_count,
+            self.fail_count)
+
+    @classmethod
+    def roll_up(cls, results):
+        """
+        Add `results`, dicts of TestResults' time, hostname, procname,
+        passed and testcount, to the rollups for their procs and days.
+
+        However many procs and days there are, this takes one query to find
+        the rollups that already exist, one to create the rest, and one to
+        add to the existing ones.
+        """
+        counts = collections.defaultdict(collections.Counter)
+        for result in results:
+            key = (timezone.localtime(result['time']).date(),
+                   result['hostname'], result['procname'])
+            counts[key]['pass_count' if result['passed'] else
+                        'fail_count'] += 1
+            if not result['testcount']:
+                counts[key]['notests_count'] += 1
+        if not counts:
+            return
+
+        # Filtering on each field separately may find some rollups we don't
+        # want, which are skipped, but needs no clause per key.
+        days, hostnames, procnames = (set(field) for field in zip(*counts))
+        found = cls.objects.select_for_update().filter(
+            day__in=days, hostname__in=hostnames, procname__in=procnames)
+        existing = {}
+        for rollup_id, day, hostname, procname in found.values_list(
+                'id', 'day', 'hostname', 'procname'):
+            if (day, hostname, procname) in counts:
+                existing[day, hostname, procname] = rollup_id
+
+        cls.objects.bulk_create([
+            cls(day=day, hostname=hostname, procname=procname,
+                **counts[day, hostname, procname])
+            for day, hostname, procname in counts
+            if (day, hostname, procname) not in existing
+        ])
+
+        def increment(name):
+            return models.F(name) + models.Case(
+                *[models.When(id=rollup_id, then=counts[key][name])
+                  for key, rollup_id in existing.items()],
+                default=0, output_field=models.IntegerField())
+        if existing:
+            cls.objects.filter(id__in=existing.values()).update(**dict(
+                (name, increment(name)) for name in TestRun.COUNTS))
+
+    class Meta:
+        ordering = ['-day']
+        db_table = 'deployment_testresultrollup'
+        unique_together = ('day', 'hostname', 'procname')
+
+
 @reversion.register
 class Dashboard(models.Model):
     name = models.CharField(max_length=50)
@@ -0,0 +1,220 @@
+"""
+Pick free ports on a host for new procs, and reserve them until the procs
+are deployed.
+
+Where reservations are kept depends on the backend named in
+settings.PORT_RESERVATIONS: PortLock rows in the database by default, or
+sorted sets in Redis.
+"""
+
+import datetime
+import logging
+import random
+import time
+
+import redis
+import six
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from vr.common.utils import parse_redis_url
+
+from vr.server import models
+
+logger = logging.getLogger('velociraptor.ports')
+
+# How many times to pick new ports when someone else reserves one of ours
+# first.
+ALLOCATE_ATTEMPTS = 3
+
+
+class PortsTaken(Exception):
+    """
+    Raised when some of the ports being reserved are reserved already.
+    """
+
+
+def _hostname(host):
+    return host if isinstance(host, six.string_types) else host.name
+
+
+class DatabaseReservations(object):
+    """
+    Reserve ports with PortLock rows.  Locks left behind by deploys that
+    never finished are deleted by expire() once they're MAX_AGE_DAYS old.
+
+    `host` can either be a hostname or a db obj.
+    """
+
+    def __init__(self, config):
+        self.max_age = datetime.timedelta(days=config.get('MAX_AGE_DAYS', 7))
+
+    @staticmethod
+    def _host(host):
+        if isinstance(host, six.string_types):
+            return models.Host.objects.get(name=host)
+        return host
+
+    def reserve(self, host, ports):
+        host = self._host(host)
+        try:
+            with transaction.atomic():
+                models.PortLock.objects.bulk_create(
+                    [models.PortLock(host=host, port=port) for port in ports])
+        except IntegrityError:
+            raise PortsTaken(host.name, ports)
+
+    def release(self, host, ports):
+        models.PortLock.objects.filter(
+            host=self._host(host),
+            port__in=[int(port) for port in ports],
+        ).delete()
+
+    def reserved(self, host):
+        return set(models.PortLock.objects.filter(
+            host=self._host(host)).values_list('port', flat=True))
+
+    def expire(self):
+        dt = timezone.now() - self.max_age
+        models.PortLock.objects.filter(created_time__lt=dt).delete()
+
+
+class RedisReservations(object):
+    """
+    Reserve ports in Redis, in a sorted set per host holding each reserved
+    port scored by the time its reservation runs out.  Reservations expire
+    on their own TTL seconds after they're made, and the whole set once the
+    last of them has.  Without a URL, the events Redis is used.
+
+    `host` can either be a hostname or a db obj.  Either way the database
+    isn't touched.
+    """
+
+    KEY_PREFIX = 'port_reservations'
+
+    # Drop expired reservations, then reserve all ports given after the
+    # current time and expiry time, or none of them if any are taken.
+    RESERVE_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        for i = 3, #ARGV do
+            if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+                return 0
+            end
+        end
+        for i = 3, #ARGV do
+            redis.call('ZADD', KEYS[1], ARGV[2], ARGV[i])
+        end
+        redis.call('EXPIREAT', KEYS[1], ARGV[2])
+        return 1
+    """
+
+    def __init__(self, config):
+        if config.get('URL'):
+            self.rcon = redis.StrictRedis(**parse_redis_url(config['URL']))
+        else:
+            self.rcon = models.events_redis
+        self.ttl = config.get('TTL', 3600)
+        self._reserve = self.rcon.register_script(self.RESERVE_SCRIPT)
+
+    def _key(self, host):
+        return ':'.join([self.KEY_PREFIX, _hostname(host)])
+
+    def reserve(self, host, ports):
+        now = int(time.time())
+        args = [now, now + self.ttl] + [int(port) for port in ports]
+        if not self._reserve(keys=[self._key(host)], args=args):
+            raise PortsTaken(_hostname(host), ports)
+
+    def release(self, host, ports):
+        if ports:
+            self.rcon.zrem(self._key(host), *[int(port) for port in ports])
+
+    def reserved(self, host):
+        members = self.rcon.zrangebyscore(
+            self._key(host), '(%d' % time.time(), '+inf')
+        return set(int(port) for port in members)
+
+    def expire(self):
+        # Redis expires reservations by itself.
+        pass
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Return the port reservation backend configured in
+    settings.PORT_RESERVATIONS.
+    """
+    global _backend
+    if _backend is None:
+        config = settings.PORT_RESERVATIONS
+        _backend = import_string(config['BACKEND'])(config)
+    return _backend
+
+
+def release_ports(host, ports):
+    """
+    Release the reservations on `ports` on `host`, a hostname or db obj.
+    """
+    logger.info('Releasing port reservations %s:%s', host, ports)
+    get_backend().release(host, ports)
+
+
+def expire_reservations():
+    """
+    Release reservations left behind by deploys that never finished.
+    """
+    get_backend().expire()
+
+
+def find_free_ports(host, count, used_ports=None):
+    """
+    Return `count` random ports on `host` in PORT_RANGE_START to
+    PORT_RANGE_END that no proc uses and that aren't reserved.
+
+    `used_ports` are the ports of the procs on the host.  Pass them if you
+    already have them, to save asking the host's supervisor.
+    """
+    start, end = settings.PORT_RANGE_START, settings.PORT_RANGE_END
+    used_ports = set(
+        host.get_used_ports() if used_ports is None else used_ports)
+    reserved_ports = get_backend().reserved(host)
+
+    # One byte per port in the range, set if the port is taken.
+    taken = bytearray(end - start)
+    for port in used_ports | reserved_ports:
+        if start <= port < end:
+            taken[port - start] = 1
+    free = [start + i for i, is_taken in enumerate(taken) if not is_taken]
+
+    if len(free) < count:
+        raise ValueError(
+            'Only {} of {} free ports found on host {}: used={}, '
+            'reserved={}'.format(
+                len(free), count, host, used_ports, reserved_ports))
+    # Pick at random, so concurrent allocations rarely collide.
+    return random.sample(free, count)
+
+
+def allocate_ports(host, count, used_ports=None):
+    """
+    Find `count` free ports on `host` as find_free_ports() does, reserve
+    them all at once and return them.  If another allocation reserved some
+    of the same ports first, pick again.
+    """
+    if used_ports is None:
+        used_ports = host.get_used_ports()
+    for attempt in range(1, ALLOCATE_ATTEMPTS + 1):
+        ports = find_free_ports(host, count, used_ports)
+        logger.info('Reserving ports %s:%s', host, ports)
+        try:
+            get_backend().reserve(host, ports)
+        except PortsTaken:
+            if attempt == ALLOCATE_ATTEMPTS:
+                raise
+            logger.info('Port reservation collision on %s.  Retrying.', host)
+        else:
+            return ports
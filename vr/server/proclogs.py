@@ -0,0 +1,184 @@
+"""
+Read parts of procs' logs, and search them, through their hosts' supervisor.
+
+Logs are read PROC_LOG_CHUNK_SIZE bytes at a time, so neither a whole log
+nor all of a search's results ever have to fit in a web worker's memory.
+Offsets are in bytes from the start of the proc's current stdout log file.
+
+Supervisor sends what it reads as text, and fails a read that starts or ends
+inside a multibyte UTF-8 character.  Such reads are retried with their ends
+moved in to the nearest character boundaries, so the data read may start a
+little after, and end a little before, the offsets asked for.
+"""
+
+import re
+from collections import deque
+from xml.parsers.expat import ExpatError
+
+import six
+from django.conf import settings
+from six.moves import xmlrpc_client
+
+# The errors a read gets when an end of it splits a character, depending on
+# the versions of supervisor and Python on the host.
+SPLIT_CHARACTER_ERRORS = (
+    xmlrpc_client.Fault, xmlrpc_client.ProtocolError, ExpatError)
+
+# The furthest a character boundary can be from any offset in UTF-8.
+MAX_BOUNDARY_SHIFT = 3
+
+
+def _to_bytes(data):
+    if isinstance(data, six.text_type):
+        return data.encode('utf-8')
+    return data
+
+
+def _to_text(line):
+    return line.decode('utf-8', 'replace')
+
+
+class ProcLog(object):
+    """
+    The stdout log of the proc `procname` on `host`, a Host model instance.
+    """
+
+    def __init__(self, host, procname):
+        self.supervisor = host.raw_host.supervisor
+        self.procname = procname
+
+    def size(self):
+        # With nothing to read, tailing just reports where the log ends.
+        return self.supervisor.tailProcessStdoutLog(self.procname, 0, 0)[1]
+
+    def read(self, offset, length):
+        """
+        Return (offset, data) for up to `length` bytes of the log from
+        `offset`, without any characters split at either end.  If nothing
+        whole fits, the data is empty.
+        """
+        shifts = sorted(
+            ((start, end) for start in range(MAX_BOUNDARY_SHIFT + 1)
+             for end in range(MAX_BOUNDARY_SHIFT + 1)),
+            key=sum)
+        error = None
+        for start, end in shifts:
+            if start + end >= length:
+                # Supervisor would read to the end of the log.
+                return offset, b''
+            try:
+                data = self.supervisor.readProcessStdoutLog(
+                    self.procname, offset + start, length - start - end)
+            except SPLIT_CHARACTER_ERRORS as exc:
+                error = error or exc
+                continue
+            return offset + start, _to_bytes(data)
+        raise error
+
+    def window(self, offset=None, length=None):
+        """
+        Return (offset, size, data) for up to `length` bytes of the log
+        from `offset`.  A negative `offset` counts back from the end of the
+        log.  By default the window ends at the end of the log.
+        """
+        max_length = settings.PROC_LOG_WINDOW_MAX_BYTES
+        length = max_length if length is None else min(length, max_length)
+        size = self.size()
+        if offset is None:
+            offset = size - length
+        elif offset < 0:
+            offset += size
+        offset = max(0, min(offset, size))
+        offset, data = self.read(offset, min(length, size - offset))
+        return offset, size, data
+
+    def lines(self, count, end=None):
+        """
+        Return (offset, size, data) for the last `count` lines before `end`,
+        by default the end of the log, reading back from there a chunk at a
+        time.  At most PROC_LOG_WINDOW_MAX_BYTES are returned.
+        """
+        max_length = settings.PROC_LOG_WINDOW_MAX_BYTES
+        size = self.size()
+        end = size if end is None else max(0, min(end, size))
+        start = end
+        chunks = deque()
+        newlines = 0
+        # One more newline than lines wanted, to be sure the first is whole.
+        while start > 0 and end - start < max_length and newlines <= count:
+            length = min(settings.PROC_LOG_CHUNK_SIZE, start,
+                         max_length - (end - start))
+            offset, chunk = self.read(start - length, length)
+            if not chunk:
+                break
+            start = offset
+            chunks.appendleft(chunk)
+            newlines += chunk.count(b'\n')
+
+        read = b''.join(chunks)
+        data = b''.join(read.splitlines(True)[-count:]) if count else b''
+        return start + len(read) - len(data), size, data
+
+    def search(self, pattern, start=0, end=None, ignore_case=False,
+               max_results=None):
+        """
+        Yield a dict for each line of the log between `start` and `end`
+        that matches `pattern`, a regular expression, with the line's
+        'offset' and 'text', and the 'start' and 'end' of the match in it.
+
+        The last dict yielded has 'done' set, with the 'offset' the search
+        got to, the log's 'size', and whether it stopped at `max_results`
+        matches before the end ('truncated').
+        """
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        if max_results is None:
+            max_results = settings.PROC_LOG_SEARCH_MAX_RESULTS
+        chunk_size = settings.PROC_LOG_CHUNK_SIZE
+        size = self.size()
+        end = size if end is None else min(end, size)
+        pos = max(0, start)
+        # The start of a line whose end hasn't been read yet.
+        partial = b''
+        found = 0
+
+        def match(line, offset):
+            text = _to_text(line.rstrip(b'\r'))
+            m = regex.search(text)
+            if m:
+                return {'offset': offset, 'text': text,
+                        'start': m.start(), 'end': m.end()}
+
+        while pos < end and found < max_results:
+            pos, chunk = self.read(pos, min(chunk_size, end - pos))
+            if not chunk:
+                break
+            lines = (partial + chunk).split(b'\n')
+            offset = pos - len(partial)
+            pos += len(chunk)
+            partial = lines.pop()
+            if len(partial) > chunk_size:
+                # Search overlong lines a chunk at a time.
+                lines.append(partial)
+                partial = b''
+            for line in lines:
+                result = match(line, offset)
+                offset += len(line) + 1
+                if result:
+                    found += 1
+                    yield result
+                    if found == max_results:
+                        pos = offset
+                        break
+
+        if partial and found < max_results:
+            result = match(partial, pos - len(partial))
+            if result:
+                found += 1
+                yield result
+
+        yield {
+            'done': True,
+            'offset': pos,
+            'size': size,
+            'truncated': found >= max_results and pos < end,
+        }
@@ -5,15 +5,19 @@ SSH.
 
 from __future__ import print_function
 
+import itertools
 import traceback
 import posixpath
 import json
 import os
 import re
+import io
+import tarfile
 import time
 import contextlib
 
 import pkg_resources
+import six
 import yaml
 from fabric.api import (sudo as sudo_, get, put, task, env, settings as
                         fab_settings, hide)
@@ -98,9 +102,93 @@ def deploy_proc(proc_yaml_path):
     supervisorctl('add ' + get_container_name(settings))
 
 
-def write_proc_conf(settings):
+DEPLOYED_PROC_MARKER = '==> vr-deployed-proc'
+
+
+def _parse_deployed_procs(out):
+    """
+    Return the names of the procs that deploy_procs' remote script reported
+    as set up in its output `out`.
+    """
+    return [
+        line[len(DEPLOYED_PROC_MARKER):].strip()
+        for line in (out or '').splitlines()
+        if line.startswith(DEPLOYED_PROC_MARKER)
+    ]
+
+
+@task
+def deploy_procs(proc_yaml_paths, archive_path='procs.tar.gz'):
+    """
+    Given paths to several proc.yaml files, get all of those procs set up on
+    the remote host at once.
+
+    All proc.yaml and proc.conf files are uploaded in a single tarball, the
+    runner setups are chained in one remote shell, and supervisor is told to
+    reread its config just once at the end.  If a setup fails, the procs set
+    up before it are still put under supervision before the error is raised.
+    """
+    all_settings = [load_proc_data(path) for path in proc_yaml_paths]
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        for path, settings in zip(proc_yaml_paths, all_settings):
+            name = get_container_name(settings)
+            archive.add(path, arcname=posixpath.join(name, 'proc.yaml'))
+            conf = render_proc_conf(settings).encode('utf-8')
+            info = tarfile.TarInfo(posixpath.join(name, 'proc.conf'))
+            info.size = len(conf)
+            archive.addfile(info, io.BytesIO(conf))
+
+    staging = '/tmp/' + randchars()
+    remote_archive = staging + '.tar.gz'
+    put(archive_path, remote_archive, use_sudo=True)
+
+    commands = [
+        'mkdir -p ' + staging,
+        'tar -xzf %s -C %s' % (remote_archive, staging),
+    ]
+    for settings in all_settings:
+        proc_path = get_proc_path(settings)
+        staged = posixpath.join(staging, get_container_name(settings))
+        remote_proc_yaml = posixpath.join(proc_path, 'proc.yaml')
+        commands.extend([
+            'mkdir -p ' + proc_path,
+            'cp %s/proc.yaml %s' % (staged, remote_proc_yaml),
+            get_runner(settings) + ' setup ' + remote_proc_yaml,
+            'cp %s/proc.conf %s' % (staged, proc_path),
+            'echo "%s %s"' % (DEPLOYED_PROC_MARKER,
+                              get_container_name(settings)),
+        ])
+    # Clean up the staging area whether or not the setups succeeded, but
+    # keep the exit status of the setups.
+    script = '(%s); status=$?; rm -rf %s %s; exit $status' % (
+        ' && '.join(commands), staging, remote_archive)
+
+    error = None
+    try:
+        out = sudo(script)
+    except Error as exc:
+        error, out = exc, exc.out
+
+    # Even if a setup failed part way, the procs set up before it are
+    # complete and should be put under supervision.
+    deployed = _parse_deployed_procs(out)
+    if deployed:
+        try:
+            supervisorctl('reread')
+            supervisorctl('update ' + ' '.join(deployed))
+        except Exception:
+            if error is None:
+                raise
+            # Don't let this hide the setup failure.
+            print('deploy_procs: Failed updating supervisor:\n' +
+                  traceback.format_exc())
+    if error is not None:
+        raise error
+
+
+def get_proc_conf_vars(settings):
     proc_path = get_proc_path(settings)
-    proc_conf_vars = {
+    return {
         'proc_yaml_path': posixpath.join(proc_path, 'proc.yaml'),
         'container_name': get_container_name(settings),
         'container_path': get_container_path(settings),
@@ -108,119 +196,229 @@ def write_proc_conf(settings):
         'runner': get_runner(settings),
         'user': 'root',
     }
+
+
+def render_proc_conf(settings):
+    """
+    Return the contents of the supervisor include for the proc, rendered the
+    same way files.upload_template would.
+    """
+    with open(get_template('proc.conf')) as f:
+        return f.read() % get_proc_conf_vars(settings)
+
+
+def write_proc_conf(settings):
+    proc_path = get_proc_path(settings)
     proc_conf_tmpl = get_template('proc.conf')
     files.upload_template(
         proc_conf_tmpl,
         posixpath.join(proc_path, 'proc.conf'),
-        proc_conf_vars,
+        get_proc_conf_vars(settings),
         use_sudo=True)
 
 
-@task
-def run_uptests(
-        hostname, proc_name, user='nobody', ignore_missing_procs=False):
-    try:
-        host = Host.objects.get(name=hostname)
-
-        try:
-            proc = host.get_proc(proc_name)
-        except ProcError:
-            if ignore_missing_procs:
-                print('Missing proc {} on host {}'.format(proc_name, hostname))
-                return []
-            raise
-
-        settings = proc.settings
-        if settings is None:
-            print('{0.name} (pid {0.pid}) running on {0.hostname} '
-                  'is not a VR process.  Skipping...'.format(proc))
-            return []
+# Marks the lines of find_uptests' remote command that name a path found.
+UPTEST_PATH_MARKER = '==> vr-uptest-path'
 
-        proc_path = get_proc_path(settings)
 
-        new_container_path = posixpath.join(proc_path, 'rootfs')
-        if files.exists(new_container_path, use_sudo=True):
-            tests_path = posixpath.join(new_container_path, 'app/uptests',
-                                        settings.proc_name)
-        else:
-            build_path = get_build_path(settings)
-            tests_path = posixpath.join(
-                build_path, 'uptests', settings.proc_name)
+def _uptest_error(error=None):
+    """
+    Return uptest results reporting `error`, a remote command Error, or else
+    the exception being handled.
+    """
+    output = repr(error.out) if error is not None else traceback.format_exc()
+    return [{
+        'Name': None,
+        'Output': output,
+        'Passed': False,
+    }]
 
-        if not files.exists(tests_path, use_sudo=True):
-            return []
 
-        # Containers set up by new-style 'runners' will be in a 'rootfs'
-        # subpath under the proc_path.  Old style containers are right in
-        # the proc_path.  We have to launch the uptester slightly
-        # differently
-        if files.exists(new_container_path, use_sudo=True):
-            proc_yaml_path = posixpath.join(proc_path, 'proc.yaml')
-            cmd = get_runner(settings) + ' uptest ' + proc_yaml_path
-        else:
-            cmd = legacy_uptests_command(
-                proc_path, settings.proc_name, env.host_string,
-                settings.port, user)
+def _parse_uptest_output(result):
+    """
+    Return the list of results in the uptester's output `result`.
+    """
+    # Though the uptester emits JSON to stdout, it's possible for the
+    # container or env var setup to emit some other output before the
+    # uptester even runs.  Stuff like this:
 
-        result = sudo(cmd)
-        # Though the uptester emits JSON to stdout, it's possible for the
-        # container or env var setup to emit some other output before the
-        # uptester even runs.  Stuff like this:
+    # 'bash: /app/env.sh: No such file or directory'
 
-        # 'bash: /app/env.sh: No such file or directory'
+    # Split that off and prepend it as an extra first uptest result.
+    # Since results should be a JSON list, look for any characters
+    # preceding the first square bracket.
 
-        # Split that off and prepend it as an extra first uptest result.
-        # Since results should be a JSON list, look for any characters
-        # preceding the first square bracket.
+    m = re.match(r'(?P<prefix>[^\[]*)(?P<json>.*)', result, re.S)
 
-        m = re.match(r'(?P<prefix>[^\[]*)(?P<json>.*)', result, re.S)
+    # If the regular expression doesn't even match, return the raw
+    # string.
+    if m is None:
+        return [{
+            'Passed': False,
+            'Name': 'uptester',
+            'Output': result,
+        }]
 
-        # If the regular expression doesn't even match, return the raw
-        # string.
-        if m is None:
-            return [{
+    parts = m.groupdict()
+    try:
+        parsed = json.loads(parts['json'])
+        if len(parts['prefix']):
+            parsed.insert(0, {
                 'Passed': False,
                 'Name': 'uptester',
-                'Output': result,
-            }]
+                'Output': parts['prefix']
+            })
+        return parsed
+    except ValueError:
+        # If we still fail parsing the json, return a dict of our own
+        # with all the output inside.
+        return [{
+            'Passed': False,
+            'Name': 'uptester',
+            'Output': result
+        }]
 
-        parts = m.groupdict()
-        try:
-            parsed = json.loads(parts['json'])
-            if len(parts['prefix']):
-                parsed.insert(0, {
+
+def _existing_paths(paths):
+    """
+    Return the set of `paths` that exist on the host, checked with a single
+    remote command rather than one files.exists() each.
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        return set()
+    commands = [
+        'test -e "%s" && echo "%s %s"' % (path, UPTEST_PATH_MARKER, path)
+        for path in paths
+    ]
+    commands.append('true')
+    with fab_settings(hide('stdout')):
+        output = sudo('; '.join(commands))
+    return set(
+        line[len(UPTEST_PATH_MARKER):].strip()
+        for line in output.splitlines()
+        if line.startswith(UPTEST_PATH_MARKER)
+    )
+
+
+def find_uptests(hostname, procs, user='nobody', ignore_missing_procs=False):
+    """
+    Work out how to uptest each of `procs` on the host, checking for all
+    their uptests with one remote command instead of separate `exists`
+    probes.  `procs` may be the host's Procs, or names to look up by asking
+    supervisor for the host's procs.  Each proc's settings are still fetched
+    from supervisor separately.
+
+    Return a tuple of a dict of the command that runs each proc's uptests,
+    for the procs that have some, and a dict of results for the rest: empty
+    for procs without uptests, or the error that stopped us finding them.
+    """
+    proc_names = [
+        proc if isinstance(proc, six.string_types) else proc.name
+        for proc in procs]
+    commands = {}
+    results = {}
+    try:
+        if any(isinstance(proc, six.string_types) for proc in procs):
+            procs = Host.objects.get(name=hostname).get_procs()
+        procs = dict((proc.name, proc) for proc in procs)
+
+        # proc name -> (settings, proc path, container path, tests path in
+        # the container, tests path in the build)
+        found = {}
+        for proc_name in proc_names:
+            proc = procs.get(proc_name)
+            if proc is None:
+                if ignore_missing_procs:
+                    print('Missing proc {} on host {}'.format(
+                        proc_name, hostname))
+                    results[proc_name] = []
+                    continue
+                results[proc_name] = [{
+                    'Name': None,
+                    'Output': 'No proc {} on host {}'.format(
+                        proc_name, hostname),
                     'Passed': False,
-                    'Name': 'uptester',
-                    'Output': parts['prefix']
-                })
-            return parsed
-        except ValueError:
-            # If we still fail parsing the json, return a dict of our own
-            # with all the output inside.
-            return [{
-                'Passed': False,
-                'Name': 'uptester',
-                'Output': result
-            }]
+                }]
+                continue
+
+            settings = proc.settings
+            if settings is None:
+                print('{0.name} (pid {0.pid}) running on {0.hostname} '
+                      'is not a VR process.  Skipping...'.format(proc))
+                results[proc_name] = []
+                continue
 
+            proc_path = get_proc_path(settings)
+            container_path = posixpath.join(proc_path, 'rootfs')
+            found[proc_name] = (
+                settings,
+                proc_path,
+                container_path,
+                posixpath.join(container_path, 'app/uptests',
+                               settings.proc_name),
+                posixpath.join(get_build_path(settings), 'uptests',
+                               settings.proc_name),
+            )
+
+        existing = _existing_paths(itertools.chain.from_iterable(
+            paths[2:] for paths in found.values()))
     except Error as error:
         # An error occurred in the command invocation, including if an
         # incorrect password is supplied and abort_on_prompts is True.
-        return [{
-            'Name': None,
-            'Output': repr(error.out),
-            'Passed': False,
-        }]
+        return {}, dict((name, _uptest_error(error)) for name in proc_names)
+    except Exception:
+        return {}, dict((name, _uptest_error()) for name in proc_names)
 
+    for proc_name, paths in found.items():
+        (settings, proc_path, container_path, container_tests_path,
+         build_tests_path) = paths
+        # Containers set up by new-style 'runners' will be in a 'rootfs'
+        # subpath under the proc_path.  Old style containers are right in
+        # the proc_path.  We have to launch the uptester slightly
+        # differently
+        new_container = container_path in existing
+        if new_container:
+            tests_path = container_tests_path
+        else:
+            tests_path = build_tests_path
+        if tests_path not in existing:
+            results[proc_name] = []
+        elif new_container:
+            proc_yaml_path = posixpath.join(proc_path, 'proc.yaml')
+            commands[proc_name] = (
+                get_runner(settings) + ' uptest ' + proc_yaml_path)
+        else:
+            commands[proc_name] = legacy_uptests_command(
+                proc_path, settings.proc_name, env.host_string,
+                settings.port, user)
+    return commands, results
+
+
+def run_uptest(cmd):
+    """
+    Run the uptest command `cmd`, from find_uptests(), and return its
+    results.
+    """
+    try:
+        return _parse_uptest_output(sudo(cmd))
+    except Error as error:
+        return _uptest_error(error)
     except Exception:
         # Catch any other exception raised
         # during the uptests and pass it back in the same format as other test
         # results.
-        return [{
-            'Name': None,
-            'Output': traceback.format_exc(),
-            'Passed': False,
-        }]
+        return _uptest_error()
+
+
+@task
+def run_uptests(
+        hostname, proc_name, user='nobody', ignore_missing_procs=False):
+    commands, results = find_uptests(
+        hostname, [proc_name], user, ignore_missing_procs)
+    if proc_name in commands:
+        return run_uptest(commands[proc_name])
+    return results[proc_name]
 
 
 def legacy_uptests_command(proc_path, proc, host, port, user):
@@ -340,92 +538,244 @@ def delete_build(build, cascade=False):
     sudo('rm -rf %s/%s' % (BUILDS_ROOT, build))
 
 
-def _get_builds_in_use():
-    procs = get_procs()
-    builds_in_use = set([proc_to_build(p) for p in procs])
-    return builds_in_use
+# Each section of the inventory script's output starts with a line holding
+# this marker and the section name, and ends with the marker and the exit
+# status of the section's command.
+INVENTORY_MARKER = '==> vr-inventory'
+
+INVENTORY_SECTIONS = [
+    ('procs', 'ls -1 {procs}'),
+    ('proc_yamls', 'cd {procs} && ls -1d */proc.yaml'),
+    ('builds', 'ls -1 {builds}'),
+    ('images', "find {images} -mindepth 1 -maxdepth 1 -printf '%A@ %f\\n'"),
+    ('supervisor', 'supervisorctl status'),
+    ('ps', 'ps -e -o pid=,ppid=,command='),
+]
+
+
+class Inventory(object):
+    """
+    A snapshot of what's on a host: the proc folders (and which of them have
+    a proc.yaml), builds, images with their access times, the procs known to
+    supervisor and the process table.  Cleanup decisions are made from this
+    instead of asking the host one question at a time.
+
+    `supervised` is None if supervisor couldn't be asked, in which case we
+    can't tell which procs are old.
+    """
+
+    def __init__(self, procs=(), proc_yamls=(), builds=(), images=None,
+                 supervised=None, processes=()):
+        self.procs = list(procs)
+        self.proc_yamls = set(proc_yamls)
+        self.builds = list(builds)
+        self.images = dict(images or {})
+        self.supervised = supervised
+        self.processes = [tuple(p) for p in processes]
+
+    @classmethod
+    def parse(cls, output):
+        """
+        Build an Inventory from the output of the inventory script.
+        """
+        sections = {}
+        statuses = {}
+        current = None
+        for line in output.splitlines():
+            if line.startswith(INVENTORY_MARKER):
+                tokens = line[len(INVENTORY_MARKER):].split()
+                if len(tokens) == 2 and tokens[0] == 'status':
+                    statuses[current] = int(tokens[1])
+                    current = None
+                else:
+                    current = tokens[0]
+                    sections[current] = []
+            elif current is not None and line.strip():
+                sections[current].append(line.strip())
+
+        images = {}
+        for line in sections.get('images', []):
+            atime, _, name = line.partition(' ')
+            images[name] = int(float(atime))
+
+        processes = []
+        for line in sections.get('ps', []):
+            tokens = line.split()
+            processes.append(
+                (int(tokens[0]), int(tokens[1]), ' '.join(tokens[2:])))
+
+        # supervisorctl exits 3 when some procs aren't running, which still
+        # gives a full status listing.
+        supervised = None
+        if statuses.get('supervisor') in (0, 3):
+            supervised = _get_procnames_from_output(
+                '\n'.join(sections['supervisor']))
+
+        return cls(
+            # filter out any .hold files
+            procs=[p for p in sections.get('procs', [])
+                   if not p.endswith('.hold')],
+            proc_yamls=[posixpath.dirname(p)
+                        for p in sections.get('proc_yamls', [])],
+            builds=sections.get('builds', []),
+            images=images,
+            supervised=supervised,
+            processes=processes,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def as_dict(self):
+        return {
+            'procs': self.procs,
+            'proc_yamls': sorted(self.proc_yamls),
+            'builds': self.builds,
+            'images': self.images,
+            'supervised': (None if self.supervised is None
+                           else sorted(self.supervised)),
+            'processes': self.processes,
+        }
+
+    def get_builds_in_use(self):
+        return set(proc_to_build(p) for p in self.procs)
+
+    def get_old_procnames(self):
+        """Get the procnames that are on the filesystem, but unknown
+        to supervisor."""
+        if self.supervised is None:
+            return set()
+        return set(self.procs) - set(self.supervised)
+
+    def get_obsolete_images(self, images, now=None):
+        """
+        Return those of `images` that haven't been accessed in
+        MAX_IMAGE_AGE_SECS.
+        """
+        now = now or time.time()
+        return set(
+            img for img in images
+            if img in self.images
+            and now - self.images[img] > MAX_IMAGE_AGE_SECS
+        )
+
+    def get_orphans(self):
+        #   PID   PPID COMMAND
+        #  6676   6667 sudo -u nobody -E -s ...
+        # 18079  18068 sudo -u nobody -E -s ...
+        #  9642  9634  su --preserve-environment ...
+        orphans = set()
+        for pid, ppid, command in self.processes:
+            is_vr_command = (
+                command.startswith('sudo -u nobody') or
+                command.startswith('su --preserve-environment'))
+
+            is_child_of_init = ppid == 1
+
+            if is_child_of_init and is_vr_command:
+                children = tuple(
+                    cmd for _, parent, cmd in self.processes if parent == pid)
+                orphans.add((pid, children))
+        return orphans
+
+
+@task
+def get_inventory():
+    """
+    Return an Inventory of the host, gathered with a single remote command.
+    """
+    roots = dict(procs=PROCS_ROOT, builds=BUILDS_ROOT, images=IMAGES_ROOT)
+    commands = []
+    for name, command in INVENTORY_SECTIONS:
+        commands.extend([
+            "echo '%s %s'" % (INVENTORY_MARKER, name),
+            '(%s) 2>/dev/null' % command.format(**roots),
+            'echo "%s status $?"' % INVENTORY_MARKER,
+        ])
+    with fab_settings(hide('stdout'), command_timeout=SUPERVISORCTL_TIMEOUT):
+        output = sudo('; '.join(commands))
+    return Inventory.parse(output)
 
 
-def clean_builds_folders():
+def clean_builds_folders(inventory=None):
     """
     Check in builds_root for builds not being used by releases.
     """
 
     print('Cleaning builds')
-    if files.exists(BUILDS_ROOT, use_sudo=True):
-        builds_in_use = _get_builds_in_use()
-        all_builds = set(get_builds())
-        unused_builds = all_builds.difference(builds_in_use)
-        for build in unused_builds:
-            delete_build(build)
+    inventory = inventory or get_inventory()
+    unused_builds = set(inventory.builds) - inventory.get_builds_in_use()
+    if unused_builds:
+        # No proc uses these builds, so there's nothing to cascade to.
+        print('Removing {} unused builds: {}'.format(
+            len(unused_builds), unused_builds))
+        sudo('rm -rf ' + ' '.join(
+            posixpath.join(BUILDS_ROOT, build)
+            for build in sorted(unused_builds)))
+
+
+def _rm_images(img_paths):
+    for img_path in img_paths:
+        assert img_path, 'Empty img_path'
+        assert img_path != '/', 'img_path is root!'
+        print('Removing image {}'.format(img_path))
+    # Be careful!
+    sudo('rm -rf {}'.format(' '.join(img_paths)))
 
 
-def _is_image_obsolete(img_path):
-    atime = int(sudo('stat -c "%X" {}'.format(img_path)))
-    now = time.time()
-    return now - atime > MAX_IMAGE_AGE_SECS
+def _get_images_in_use(builds_in_use):
+    images_in_use = set()
+    for app_tag in builds_in_use:
+        try:
+            app_name, tag = app_tag.split('-', 1)
+        except ValueError:
+            print('Invalid app name: {}'.format(app_tag))
+            continue
 
+        try:
+            app = App.objects.get(name=app_name)
+        except App.DoesNotExist:
+            print('Unknown image {}'.format(app_name))
+            continue
 
-def _rm_image(img_path):
-    assert img_path, 'Empty img_path'
-    assert img_path != '/', 'img_path is root!'
-    print('Removing image {}'.format(img_path))
-    # Be careful!
-    sudo('rm -rf {}'.format(img_path))
+        for b in Build.objects.filter(
+                app=app,
+                tag=tag,
+        ):
+            if b.os_image:
+                images_in_use.add(b.os_image.name)
+    return images_in_use
 
 
-def clean_images_folders():
+def clean_images_folders(inventory=None):
     """
     Check in images_root for images not being used by releases.
     """
 
     print('Cleaning images')
     try:
-        if not files.exists(IMAGES_ROOT, use_sudo=True):
+        inventory = inventory or get_inventory()
+        if not inventory.images:
             # Nothing to do
             return
 
-        all_images = set(get_images())
-
-        builds_in_use = _get_builds_in_use()
-        images_in_use = set()
-        for app_tag in builds_in_use:
-            try:
-                app_name, tag = app_tag.split('-', 1)
-            except ValueError:
-                print('Invalid app name: {}'.format(app_tag))
-                continue
-
-            try:
-                app = App.objects.get(name=app_name)
-            except App.DoesNotExist:
-                print('Unknown image {}'.format(app_name))
-                continue
-
-            for b in Build.objects.filter(
-                    app=app,
-                    tag=tag,
-            ):
-                if b.os_image:
-                    images_in_use.add(b.os_image.name)
+        images_in_use = _get_images_in_use(inventory.get_builds_in_use())
 
         # Set of unused images (dirnames wrt IMAGES_ROOT)
-        unused_images = all_images.difference(images_in_use)
+        unused_images = set(inventory.images).difference(images_in_use)
         print('Found {} unused images: {}'.format(
             len(unused_images), unused_images))
 
         # Get the ones that have not been used for a while
-        obsolete_image_paths = set()
-        for img in unused_images:
-            img_path = os.path.join(IMAGES_ROOT, img)
-            if (files.exists(img_path, use_sudo=True) and
-                    _is_image_obsolete(img_path)):
-                obsolete_image_paths.add(img_path)
+        obsolete_image_paths = sorted(
+            os.path.join(IMAGES_ROOT, img)
+            for img in inventory.get_obsolete_images(unused_images))
         print('Found {} obsolete image paths: {}'.format(
             len(obsolete_image_paths), obsolete_image_paths))
 
-        for img_path in obsolete_image_paths:
-            _rm_image(img_path)
+        if obsolete_image_paths:
+            _rm_images(obsolete_image_paths)
 
     except Exception:
         print('Failed to remove images: {}'.format(traceback.format_exc()))
@@ -442,27 +792,32 @@ def _get_procnames_from_output(output):
     return procnames
 
 
-def get_supervised_procnames():
-    """Return a list of procnames under supervisor."""
-    with fab_settings(hide('stdout')):
-        output = supervisorctl('status')
-    return _get_procnames_from_output(output)
-
-
-def get_installed_procnames():
-    """Get a list of procs currently on the file system."""
-    return set(get_procs())
-
-
-def get_old_procnames():
+def get_old_procnames(inventory=None):
     """Get a list of procnames that are on the filesystem, but unknown
     to supervisor."""
-    s_procnames = get_supervised_procnames()
-    i_procnames = get_installed_procnames()
-    return i_procnames - s_procnames
+    return (inventory or get_inventory()).get_old_procnames()
+
+
+def teardown_procs(procnames, inventory):
+    """
+    Like teardown() with the default runner, for several procs at once and
+    in a single remote command.  `inventory` says which procs have a
+    proc.yaml to tear down.  A proc's folder is only removed if its teardown
+    succeeded.
+    """
+    commands = ['status=0']
+    for proc in procnames:
+        proc_dir = posixpath.join(PROCS_ROOT, proc)
+        rm = 'rm -rf ' + proc_dir
+        if proc in inventory.proc_yamls:
+            proc_yaml_path = posixpath.join(proc_dir, 'proc.yaml')
+            rm = 'vrun teardown %s && %s' % (proc_yaml_path, rm)
+        commands.append(rm + ' || status=1')
+    commands.append('exit $status')
+    sudo('; '.join(commands))
 
 
-def teardown_old_procs():
+def teardown_old_procs(inventory=None):
     """
     Teardown old procs. Usually, old procs are removed during the
     swarm phase and replaced with the new proc. But if the swarm
@@ -475,68 +830,39 @@ def teardown_old_procs():
     """
 
     hostname = env.host_string
-    for procname in get_old_procnames():
+    inventory = inventory or get_inventory()
+    if inventory.supervised is None:
+        print('teardown_old_procs: Could not get supervisor status @{}, '
+              'not tearing anything down'.format(hostname))
+        return
+
+    old_procnames = sorted(inventory.get_old_procnames())
+    for procname in old_procnames:
         print('teardown_old_procs: Tearing down {} @{}'.format(
             procname, hostname))
 
-        # Proc settings are always going to be unknown, because they
-        # come from supervisor and this proc is "old" exactly because
-        # it's unknown by supervisor.
-        settings = None
-
-        # try:
-        #     settings = _get_proc_settings(hostname, procname)
-        # except ProcError:
-        #     print(
-        #         'teardown_old_procs: '
-        #         'Failed getting psettings for {} @{}'.format(
-        #             procname, hostname))
-        #     settings = None
-
-        teardown(procname, settings)
-
-
-def get_orphans():
-    with fab_settings(hide('stdout')):
-        output = sudo('ps -C sudo,su -o pid,ppid,command')
-        #   PID   PPID COMMAND
-        #  6676   6667 sudo -u nobody -E -s ...
-        # 18079  18068 sudo -u nobody -E -s ...
-        #  9642  9634  su --preserve-environment ...
-
-    def get_children(pid):
-        with fab_settings(hide('stdout')):
-            output = sudo('ps --ppid {} -o command'.format(pid))
-        return tuple(output.splitlines()[1:])
-
-    orphans = set()
-    for line in output.splitlines()[1:]:
-        tokens = line.split()
-        pid = int(tokens[0])
-        ppid = int(tokens[1])
-        command = ' '.join(tokens[2:]).strip()
-
-        is_vr_command = (
-            command.startswith('sudo -u nobody') or
-            command.startswith('su --preserve-environment'))
-
-        is_child_of_init = ppid == 1
+    # Proc settings are always going to be unknown, because they
+    # come from supervisor and these procs are "old" exactly because
+    # they're unknown by supervisor.  So use the default runner.
+    if old_procnames:
+        teardown_procs(old_procnames, inventory)
 
-        if is_child_of_init and is_vr_command:
-            orphans.add((int(pid), get_children(pid)))
 
-    return orphans
+def get_orphans(inventory=None):
+    return (inventory or get_inventory()).get_orphans()
 
 
-def kill_orphans():
+def kill_orphans(inventory=None):
     """
     Delete orphans procs left behind by LXC crashes leaving orphans behind.
 
     See https://bitbucket.org/yougov/velociraptor/issues/195.
     """
-    for pid, cmds in get_orphans():
+    orphans = sorted(get_orphans(inventory))
+    for pid, cmds in orphans:
         print('kill_orphans: Killing pid={} and children={}'.format(pid, cmds))
-        sudo('kill -9 {}'.format(pid))
+    if orphans:
+        sudo('kill -9 ' + ' '.join(str(pid) for pid, _ in orphans))
 
 
 @task
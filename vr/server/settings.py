@@ -74,6 +74,14 @@ USE_TZ = True
 DEPLOY_USER = 'vagrant'
 DEPLOY_PASSWORD = 'vagrant'
 
+# SSH connections to hosts are kept open and reused between tasks in the same
+# worker process.  Idle connections are closed after SSH_POOL_IDLE_TIMEOUT
+# seconds, and at most SSH_POOL_MAX_PER_HOST idle connections are kept for any
+# one host.  Set SSH_POOL_ENABLED to False to disconnect after every task.
+SSH_POOL_ENABLED = True
+SSH_POOL_MAX_PER_HOST = 4
+SSH_POOL_IDLE_TIMEOUT = 300
+
 MONGODB_URL = 'mongodb://localhost/velociraptor'
 
 CELERY_ENABLE_UTC = True
@@ -100,11 +108,55 @@ EVENTS_PUBSUB_CHANNEL = 'vr2_events'
 EVENTS_BUFFER_KEY = 'vr2_events_buffer'
 EVENTS_BUFFER_LENGTH = 100
 
+# Publish events from a background thread in each process, so tasks and
+# views never wait on Redis for them.  Up to EVENTS_QUEUE_SIZE events wait
+# to be sent, EVENTS_BATCH_SIZE at a time.  When the queue is full, new
+# events are dropped ('drop') or their senders wait for room ('block').
+EVENTS_ASYNC = True
+EVENTS_QUEUE_SIZE = 10000
+EVENTS_BATCH_SIZE = 100
+EVENTS_OVERFLOW = 'drop'
+
+# With EVENTS_TRANSPORT = 'stream', events go on the Redis stream at
+# EVENTS_STREAM_KEY instead of EVENTS_PUBSUB_CHANNEL and EVENTS_BUFFER_KEY,
+# so clients reconnecting with a Last-Event-ID are sent everything they
+# missed.  The stream keeps about EVENTS_STREAM_MAX_LEN events, or if
+# EVENTS_STREAM_MAX_AGE is set, those from the last that many seconds.
+# Needs Redis 5 (6.2 for EVENTS_STREAM_MAX_AGE).
+EVENTS_TRANSPORT = 'pubsub'
+EVENTS_STREAM_KEY = 'vr2_events_stream'
+EVENTS_STREAM_MAX_LEN = 10000
+EVENTS_STREAM_MAX_AGE = None
+
+# Each web process shares one Redis subscription among all its clients'
+# event streams.  A client that falls this many events behind is cut off.
+EVENT_HUB_QUEUE_SIZE = 100
+
+# Seconds of quiet before an event stream is sent a keepalive comment.
+EVENT_HUB_KEEPALIVE = 15
+
+# Proc events about the same proc within this many seconds are sent to event
+# stream clients as just the latest one.  Set to 0 to send them all.
+EVENT_HUB_COALESCE_WINDOW = 1
+
 # Event listener plugins on the application-running hosts should be configured
 # to send proc status messages to this channel on the redis at
 # EVENTS_PUBSUB_URL.
 PROC_EVENTS_CHANNEL = 'proc_events'
 
+# The procs on each host are cached in Redis for this many seconds, so the
+# steps of a swarm don't each ask every host's supervisor.  Cached procs are
+# dropped early when procs are deployed or deleted on their host, and, while
+# celerybeat is running, when a proc event for their host arrives on
+# PROC_EVENTS_CHANNEL.  Set to 0 to disable the cache.
+PROC_CACHE_TTL = 60
+
+# Listing the procs of a whole squad asks up to PROC_LIST_CONCURRENCY hosts at
+# once.  Hosts that take longer than PROC_LIST_HOST_TIMEOUT seconds to answer
+# are reported as unreachable.
+PROC_LIST_CONCURRENCY = 20
+PROC_LIST_HOST_TIMEOUT = 10
+
 CELERYBEAT_SCHEDULE = {
     'filesystem_scooper': {
         'task': 'vr.server.tasks.filesystem_scooper',
@@ -134,6 +186,13 @@ CELERYBEAT_SCHEDULE = {
             'expires': 120,
         },
     },
+    'compact_test_results': {
+        'task': 'vr.server.tasks.compact_test_results',
+        'schedule': crontab(hour=4, minute=0),
+        'options': {
+            'expires': 120,
+        },
+    },
 }
 
 CELERY_ROUTES = {
@@ -142,12 +201,70 @@ CELERY_ROUTES = {
     'vr.server.tasks.uptest_host': {'queue': 'scheduled_uptests'}
 }
 
+# The scooper tasks clean up every active host from a single task, talking to
+# up to SCOOPER_CONCURRENCY hosts at once.  A host that takes longer than
+# SCOOPER_HOST_TIMEOUT seconds is reported as timed out.
+SCOOPER_CONCURRENCY = 20
+SCOOPER_HOST_TIMEOUT = 600
+
+# A host's procs are uptested UPTEST_HOST_CONCURRENCY at a time, each in its
+# own session on the host's one SSH connection, so keep this under sshd's
+# MaxSessions (10 by default).  A proc's uptests that take longer than
+# UPTEST_PROC_TIMEOUT seconds are reported as failed.
+UPTEST_HOST_CONCURRENCY = 4
+UPTEST_PROC_TIMEOUT = 300
+
+# Scheduled uptest runs only test procs that failed last time, or have been
+# restarted or replaced since, plus a random UPTEST_SAMPLE_RATE share of the
+# rest.  Every UPTEST_FULL_SWEEP_INTERVAL seconds a run tests every proc.  Set
+# UPTEST_INCREMENTAL to False to test every proc every time.
+UPTEST_INCREMENTAL = True
+UPTEST_SAMPLE_RATE = 0.1
+UPTEST_FULL_SWEEP_INTERVAL = 24 * 60 * 60
+
+# If UPTEST_RETENTION_DAYS is set to an integer instead of None, then the
+# celerybeat proc will run a task every day that rolls older uptest results up
+# into per-proc daily pass/fail counts and deletes them, and their runs,
+# UPTEST_RETENTION_BATCH_SIZE rows at a time.
+UPTEST_RETENTION_DAYS = 30
+UPTEST_RETENTION_BATCH_SIZE = 1000
+
 SUPERVISOR_PORT = 9001
 SUPERVISOR_USERNAME = 'vagrant'
 SUPERVISOR_PASSWORD = 'vagrant'
+
+# Everyone watching a proc's log from the same web process shares one
+# connection to its host.  New viewers first get the last LOG_TAIL_BACKLOG
+# lines.  A viewer more than LOG_TAIL_QUEUE_SIZE lines behind is cut off.
+LOG_TAIL_BACKLOG = 100
+LOG_TAIL_QUEUE_SIZE = 1000
+LOG_TAIL_CHUNK_SIZE = 4096
+
+# Proc logs are read from supervisor this many bytes at a time when fetching
+# part of a log or searching one through the API.  At most
+# PROC_LOG_WINDOW_MAX_BYTES are returned at once, and searches stop after
+# PROC_LOG_SEARCH_MAX_RESULTS matches.
+PROC_LOG_CHUNK_SIZE = 256 * 1024
+PROC_LOG_WINDOW_MAX_BYTES = 1024 * 1024
+PROC_LOG_SEARCH_MAX_RESULTS = 1000
+
 PORT_RANGE_START = 5000
 PORT_RANGE_END = 6000
 
+# Where to reserve the ports picked for new procs until they're deployed.
+# vr.server.ports.DatabaseReservations keeps PortLock rows, which
+# procs_scooper deletes once they're MAX_AGE_DAYS old.
+# vr.server.ports.RedisReservations keeps them in Redis (at 'URL', or the
+# events Redis), where they expire on their own after 'TTL' seconds.
+PORT_RESERVATIONS = {
+    'BACKEND': 'vr.server.ports.DatabaseReservations',
+    'MAX_AGE_DAYS': 7,
+}
+
+# When a swarm needs several new procs on the same host, deploy them all with
+# one upload and one supervisor update instead of one deploy per proc.
+SWARM_BATCH_DEPLOY = True
+
 # Settings used when writing the proc.conf includes for supervisord
 PROC_USER = 'nobody'
 PROC_SYSLOG = False
@@ -303,6 +420,18 @@ GRIDFS_PORT = mongoparts['nodelist'][0][1]
 GRIDFS_DB = mongoparts['database'] or 'test'
 GRIDFS_COLLECTION = mongoparts['collection'] or 'fs'
 
+# Artifacts are written to GridFS in chunks of this many bytes, hashing them
+# on the way.  An upload that loses its connection to MongoDB is resumed from
+# its last stored chunk up to GRIDFS_UPLOAD_RETRIES times.
+GRIDFS_CHUNK_SIZE = 255 * 1024
+GRIDFS_UPLOAD_RETRIES = 3
+
+# Files served out of GridFS are also kept in this directory on each web
+# host, up to GRIDFS_CACHE_MAX_BYTES of the most recently used ones.  Set to
+# None to always read them from GridFS.
+GRIDFS_CACHE_DIR = None
+GRIDFS_CACHE_MAX_BYTES = 10 * 1024 ** 3
+
 djcelery.setup_loader()
 
 
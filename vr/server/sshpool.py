@@ -0,0 +1,177 @@
+"""
+A per-process pool of SSH connections, so that consecutive remote operations
+against the same host reuse a live Fabric session instead of paying for a
+new handshake and authentication every time.
+"""
+
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import fabric.state
+from django.conf import settings
+
+logger = logging.getLogger('velociraptor.sshpool')
+
+
+def is_healthy(client):
+    """
+    Return True if the paramiko SSHClient `client` still has a usable
+    transport.
+    """
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        # Cheap probe that fails fast if the socket has gone away.
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+class ConnectionPool(object):
+    """
+    Keep idle SSH clients around, keyed by hostname.
+
+    Clients are handed to Fabric by installing them in
+    ``fabric.state.connections`` for the duration of a ``connection()``
+    block, and taken back out again afterwards.  A client that has been idle
+    for longer than `idle_timeout` seconds, or that fails its health check,
+    is closed instead of being reused.  At most `max_per_host` idle clients
+    are kept for any host; surplus ones are closed on release.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=300):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # hostname -> list of (last_used, client), most recently used last.
+        self._idle = collections.defaultdict(list)
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.overflows = 0
+
+    def _check_pid(self):
+        # Sockets inherited across a fork belong to the parent.  Forget them
+        # without closing, so we don't tear down the parent's sessions.
+        if self._pid != os.getpid():
+            self._reset()
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except Exception:
+            logger.exception('Error closing pooled SSH connection')
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        for hostname, idle in list(self._idle.items()):
+            fresh = []
+            for last_used, client in idle:
+                if last_used >= cutoff:
+                    fresh.append((last_used, client))
+                else:
+                    self._close(client)
+                    self.evictions += 1
+            if fresh:
+                self._idle[hostname] = fresh
+            else:
+                del self._idle[hostname]
+
+    def checkout(self, hostname):
+        """
+        Return a healthy idle client for `hostname`, or None if there isn't
+        one and Fabric should connect on its own.
+        """
+        with self._lock:
+            self._check_pid()
+            self._evict_idle()
+            idle = self._idle.get(hostname, [])
+            while idle:
+                _, client = idle.pop()
+                if is_healthy(client):
+                    self.hits += 1
+                    return client
+                self._close(client)
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def checkin(self, hostname, client):
+        """
+        Return `client` to the pool for later reuse.
+        """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle[hostname]
+            if len(idle) >= self.max_per_host:
+                self._close(client)
+                self.overflows += 1
+            else:
+                idle.append((time.time(), client))
+            self._evict_idle()
+
+    @contextlib.contextmanager
+    def connection(self, hostname):
+        """
+        Make a pooled connection to `hostname` available to Fabric for the
+        duration of the block.  Must be used inside a Fabric settings context
+        that sets the user for `hostname`, since Fabric keys its connection
+        cache on user@host:port.
+        """
+        client = self.checkout(hostname)
+        if client is not None:
+            fabric.state.connections[hostname] = client
+        try:
+            yield
+        finally:
+            # Fabric connects lazily, so there's only something to take back
+            # if a command was actually run.
+            if hostname in fabric.state.connections:
+                client = fabric.state.connections[hostname]
+                del fabric.state.connections[hostname]
+                self.checkin(hostname, client)
+            logger.info('SSH pool stats: %s', self.stats())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'overflows': self.overflows,
+                'idle': sum(len(v) for v in self._idle.values()),
+            }
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for _, client in idle:
+                    self._close(client)
+            self._idle.clear()
+
+
+_pool = None
+
+
+def get_pool():
+    """
+    Return this process's connection pool, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            max_per_host=settings.SSH_POOL_MAX_PER_HOST,
+            idle_timeout=settings.SSH_POOL_IDLE_TIMEOUT,
+        )
+    return _pool
@@ -54,6 +54,11 @@ VR.Dash.init = function(
   );
 
   // bind proc event stream to handler
+  if (!procEventsUrl && VR.Dash.Options.dashboardId) {
+    // only get events for the dashboard's apps
+    procEventsUrl = VR.Urls.procEvents + '?dashboard=' +
+      VR.Dash.Options.dashboardId;
+  }
   var procEvents = new EventSource(procEventsUrl || VR.Urls.procEvents);
   procEvents.onmessage = $.proxy(function(e) {
       var parsed = JSON.parse(e.data);
@@ -1,12 +1,250 @@
+import contextlib
+import datetime
+import errno
+import fcntl
+import hashlib
+import itertools
+import os
+import tempfile
+import time
 import urlparse
 import mimetypes
+import re
 
 from django.core.files.storage import Storage, default_storage
 from django import http
 from django.conf import settings
 
 import pymongo
+from bson.binary import Binary
+from bson.objectid import ObjectId
 from gridfs import GridFS, NoFile
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+
+
+# Bytes read from GridFS at a time while streaming a file out.
+CHUNK_SIZE = 256 * 1024
+
+# Seconds between attempts to take the lock on a file being cached.
+LOCK_POLL_INTERVAL = 0.1
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+    Hold an exclusive lock on the file at `path`, removing it afterward.
+    """
+    fd = os.open(path, os.O_CREAT | os.O_RDWR)
+    try:
+        while True:
+            # Don't block: under gevent that would stall the whole process,
+            # including whoever holds the lock.
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            time.sleep(LOCK_POLL_INTERVAL)
+        yield
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    finally:
+        os.close(fd)
+
+
+class DiskCache(object):
+    """
+    A local copy of GridFS files in `directory`, each named for the file's
+    name and md5, so a new version of a file never gets served the old one.
+    Least recently used files are deleted when there are more than
+    `max_bytes` of them.
+
+    A file is copied in under a temporary name and renamed into place once
+    complete.  A lock file makes concurrent requests for the same file, from
+    any process, wait for one copy rather than all read it from GridFS.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, name, md5):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '%s-%s' % (digest, md5))
+
+    def fetch(self, f):
+        """
+        Return the path of the local copy of the GridFS file `f`, copying it
+        first if needed.
+        """
+        path = self.path(f.name, f.md5)
+        if self._touch(path):
+            return path
+
+        with _file_lock(path + '.lock'):
+            # Someone else may have copied it while we waited.
+            if self._touch(path):
+                return path
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        out.write(chunk)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+        self.evict(keep=path)
+        return path
+
+    @staticmethod
+    def _touch(path):
+        """
+        Mark `path` as just used.  Return False if it's not there.
+        """
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used files until there are no more than
+        max_bytes left, except for `keep`.
+        """
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.startswith('.') or filename.endswith('.lock'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class ChunkedUpload(object):
+    """
+    A file being written into the GridFSStorage `storage` as `name`, a chunk
+    at a time, working out its md5 and length on the way.  Neither the whole
+    file nor a second read of it is needed.
+
+    Chunks are stored as they fill, and the file only shows up in GridFS
+    once `finish` is called.  An upload that fails part way can be
+    `resume`d after the last chunk stored, or `abort`ed to delete its
+    chunks.
+    """
+
+    def __init__(self, storage, name, chunk_size=None):
+        self.files = storage.db[storage.collection].files
+        self.chunks = storage.db[storage.collection].chunks
+        self.name = name
+        self.chunk_size = chunk_size or storage.chunk_size
+        self.file_id = ObjectId()
+        self._reset()
+
+    def _reset(self):
+        self._md5 = hashlib.md5()
+        self._buffer = b''
+        self.length = 0
+        self.n = 0
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def write(self, data):
+        self._md5.update(data)
+        self.length += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._put(self._buffer[:self.chunk_size])
+            self._buffer = self._buffer[self.chunk_size:]
+
+    def _put(self, data):
+        self.chunks.insert({
+            'files_id': self.file_id,
+            'n': self.n,
+            'data': Binary(data),
+        })
+        self.n += 1
+
+    def copy(self, fileobj):
+        """
+        Write the rest of `fileobj`.
+        """
+        for data in iter(lambda: fileobj.read(self.chunk_size), b''):
+            self.write(data)
+
+    def resume(self, fileobj):
+        """
+        Carry on from `fileobj`, the source of the upload read again from
+        the start, after the chunks stored already.
+        """
+        self._reset()
+        last = list(self.chunks.find({'files_id': self.file_id}, ['n'])
+                    .sort('n', -1).limit(1))
+        stored = last[0]['n'] + 1 if last else 0
+        # The stored chunks still have to be hashed, but from the source.
+        remaining = stored * self.chunk_size
+        while remaining > 0:
+            data = fileobj.read(min(self.chunk_size, remaining))
+            if not data:
+                break
+            self._md5.update(data)
+            self.length += len(data)
+            remaining -= len(data)
+        self.n = stored
+        self.copy(fileobj)
+
+    def finish(self):
+        """
+        Store the last, short chunk, and then the file itself.
+        """
+        if self._buffer:
+            self._put(self._buffer)
+            self._buffer = b''
+        try:
+            self.files.insert({
+                '_id': self.file_id,
+                'filename': self.name,
+                'length': self.length,
+                'chunkSize': self.chunk_size,
+                'uploadDate': datetime.datetime.utcnow(),
+                'md5': self.md5,
+            })
+        except DuplicateKeyError:
+            # Stored by an attempt that lost its connection before hearing
+            # back.
+            pass
+
+    def abort(self):
+        self.chunks.remove({'files_id': self.file_id})
 
 
 class GridFSStorage(Storage):
@@ -33,13 +271,55 @@ class GridFSStorage(Storage):
         collection = collection or getattr(settings, 'GRIDFS_COLLECTION', 'fs')
 
         self.db = connection[db]
+        self.collection = collection
         self.fs = GridFS(self.db, collection=collection)
 
+        # Files are uploaded in chunks of this many bytes, GridFS's own
+        # default.  Uploads that lose their connection are resumed this many
+        # times before giving up.
+        self.chunk_size = getattr(settings, 'GRIDFS_CHUNK_SIZE', 255 * 1024)
+        self.upload_retries = getattr(settings, 'GRIDFS_UPLOAD_RETRIES', 3)
+
         self.base_url = base_url or settings.MEDIA_URL
 
+        # Files served are cached on local disk if there's a directory for
+        # them.
+        cache_dir = getattr(settings, 'GRIDFS_CACHE_DIR', None)
+        self.cache = None
+        if cache_dir:
+            self.cache = DiskCache(
+                cache_dir,
+                getattr(settings, 'GRIDFS_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+
     def _save(self, name, content):
-        self.fs.put(content, filename=name)
-        return name
+        return self.upload(name, content).name
+
+    def upload(self, name, content, chunk_size=None):
+        """
+        Write the file object `content` into GridFS as `name` through a
+        ChunkedUpload, and return the finished upload, with its md5 and
+        length.  An upload that loses its connection to MongoDB is resumed,
+        reading `content` again from the start; one that fails otherwise, or
+        too often, is aborted.
+        """
+        upload = ChunkedUpload(self, name, chunk_size)
+        for attempt in itertools.count():
+            try:
+                if attempt:
+                    content.seek(0)
+                    upload.resume(content)
+                else:
+                    upload.copy(content)
+                upload.finish()
+                return upload
+            except ConnectionFailure:
+                if attempt < self.upload_retries:
+                    continue
+                upload.abort()
+                raise
+            except Exception:
+                upload.abort()
+                raise
 
     def _open(self, name, *args, **kwars):
         return self.fs.get_last_version(filename=name)
@@ -72,21 +352,125 @@ class GridFSStorage(Storage):
         return name
 
 
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _etag_matches(header, etag):
+    """
+    Return whether an If-None-Match or If-Range header matches `etag`.
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or any(
+        tag.replace('W/', '', 1).strip('"') == etag for tag in tags)
+
+
+def parse_range(header, length):
+    """
+    Return the (start, end) of the byte range in a Range header, with `end`
+    exclusive and clipped to a file of `length` bytes.
+
+    Return None if the header should be ignored, because it can't be parsed
+    or asks for several ranges, and raise ValueError if the range can't be
+    satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # The last `end` bytes.
+        if int(end) == 0:
+            raise ValueError(header)
+        return max(0, length - int(end)), length
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= length:
+        raise ValueError(header)
+    return start, min(int(end) + 1, length) if end else length
+
+
+def _read(f, start, end):
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
 def serve_file(request, path):
     """
     A Django view for serving files out of GridFS.  Assumes that the
     GridFSStorage class above has been set as the default storage backend.
+
+    Files are streamed out a chunk at a time, from the storage's local
+    DiskCache if it has one.  Single byte Range requests (with If-Range) are
+    honored, as is If-None-Match against the file's md5, and HEAD requests
+    don't read the file at all.
     """
     try:
         f = default_storage.open(path)
     except NoFile:
         return http.HttpResponseNotFound()
-    resp = http.HttpResponse()
-    if request.method == 'GET':
-        resp.content = f
 
-    resp['Etag'] = f.md5
-    resp['Content-Length'] = f.length
+    etag = f.md5
+    if etag and _etag_matches(request.META.get('HTTP_IF_NONE_MATCH', ''),
+                              etag):
+        f.close()
+        resp = http.HttpResponseNotModified()
+        resp['ETag'] = '"%s"' % etag
+        return resp
+
+    start, end = 0, f.length
+    status = 200
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (
+            not if_range or (etag and _etag_matches(if_range, etag))):
+        try:
+            byte_range = parse_range(range_header, f.length)
+        except ValueError:
+            f.close()
+            resp = http.HttpResponse(status=416)
+            resp['Content-Range'] = 'bytes */%d' % f.length
+            return resp
+        if byte_range:
+            start, end = byte_range
+            status = 206
+
+    cache = getattr(default_storage, 'cache', None)
+    if request.method == 'HEAD':
+        f.close()
+        resp = http.HttpResponse(status=status)
+    elif cache is not None and etag:
+        local = open(cache.fetch(f), 'rb')
+        f.close()
+        if status == 200:
+            # Lets the WSGI server use sendfile.
+            resp = http.FileResponse(local)
+        else:
+            resp = http.StreamingHttpResponse(
+                _read(local, start, end), status=status)
+    else:
+        resp = http.StreamingHttpResponse(_read(f, start, end), status=status)
+
+    if status == 206:
+        resp['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, f.length)
+    resp['Content-Length'] = end - start
+    resp['Accept-Ranges'] = 'bytes'
+    if etag:
+        resp['ETag'] = '"%s"' % etag
+    # Keep GZipMiddleware off, so ranges and lengths stay true (and builds
+    # and images are compressed already).
+    resp['Content-Encoding'] = 'identity'
 
     resp['Content-Type'] = (
         f.content_type
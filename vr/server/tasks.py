@@ -16,9 +16,11 @@ import yaml
 import fabric.network
 import fabric.state
 import redis
+from celery.signals import beat_init, worker_process_shutdown
 from celery.task import subtask, chord, task
 from fabric.context_managers import settings as fab_settings
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.core.files import File
 from django.core.files.base import ContentFile
@@ -29,30 +31,40 @@ from vr.common import utils
 from vr.common.models import Proc
 from vr.common.utils import tmpdir
 from vr.server.utils import build_swarm_trace_id
-from vr.server import events, balancer, remote
-from vr.server.models import (Release, Build, Swarm, Host, PortLock, TestRun,
-                              TestResult, BuildPack, OSImage)
+from vr.server import (
+    events, balancer, remote, sshpool, fanout, hostprocs, uptests)
+from vr.server.ports import (
+    allocate_ports, release_ports, expire_reservations, get_backend)
+from vr.server.models import (Release, Build, Swarm, Host, TestRun,
+                              TestResult, TestResultRollup, BuildPack,
+                              OSImage)
 
 MAX_EVENT_MESSAGE_LEN = 10000
-PORTLOCK_MAX_AGE_DAYS = 7
 
 logger = logging.getLogger('velociraptor.tasks')
 
 
+@worker_process_shutdown.connect
+def flush_events(**kwargs):
+    # Pool processes exit without running atexit handlers, which would
+    # otherwise send the events still queued.
+    events.flush()
+
+
+@beat_init.connect
+def start_proc_cache_listener(**kwargs):
+    # There's one celerybeat process, so its listener keeps the shared proc
+    # cache fresh for every worker and web process.
+    if settings.PROC_CACHE_TTL:
+        hostprocs.start_listener()
+
+
 class MissingLogError(Exception):
     """Raised when some mandatory log is missing."""
 
 
 def send_event(title, msg, tags=None, **kw):
     logger.info(msg)
-    # Create and discard connections when needed.  More robust than trying to
-    # hold them open for a long time.
-    sender = events.EventSender(
-        settings.EVENTS_PUBSUB_URL,
-        settings.EVENTS_PUBSUB_CHANNEL,
-        settings.EVENTS_BUFFER_KEY,
-        settings.EVENTS_BUFFER_LENGTH,
-    )
 
     def _trim(msg):
         if not isinstance(msg, six.string_types):
@@ -64,8 +76,7 @@ def send_event(title, msg, tags=None, **kw):
         sep = '\n\n...<snip>...\n\n'
         return msg[:n] + sep + msg[-n:]
 
-    sender.publish(_trim(msg), title=title, tags=tags, **kw)
-    sender.close()
+    events.publish(_trim(msg), title=title, tags=tags, **kw)
 
 
 def send_debug_event(title, msg=''):
@@ -187,8 +198,57 @@ def deploy(release_id, config_name, hostname, proc, port, swarm_trace_id=None):
                 f.write(yaml.safe_dump(info, default_flow_style=False))
 
             with remote_settings(hostname):
-                with always_disconnect(hostname):
-                    remote.deploy_proc('proc.yaml')
+                with pooled_connection(hostname):
+                    try:
+                        remote.deploy_proc('proc.yaml')
+                    finally:
+                        hostprocs.invalidate(hostname)
+
+
+@task
+@event_on_exception(['deploy'])
+def deploy_batch(release_id, config_name, hostname, proc, ports,
+                 swarm_trace_id=None):
+    """
+    Deploy one instance of a release's proc to a host for each of the given
+    ports, with a single upload and a single supervisor update.
+    """
+    try:
+        release = Release.objects.get(id=release_id)
+        logger.info(
+            '[%s] Deploy %s-%s-%s to %s',
+            swarm_trace_id, release, proc, ports, hostname)
+
+        msg_title = '%s-%s-%s' % (
+            release.build.app.name, release.build.tag, proc)
+        msg = 'deploying %s-%s-%s to %s' % (
+            release, proc, ','.join(str(p) for p in ports), hostname)
+        send_event(title=msg_title, msg=msg, tags=['deploy'],
+                   swarm_id=swarm_trace_id)
+
+        assert release.build.file, "Build %s has no file" % release.build
+        assert release.hash, "Release %s has not been hashed" % release
+
+        with tmpdir():
+
+            # write a proc.yaml locally for each port
+            paths = []
+            for port in ports:
+                path = 'proc-%s.yaml' % port
+                with open(path, 'wb') as f:
+                    info = build_proc_info(
+                        release, config_name, hostname, proc, port)
+                    f.write(yaml.safe_dump(info, default_flow_style=False))
+                paths.append(path)
+
+            with remote_settings(hostname):
+                with pooled_connection(hostname):
+                    try:
+                        remote.deploy_procs(paths)
+                    finally:
+                        hostprocs.invalidate(hostname)
+    finally:
+        release_ports(hostname, ports)
 
 
 @task
@@ -242,7 +302,8 @@ def build_image(image_id, callback=None):
             img_file = image.name + '.tar.gz'
             img_storage_path = 'images/' + img_file
             with open(img_file, 'rb') as localfile:
-                image.file.save(img_storage_path, File(localfile))
+                upload = _upload(image.file, img_storage_path, localfile)
+            image.file_md5 = upload.md5
 
             image.active = True
         finally:
@@ -268,6 +329,19 @@ def build_image(image_id, callback=None):
         subtask(callback).delay()
 
 
+def _upload(fieldfile, name, localfile):
+    """
+    Stream `localfile` into storage as the file of `fieldfile`, a model's
+    FileField, without saving the model, and return the finished upload with
+    the file's md5.
+    """
+    field = fieldfile.field
+    name = field.generate_filename(fieldfile.instance, name)
+    upload = fieldfile.storage.upload(name, localfile)
+    setattr(fieldfile.instance, field.name, upload.name)
+    return upload
+
+
 def _do_build(build, build_yaml):
     t0 = time.time()
     # enter a temp folder
@@ -292,7 +366,7 @@ def _do_build(build, build_yaml):
             filepath = 'builds/' + build_name + '.tar.gz'
             logger.info('Saving tarball')
             with open('build.tar.gz', 'rb') as localfile:
-                build.file.save(filepath, File(localfile))
+                _upload(build.file, filepath, localfile)
 
             logger.info('Saving build metadata')
             build.file_md5 = build_result.build_md5
@@ -407,8 +481,11 @@ def delete_proc(host, proc, callback=None, swarm_trace_id=None, retry=0):
 
     try:
         with remote_settings(host):
-            with always_disconnect(host):
-                remote.delete_proc(host, proc)
+            with pooled_connection(host):
+                try:
+                    remote.delete_proc(host, proc)
+                finally:
+                    hostprocs.invalidate(host)
 
         send_event(Proc.name_to_shortname(proc),
                    'deleted %s on %s' % (proc, host),
@@ -535,6 +612,21 @@ def swarm_start(swarm_id, swarm_trace_id=None):
         build_app.delay(build.id, callback, swarm_trace_id)
 
 
+def _abort_if_unreachable(swarm, index, swarm_trace_id):
+    """
+    Send an event and return True if some of the swarm's squad couldn't be
+    asked for their procs, as counting and placing procs without them would
+    go wrong.
+    """
+    if not index.unreachable:
+        return False
+    msg = 'Could not list the procs on %s for swarm %s' % (
+        ', '.join(sorted(index.unreachable)), swarm)
+    send_event('Swarm %s aborted' % swarm, msg,
+               tags=['failed'], swarm_id=swarm_trace_id)
+    return True
+
+
 # This task should only be used as a callback after swarm_start
 @task
 @event_on_exception(['swarm'])
@@ -563,26 +655,29 @@ def swarm_release(swarm_id, swarm_trace_id=None):
 
     # OK we have a release.  Next: see if we need to do a deployment.
     # Query squad for list of procs.
-    all_procs = swarm.get_procs()
-    current_procs = [p for p in all_procs if p.hash == swarm.release.hash]
+    index = swarm.get_proc_index(check_cache=True)
+    if _abort_if_unreachable(swarm, index, swarm_trace_id):
+        return
+    current_procs = index.current(swarm)
 
     procs_needed = swarm.size - len(current_procs)
 
     if procs_needed > 0:
-        hosts = swarm.get_prioritized_hosts()
+        hosts = swarm.get_prioritized_hosts(index)
         hostcount = len(hosts)
 
-        # Build up a dictionary where the keys are hostnames, and the
-        # values are lists of ports.
-        new_procs_by_host = defaultdict(list)
+        # Work out how many new procs go on each host.
+        counts = defaultdict(int)
         for x in range(procs_needed):
-            host = hosts[x % hostcount]
-            port = host.get_free_port()
-            new_procs_by_host[host.name].append(port)
+            counts[hosts[x % hostcount]] += 1
 
-            # Ports need to be locked here in the synchronous loop, before
-            # fanning out the async subtasks, in order to prevent collisions.
-            lock_port(host, port)
+        # Build up a dictionary where the keys are hostnames, and the
+        # values are lists of ports.  Ports need to be locked here, before
+        # fanning out the async subtasks, in order to prevent collisions.
+        new_procs_by_host = {}
+        for host, count in counts.items():
+            new_procs_by_host[host.name] = allocate_ports(
+                host, count, used_ports=index.ports(host.name))
 
         # Now loop over the hosts and fan out a task to each that needs it.
         subtasks = []
@@ -603,7 +698,7 @@ def swarm_release(swarm_id, swarm_trace_id=None):
 
         # reverse prioritized list so the most loaded hosts get things removed
         # first.
-        hosts = swarm.get_prioritized_hosts()
+        hosts = swarm.get_prioritized_hosts(index)
         hosts.reverse()
         hostcount = len(hosts)
         subtasks = []
@@ -640,15 +735,25 @@ def swarm_deploy_to_host(swarm_id, host_id, ports, swarm_trace_id=None):
     logger.info(
         "[%s] Swarm %s deploy to host %s",
         swarm_trace_id, swarm_id, host.name)
-    for port in ports:
-        deploy(
+    if settings.SWARM_BATCH_DEPLOY and len(ports) > 1:
+        deploy_batch(
             swarm.release.id,
             swarm.config_name,
             host.name,
             swarm.proc_name,
-            port,
+            ports,
             swarm_trace_id,
         )
+    else:
+        for port in ports:
+            deploy(
+                swarm.release.id,
+                swarm.config_name,
+                host.name,
+                swarm.proc_name,
+                port,
+                swarm_trace_id,
+            )
 
     procnames = ["%s-%s-%s" % (swarm.release, swarm.proc_name, port) for port
                  in ports]
@@ -677,8 +782,7 @@ def swarm_assign_uptests(swarm_id, swarm_trace_id=None):
     logger.info("[%s] Swarm %s uptests", swarm_trace_id, swarm_id)
 
     swarm = Swarm.objects.get(id=swarm_id)
-    all_procs = swarm.get_procs()
-    current_procs = [p for p in all_procs if p.hash == swarm.release.hash]
+    current_procs = swarm.get_proc_index(check_cache=True).current(swarm)
 
     # Organize procs by host
     host_procs = defaultdict(list)
@@ -700,48 +804,70 @@ def swarm_assign_uptests(swarm_id, swarm_trace_id=None):
 
 @task
 def uptest_host_procs(hostname, procs, ignore_missing_procs=False):
+    """
+    Run the uptests of `procs`, Procs or proc names, on `hostname`,
+    UPTEST_HOST_CONCURRENCY procs at a time over one SSH connection, and
+    return the hostname and a dict of each proc's results.
+    """
+    def uptest(procname):
+        with remote_settings(hostname):
+            return remote.run_uptest(commands[procname])
+
     with remote_settings(hostname):
-        with always_disconnect(hostname):
-            results = {
-                p: remote.run_uptests(
-                    hostname, p, settings.PROC_USER, ignore_missing_procs)
-                for p in procs
-            }
+        with pooled_connection(hostname):
+            commands, results = remote.find_uptests(
+                hostname, procs, settings.PROC_USER, ignore_missing_procs)
+            report = fanout.run(
+                uptest,
+                commands,
+                concurrency=settings.UPTEST_HOST_CONCURRENCY,
+                timeout=settings.UPTEST_PROC_TIMEOUT,
+            )
+
+    results.update(report.results)
+    for procname, error in report.errors.items():
+        results[procname] = [{'Name': None, 'Output': error, 'Passed': False}]
+    for procname in report.timeouts:
+        results[procname] = [{
+            'Name': None,
+            'Output': 'Uptests timed out after %s seconds' % (
+                settings.UPTEST_PROC_TIMEOUT),
+            'Passed': False,
+        }]
     return hostname, results
 
 
 @task
-def uptest_host(hostname, test_run_id=None, ignore_missing_procs=False):
+def uptest_host(hostname, test_run_id=None, ignore_missing_procs=False,
+                incremental=False):
     """
     Given a hostname, look up all its procs and then run uptests on them.
+    With incremental=True, only the procs that uptests.due() picks are
+    tested.
     """
 
     print('Uptest host {} run_id={}'.format(hostname, test_run_id))
     host = Host.objects.get(name=hostname)
     procs = host.get_procs()
-    _, results = uptest_host_procs(
-        hostname, [p.name for p in procs], ignore_missing_procs)
+    tested = procs
+    if settings.UPTEST_INCREMENTAL:
+        by_name = dict((p.name, p) for p in procs)
+        tested = [by_name[name] for name in
+                  uptests.due(hostname, procs, full=not incremental)]
+        print('Skipping {} of {} procs on host {}'.format(
+            len(procs) - len(tested), len(procs), hostname))
+    # Pass the procs we already have, so they aren't listed again.
+    _, results = uptest_host_procs(hostname, tested, ignore_missing_procs)
+    if settings.UPTEST_INCREMENTAL:
+        uptests.record(hostname, procs, results)
 
     if test_run_id:
-        run = TestRun.objects.get(id=test_run_id)
-        for procname, resultlist in results.items():
-            testcount = len(resultlist)
-            if testcount:
-                passed = all(r['Passed'] for r in resultlist)
-            else:
-                # There were no tests :(
-                passed = True
-
-            tr = TestResult(
-                run=run,
-                time=timezone.now(),
-                hostname=hostname,
-                procname=procname,
-                passed=passed,
-                testcount=testcount,
-                results=yaml.safe_dump(resultlist)
-            )
-            tr.save()
+        now = timezone.now()
+        TestResult.objects.bulk_create([
+            TestResult.from_results(
+                test_run_id, hostname, procname, resultlist, now)
+            for procname, resultlist in results.items()
+        ])
     return hostname, results
 
 
@@ -852,9 +978,11 @@ def swarm_cleanup(swarm_id, swarm_trace_id):
     logger.info("[%s] Swarm %s cleanup", swarm_trace_id, swarm_id)
 
     swarm = Swarm.objects.get(id=swarm_id)
-    all_procs = swarm.get_procs()
-    current_procs = [p for p in all_procs if p.hash == swarm.release.hash]
-    stale_procs = [p for p in all_procs if p.hash != swarm.release.hash]
+    index = swarm.get_proc_index(check_cache=True)
+    if _abort_if_unreachable(swarm, index, swarm_trace_id):
+        return
+    current_procs = index.current(swarm)
+    stale_procs = index.stale(swarm)
 
     delete_subtasks = []
 
@@ -926,12 +1054,18 @@ def uptest_all_procs():
         # Create a test run record.
         run = TestRun(start=timezone.now())
         run.save()
-        print('Running test run_id={}'.format(run.id))
+        # Most runs only test the procs that failed or changed since the
+        # last, but every so often one tests them all.
+        incremental = (settings.UPTEST_INCREMENTAL and
+                       not uptests.start_full_sweep())
+        print('Running test run_id={} incremental={}'.format(
+            run.id, incremental))
 
         def make_test_task(host):
             print('Creating test task for host={} run_id={}'.format(
                 host.name, run.id))
-            return uptest_host.subtask((host.name, run.id, True), expires=1800)
+            return uptest_host.subtask(
+                (host.name, run.id, True, incremental), expires=1800)
         chord((make_test_task(h) for h in hosts))(
             post_uptest_all_procs.subtask((run.id,)))
 
@@ -942,9 +1076,11 @@ def uptest_all_procs():
 @task
 def post_uptest_all_procs(_results, test_run_id):
     print('Post uptest all procs')
-    # record test run end time
+    # record test run end time, and its counts so they needn't be counted
+    # again
     run = TestRun.objects.get(id=test_run_id)
     run.end = timezone.now()
+    run.update_counts()
     run.save()
 
     if run.has_failures():
@@ -968,9 +1104,10 @@ def _clean_host_filesystem(hostname):
     '''Clean builds and images from this host's filesystem.'''
     logger.info('Cleaning host %s filesystem', hostname)
     with remote_settings(hostname):
-        with always_disconnect(hostname):
-            remote.clean_builds_folders()
-            remote.clean_images_folders()
+        with pooled_connection(hostname):
+            inventory = remote.get_inventory()
+            remote.clean_builds_folders(inventory)
+            remote.clean_images_folders(inventory)
 
 
 @task
@@ -978,29 +1115,50 @@ def _clean_host_procs(hostname):
     '''Clean lingering procs from this host.'''
     logger.info('Cleaning host %s procs', hostname)
     with remote_settings(hostname):
-        with always_disconnect(hostname):
-            remote.teardown_old_procs()
-            remote.kill_orphans()
+        with pooled_connection(hostname):
+            inventory = remote.get_inventory()
+            remote.teardown_old_procs(inventory)
+            remote.kill_orphans(inventory)
+
+
+def _scoop_hosts(clean_host, description):
+    """
+    Run `clean_host` against every active host at once, rather than queueing
+    a task per host.  Return the fan-out report as a dict.
+    """
+    hostnames = Host.objects.filter(active=True).values_list('name', flat=True)
+    report = fanout.run(
+        clean_host,
+        hostnames,
+        concurrency=settings.SCOOPER_CONCURRENCY,
+        timeout=settings.SCOOPER_HOST_TIMEOUT,
+    )
+    logger.info('Cleaned up hosts %s: %s', description, report.summary())
+    if report.failed:
+        lines = ['%s: timed out' % h for h in report.timeouts]
+        lines.extend(
+            '%s:\n%s' % item for item in sorted(report.errors.items()))
+        send_event('scooper failed to clean %s' % description,
+                   '\n'.join(lines), tags=['scooper', 'failed'])
+    return report.as_dict()
 
 
 @task
 def filesystem_scooper():
     '''Clean all hosts' filesystem.'''
     logger.info('Cleaning up hosts filesystem')
-    for host in Host.objects.filter(active=True):
-        _clean_host_filesystem.apply_async((host.name,), expires=1800)
+    return _scoop_hosts(_clean_host_filesystem, 'filesystem')
 
 
 @task
 def procs_scooper():
     '''Clean all hosts' procs.'''
     logger.info('Cleaning up hosts procs')
-    for host in Host.objects.filter(active=True):
-        _clean_host_procs.apply_async((host.name,), expires=1800)
+    report = _scoop_hosts(_clean_host_procs, 'procs')
 
-    logger.info('Free up old port locks')
-    dt = timezone.now() - datetime.timedelta(days=PORTLOCK_MAX_AGE_DAYS)
-    PortLock.objects.filter(created_time__lt=dt).delete()
+    logger.info('Free up old port reservations')
+    expire_reservations()
+    return report
 
 
 @task
@@ -1051,6 +1209,45 @@ def clean_old_builds():
             build.save()
 
 
+@task
+def compact_test_results():
+    '''Roll up and delete old uptest results.
+
+    Results older than UPTEST_RETENTION_DAYS are added to their procs' daily
+    TestResultRollups and deleted, UPTEST_RETENTION_BATCH_SIZE at a time and
+    each batch in its own transaction, so no table stays locked for long.
+    Runs left without results are deleted too.
+    '''
+    if settings.UPTEST_RETENTION_DAYS is None:
+        return
+
+    logger.info('Compacting old uptest results')
+    cutoff = (timezone.now() -
+              datetime.timedelta(days=settings.UPTEST_RETENTION_DAYS))
+    batch_size = settings.UPTEST_RETENTION_BATCH_SIZE
+
+    old_results = TestResult.objects.filter(time__lt=cutoff).order_by('id')
+    while True:
+        with transaction.atomic():
+            # Locking the batch keeps overlapping runs from counting it twice.
+            batch = list(old_results.select_for_update().values(
+                'id', 'time', 'hostname', 'procname', 'passed',
+                'testcount')[:batch_size])
+            if not batch:
+                break
+            TestResultRollup.roll_up(batch)
+            TestResult.objects.filter(
+                id__in=[result['id'] for result in batch]).delete()
+        logger.info('Compacted %s uptest results', len(batch))
+
+    old_runs = TestRun.objects.filter(start__lt=cutoff, tests__isnull=True)
+    while True:
+        ids = list(old_runs.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        TestRun.objects.filter(id__in=ids).delete()
+
+
 def remote_settings(hostname):
     '''Context manager to set Fabric env suitably for remote calls.'''
     return fab_settings(
@@ -1061,6 +1258,16 @@ def remote_settings(hostname):
         linewise=True)
 
 
+def pooled_connection(hostname):
+    '''Context manager to reuse a pooled SSH connection to `hostname`.
+
+    Falls back to disconnecting at the end when SSH_POOL_ENABLED is off.
+    '''
+    if not settings.SSH_POOL_ENABLED:
+        return always_disconnect(hostname)
+    return sshpool.get_pool().connection(hostname)
+
+
 @contextlib.contextmanager
 def always_disconnect(host=None):
     """Disconnect from `host`. If `host` is None, disconnect from all hosts.
@@ -1098,30 +1305,20 @@ class tmpredis(object):
 
 
 def lock_port(host, port):
-    '''Acquire a PortLock on (host, port).
+    '''Reserve (host, port).
 
     `host` can either be a hostname or a db obj.
     '''
     logger.info('Acquiring port lock %s:%s', host, port)
-    if isinstance(host, six.string_types):
-        host = Host.objects.get(name=host)
-    pl = PortLock(host=host, port=port)
-    pl.save()
+    get_backend().reserve(host, [port])
 
 
 def unlock_port(host, port):
-    '''Release the PortLock on (host, port).
+    '''Release the reservation on (host, port).
 
     `host` can either be a hostname or a db obj.
     '''
-    logger.info('Releasing port lock %s:%s', host, port)
-    if isinstance(host, six.string_types):
-        host = Host.objects.get(name=host)
-    try:
-        lock = PortLock.objects.get(host=host, port=int(port))
-        lock.delete()
-    except PortLock.DoesNotExist:
-        pass
+    release_ports(host, [port])
 
 
 @contextlib.contextmanager
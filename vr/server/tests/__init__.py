@@ -47,3 +47,25 @@ def get_user():
     u.is_staff = True
     u.save()
     return u
+
+
+def make_proc_info(name):
+    """
+    Return a dict like the ones supervisor's getAllProcessInfo returns.
+    """
+    return {
+        'name': name,
+        'group': name,
+        'description': 'pid 1234, uptime 1 day, 2:03:04',
+        'exitstatus': 0,
+        'logfile': '/var/log/supervisor/%s.log' % name,
+        'stdout_logfile': '/var/log/supervisor/%s.log' % name,
+        'stderr_logfile': '',
+        'now': 1500000000,
+        'start': 1499990000,
+        'stop': 0,
+        'pid': 1234,
+        'spawnerr': '',
+        'state': 20,
+        'statename': 'RUNNING',
+    }
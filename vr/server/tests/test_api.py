@@ -1,13 +1,15 @@
 import base64
 import json
+from unittest.mock import patch
 
 import pytest
+import requests
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 
 from vr.common.utils import randchars
 from vr.server.tests import get_user
-from vr.server import models
+from vr.server import models, hostprocs, logtail
 
 
 def get_api_url(resource_name, view_name, **kwargs):
@@ -53,6 +55,17 @@ def test_basic_auth_bad_password(postgresql):
     assert response.status_code == 401
 
 
+@patch.object(logtail, 'tail')
+def test_proc_log_stream_connect_error(tail, postgresql):
+    tail.side_effect = requests.ConnectionError('Connection refused')
+    u = get_user()
+    c = BasicAuthClient(u.username, 'password123')
+    url = reverse('api_proc_log', kwargs={
+        'hostname': 'host1', 'procname': 'app-v1-prod-abc123-web-5000'})
+    response = c.get(url, HTTP_ACCEPT='text/event-stream')
+    assert response.status_code == 502
+
+
 def test_session_auth_accepted(postgresql):
     u = get_user()
     c = Client()
@@ -163,6 +176,28 @@ class TestSaveSwarms:
         saved = models.Swarm.objects.get(id=self.swarm.id)
         assert saved.config_name == 'test_config_name'
 
+    @patch.object(models.Swarm, 'get_procs_and_unreachable')
+    @patch.object(hostprocs, 'get_swarm_procs')
+    def test_list_gets_procs_in_bulk(self, get_swarm_procs, get_procs):
+        get_swarm_procs.side_effect = lambda swarms: [([], [])] * len(swarms)
+        url = get_api_url('swarms', 'api_dispatch_list')
+        resp = self.client.get(url)
+        doc = json.loads(resp.content)
+        assert get_swarm_procs.call_count == 1
+        assert not get_procs.called
+        for swarm in doc['objects']:
+            assert swarm['procs'] == []
+            assert swarm['unreachable_hosts'] == []
+
+    @patch.object(hostprocs, 'get_swarm_procs')
+    def test_list_without_procs(self, get_swarm_procs):
+        url = get_api_url('swarms', 'api_dispatch_list')
+        resp = self.client.get(url, {'procs': '0'})
+        doc = json.loads(resp.content)
+        assert not get_swarm_procs.called
+        assert doc['objects']
+        assert all('procs' not in swarm for swarm in doc['objects'])
+
     def test_release(self, redis):
         u = get_user()
         c = BasicAuthClient(u.username, 'password123')
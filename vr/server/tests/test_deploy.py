@@ -1,8 +1,12 @@
+import tarfile
+from unittest import mock
+
 import pytest
 import yaml
 from django.utils import timezone
 
 
+from vr.server import remote
 from vr.server.models import App, Build, Release
 from vr.server.tasks import build_proc_info
 from vr.common.utils import randchars, tmpdir
@@ -60,3 +64,74 @@ class TestDeploy(object):
                 written_info = yaml.load(f.read())
 
         assert info == written_info
+
+
+def write_proc_yaml(path, port):
+    info = {
+        'app_name': 'app',
+        'version': 'v1',
+        'config_name': 'prod',
+        'release_hash': 'abcd1234',
+        'proc_name': 'web',
+        'port': port,
+        'image_url': 'http://somewhere/image.tar.gz',
+    }
+    with open(path, 'wb') as f:
+        f.write(yaml.safe_dump(info, default_flow_style=False))
+
+
+@mock.patch.object(remote, 'supervisorctl')
+@mock.patch.object(remote, 'sudo')
+@mock.patch.object(remote, 'put')
+def test_deploy_procs_in_one_batch(mock_put, mock_sudo, mock_supervisorctl):
+    mock_sudo.return_value = '\n'.join(
+        remote.DEPLOYED_PROC_MARKER + ' ' + name for name in [
+            'app-v1-prod-abcd1234-web-5000',
+            'app-v1-prod-abcd1234-web-5001',
+        ])
+    with tmpdir():
+        write_proc_yaml('proc-5000.yaml', 5000)
+        write_proc_yaml('proc-5001.yaml', 5001)
+        remote.deploy_procs(['proc-5000.yaml', 'proc-5001.yaml'])
+
+        with tarfile.open('procs.tar.gz') as archive:
+            names = set(archive.getnames())
+
+    assert names == {
+        'app-v1-prod-abcd1234-web-5000/proc.yaml',
+        'app-v1-prod-abcd1234-web-5000/proc.conf',
+        'app-v1-prod-abcd1234-web-5001/proc.yaml',
+        'app-v1-prod-abcd1234-web-5001/proc.conf',
+    }
+    assert mock_put.call_count == 1
+    assert mock_sudo.call_count == 1
+    script = mock_sudo.call_args[0][0]
+    assert script.count('vrun setup') == 2
+    mock_supervisorctl.assert_has_calls([
+        mock.call('reread'),
+        mock.call('update app-v1-prod-abcd1234-web-5000 '
+                  'app-v1-prod-abcd1234-web-5001'),
+    ])
+
+
+@mock.patch.object(remote, 'supervisorctl')
+@mock.patch.object(remote, 'sudo')
+@mock.patch.object(remote, 'put')
+def test_deploy_procs_supervises_completed_setups(
+        mock_put, mock_sudo, mock_supervisorctl):
+    error = remote.Error(
+        remote.DEPLOYED_PROC_MARKER + ' app-v1-prod-abcd1234-web-5000\n'
+        'setup failed')
+    mock_sudo.side_effect = error
+    mock_supervisorctl.side_effect = [None, ValueError('supervisor is down')]
+    with tmpdir():
+        write_proc_yaml('proc-5000.yaml', 5000)
+        write_proc_yaml('proc-5001.yaml', 5001)
+        with pytest.raises(remote.Error) as raised:
+            remote.deploy_procs(['proc-5000.yaml', 'proc-5001.yaml'])
+
+    assert raised.value is error
+    mock_supervisorctl.assert_has_calls([
+        mock.call('reread'),
+        mock.call('update app-v1-prod-abcd1234-web-5000'),
+    ])
@@ -0,0 +1,93 @@
+import itertools
+import json
+from unittest.mock import Mock
+
+from django.test.utils import override_settings
+
+from vr.server import eventhub
+
+
+def upper(data):
+    return None if data == 'flush' else data.upper()
+
+
+class TestHub(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            EVENT_HUB_QUEUE_SIZE=2, EVENT_HUB_KEEPALIVE=0.01,
+            EVENT_HUB_COALESCE_WINDOW=1)
+        self.settings.enable()
+        self.hub = eventhub.Hub(Mock())
+        # Don't start the subscription thread.
+        self.hub._thread = Mock()
+
+    def teardown(self):
+        self.settings.disable()
+
+    def read(self, client, count):
+        return list(itertools.islice(iter(client), count))
+
+    def test_broadcasts_to_channel_clients(self):
+        first = self.hub.listen('events', upper)
+        second = self.hub.listen('events', upper)
+        other = self.hub.listen('procs', upper)
+
+        self.hub.broadcast('events', 'hello')
+        self.hub.broadcast('events', 'flush')
+
+        assert self.read(first, 2) == [eventhub.KEEPALIVE, 'HELLO']
+        assert self.read(second, 2) == [eventhub.KEEPALIVE, 'HELLO']
+        assert other.queue.empty()
+
+    def test_drops_slow_client(self):
+        slow = self.hub.listen('events', upper)
+        for data in 'abc':
+            self.hub.broadcast('events', data)
+
+        assert slow.dropped
+        assert slow not in self.hub.clients['events']
+        assert self.read(slow, 10) == [eventhub.KEEPALIVE]
+
+    def test_backlog_is_not_repeated(self):
+        client = self.hub.listen('events', upper)
+        client.backlog = ['A', 'B']
+        self.hub.broadcast('events', 'b')
+        self.hub.broadcast('events', 'c')
+
+        assert self.read(client, 4) == [eventhub.KEEPALIVE, 'A', 'B', 'C']
+
+    def test_keepalive_when_quiet(self):
+        client = self.hub.listen('events', upper)
+        assert self.read(client, 2) == [eventhub.KEEPALIVE] * 2
+
+    def test_close_removes_client(self):
+        client = self.hub.listen('events', upper)
+        client.close()
+        assert client not in self.hub.clients['events']
+
+    def test_match_filters_per_client(self):
+        def on_host1(message):
+            return message.get('host') == 'host1'
+        picky = self.hub.listen('procs', str, match=on_host1)
+        everything = self.hub.listen('procs', str)
+
+        messages = [json.dumps({'host': host}) for host in ['host1', 'host2']]
+        for data in messages:
+            self.hub.broadcast('procs', data)
+
+        assert self.read(picky, 2)[1:] == messages[:1]
+        assert picky.queue.empty()
+        assert self.read(everything, 3)[1:] == messages
+
+    def test_coalesces_messages_with_same_key(self):
+        def first_word(data):
+            return data.split()[0]
+        client = self.hub.listen('procs', str, coalesce=first_word)
+
+        for data in ['a STARTING', 'b RUNNING', 'a RUNNING', 'a EXITED']:
+            self.hub.receive('procs', data)
+        assert client.queue.empty()
+        self.hub.flush()
+
+        assert self.read(client, 3)[1:] == ['b RUNNING', 'a EXITED']
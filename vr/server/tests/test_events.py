@@ -0,0 +1,181 @@
+import itertools
+import json
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+import redis
+from django.test.utils import override_settings
+from vr.common.utils import randchars
+
+from vr.server import events
+
+
+@patch.object(events, '_new_sender')
+class TestPublish(object):
+
+    def setup(self):
+        events._sender = None
+        self.sync = override_settings(EVENTS_ASYNC=False)
+        self.sync.enable()
+
+    def teardown(self):
+        events._sender = None
+        self.sync.disable()
+
+    def test_sender_is_shared(self, new_sender):
+        events.publish('one')
+        events.publish('two')
+
+        assert new_sender.call_count == 1
+        sender = new_sender.return_value
+        assert sender.send.call_count == 2
+        assert not sender.close.called
+
+    def test_forked_child_gets_own_sender(self, new_sender):
+        new_sender.side_effect = lambda: Mock()
+        parent = events.get_sender()
+
+        with patch.object(events.os, 'getpid', return_value=-1):
+            child = events.get_sender()
+
+        assert child is not parent
+        assert not parent.close.called
+
+    def test_falls_back_to_new_connection(self, new_sender):
+        shared, fallback = Mock(), Mock()
+        shared.send.side_effect = redis.ConnectionError()
+        new_sender.side_effect = [shared, fallback]
+
+        events.publish('hello', tags=['deploy'])
+
+        shared.make_message.assert_called_once_with('hello', tags=['deploy'])
+        assert shared.close.called
+        fallback.send.assert_called_once_with(
+            [shared.make_message.return_value])
+        assert fallback.close.called
+        assert events._sender is None
+
+
+def test_sender_sends_batch_in_one_round_trip():
+    rcon = Mock(spec=redis.StrictRedis)
+    sender = events.EventSender(rcon, 'events', 'buffer', 2)
+
+    sender.send(['a', 'b', 'c'])
+
+    pipe = rcon.pipeline.return_value
+    assert pipe.publish.call_count == 3
+    assert pipe.lpush.call_count == 3
+    pipe.ltrim.assert_called_once_with('buffer', 0, 1)
+    pipe.execute.assert_called_once_with()
+
+
+class TestEventPipeline(object):
+
+    def setup(self):
+        self.sent = []
+        self.sending = threading.Event()
+        self.sending.set()
+
+    def send(self, batch):
+        self.sending.wait()
+        self.sent.append(batch)
+
+    def test_sends_queued_events_in_batches(self):
+        self.sending.clear()
+        pipeline = events.EventPipeline(self.send, 10, batch_size=2)
+        for message in 'abcd':
+            pipeline.put(message)
+        self.sending.set()
+
+        assert pipeline.flush(5)
+        assert sum(self.sent, []) == list('abcd')
+        assert all(len(batch) <= 2 for batch in self.sent)
+
+    def test_drops_events_when_full(self):
+        self.sending.clear()
+        pipeline = events.EventPipeline(self.send, 1, batch_size=1)
+        for message in 'abcd':
+            pipeline.put(message)
+        self.sending.set()
+
+        assert pipeline.flush(5)
+        assert pipeline.dropped > 0
+        assert len(sum(self.sent, [])) == 4 - pipeline.dropped
+
+    def test_failed_batch_does_not_stop_pipeline(self):
+        def send(batch):
+            self.sent.append(batch)
+            if batch == ['a']:
+                raise redis.ConnectionError()
+
+        pipeline = events.EventPipeline(send, 10, batch_size=1)
+        pipeline.put('a')
+        assert pipeline.flush(5)
+        pipeline.put('b')
+        assert pipeline.flush(5)
+        assert self.sent == [['a'], ['b']]
+
+
+def test_proc_event_filter():
+    match = events.ProcEventFilter(hosts=['host1'], apps=['app'])
+    proc = 'app-v1-prod-abc123-web-5000'
+
+    assert match({'host': 'host1', 'app_name': 'app', 'name': proc})
+    assert match({'host': 'host1', 'name': proc})
+    assert not match({'host': 'host2', 'app_name': 'app', 'name': proc})
+    assert not match({'host': 'host1', 'app_name': 'other'})
+    assert events.ProcEventFilter()({'host': 'host2'})
+
+
+def test_proc_event_key():
+    assert events.proc_event_key(json.dumps({'id': 'host1-proc'})) == (
+        'host1-proc')
+    assert events.proc_event_key('flush') is None
+
+
+@pytest.mark.usefixtures('redis')
+class TestStreams(object):
+
+    def setup(self):
+        self.rcon = redis.StrictRedis()
+        self.key = 'test_events_' + randchars()
+        self.sender = events.StreamEventSender(self.rcon, self.key, max_len=50)
+
+    def teardown(self):
+        self.rcon.delete(self.key)
+
+    def send(self, *messages):
+        self.sender.send([self.sender.make_message(m) for m in messages])
+
+    def read(self, listener, count):
+        return list(itertools.islice(listener, count))
+
+    def test_new_client_gets_backlog(self):
+        self.send('one', 'two', 'three')
+
+        listener = events.StreamListener(self.rcon, self.key, backlog=2)
+        first, second = self.read(listener, 2)
+
+        assert json.loads(first.split('data: ')[1])['message'] == 'two'
+        assert json.loads(second.split('data: ')[1])['message'] == 'three'
+
+    def test_resumes_from_last_event_id(self):
+        self.send('one', 'two')
+        listener = events.StreamListener(self.rcon, self.key)
+        first = self.read(listener, 1)[0]
+        last_id = first.split('\n')[0][len('id: '):]
+        self.send('three')
+
+        resumed = events.StreamListener(
+            self.rcon, self.key, last_event_id=last_id)
+        messages = [json.loads(ev.split('data: ')[1])['message']
+                    for ev in self.read(resumed, 2)]
+
+        assert messages == ['two', 'three']
+
+    def test_trim_args(self):
+        self.sender.max_len = 1
+        assert self.sender._trim_args() == ['MAXLEN', '~', 1]
+        self.sender.max_age = 60
+        assert self.sender._trim_args()[:2] == ['MINID', '~']
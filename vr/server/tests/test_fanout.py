@@ -0,0 +1,80 @@
+import threading
+import time
+
+import fabric.state
+from fabric.context_managers import settings as fab_settings
+
+from vr.server import fanout
+
+
+class TestRun(object):
+
+    def test_results(self):
+        report = fanout.run(lambda key: key * 2, [1, 2, 3],
+                            concurrency=2, timeout=10)
+        assert report.results == {1: 2, 2: 4, 3: 6}
+        assert not report.failed
+
+    def test_errors_are_collected(self):
+        def func(key):
+            if key == 'bad':
+                raise ValueError('boom')
+            return key
+
+        report = fanout.run(func, ['good', 'bad'], concurrency=2, timeout=10)
+        assert report.results == {'good': 'good'}
+        assert 'ValueError: boom' in report.errors['bad']
+        assert report.failed
+
+    def test_timeouts(self):
+        done = threading.Event()
+
+        def func(key):
+            if key == 'slow':
+                done.wait(5)
+            return key
+
+        report = fanout.run(func, ['fast', 'slow'], concurrency=2,
+                            timeout=0.1)
+        done.set()
+        assert report.results == {'fast': 'fast'}
+        assert report.timeouts == ['slow']
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def func(key):
+            with lock:
+                running.append(key)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(key)
+
+        fanout.run(func, range(8), concurrency=3, timeout=10)
+        assert max(peak) == 3
+
+    def test_no_keys(self):
+        report = fanout.run(lambda key: key, [], concurrency=2, timeout=10)
+        assert report.as_dict()['results'] == {}
+
+    def test_fabric_env_is_per_thread(self):
+        entered = {'host1': threading.Event(), 'host2': threading.Event()}
+
+        def func(key):
+            with fab_settings(host_string=key):
+                # Make sure both threads are inside their settings blocks.
+                entered[key].set()
+                for event in entered.values():
+                    event.wait(5)
+                return fabric.state.env.host_string, \
+                    fabric.state.env.command_timeout
+
+        report = fanout.run(func, ['host1', 'host2'], concurrency=2,
+                            timeout=10)
+        assert report.results == {'host1': ('host1', 10),
+                                  'host2': ('host2', 10)}
+        assert fabric.state.env.host_string != 'host1'
+        assert fabric.state.env.command_timeout is None
@@ -0,0 +1,155 @@
+import json
+from unittest.mock import MagicMock, Mock, patch
+
+from vr.common import models as common_models
+
+from vr.server import hostprocs
+from vr.server.tests import make_proc_info
+
+
+def make_host(name, proc_names=()):
+    host = MagicMock()
+    host.name = name
+    host.raw_host.name = name
+    host.raw_host.cache_key = 'host_procs:' + name
+    host.raw_host.cache_lifetime = 60
+    get_infos = host.raw_host.supervisor.getAllProcessInfo
+    get_infos.__name__ = 'getAllProcessInfo'
+    get_infos.return_value = [
+        make_proc_info(proc_name) for proc_name in proc_names]
+    return host
+
+
+@patch.object(common_models.time, 'sleep', Mock())
+class TestGetProcs(object):
+
+    proc_name = 'app-v1-local-abc123-web-5000'
+
+    def test_miss_fetches_and_caches(self):
+        host = make_host('host1', [self.proc_name])
+        host.raw_host.redis.hgetall.return_value = {}
+
+        procs = hostprocs.get_procs(host)
+
+        assert [p.name for p in procs] == [self.proc_name]
+        pipe = host.raw_host.redis.pipeline.return_value.__enter__.return_value
+        key, values = pipe.hmset.call_args[0]
+        assert key == 'host_procs:host1'
+        assert list(values) == [self.proc_name]
+        pipe.expire.assert_called_once_with('host_procs:host1', 60)
+
+    def test_hit_skips_supervisor(self):
+        host = make_host('host1')
+        host.raw_host.redis.hgetall.return_value = {
+            self.proc_name: json.dumps(make_proc_info(self.proc_name))}
+
+        procs = hostprocs.get_procs(host)
+
+        assert [p.port for p in procs] == [5000]
+        assert not host.raw_host.supervisor.getAllProcessInfo.called
+
+    def test_refresh(self):
+        host = make_host('host1', [self.proc_name])
+        hostprocs.get_procs(host, refresh=True)
+        assert not host.raw_host.redis.hgetall.called
+        assert host.raw_host.supervisor.getAllProcessInfo.called
+
+    def test_unreachable_host_is_not_cached(self):
+        host = make_host('host1')
+        host.raw_host.redis.hgetall.return_value = {}
+        host.raw_host.supervisor.getAllProcessInfo.side_effect = IOError()
+
+        assert hostprocs.get_procs(host) == []
+        assert host.raw_host.supervisor.getAllProcessInfo.call_count == 3
+        assert not host.raw_host.redis.pipeline.called
+
+
+@patch.object(hostprocs.models, 'events_redis')
+def test_proc_event_invalidates_host(events_redis):
+    hostprocs._handle_event(json.dumps({'host': 'host1', 'state': 'EXITED'}))
+    events_redis.delete.assert_called_once_with('host_procs:host1')
+
+
+@patch.object(hostprocs.models, 'events_redis')
+def test_flush_is_ignored(events_redis):
+    hostprocs._handle_event('flush')
+    assert not events_redis.delete.called
+
+
+@patch.object(common_models.time, 'sleep', Mock())
+def test_get_many_flags_unreachable_hosts():
+    up = make_host('up', ['app-v1-local-abc123-web-5000'])
+    down = make_host('down')
+    for host in up, down:
+        host.raw_host.redis.hgetall.return_value = {}
+    down.raw_host.supervisor.getAllProcessInfo.side_effect = IOError()
+
+    host_procs, unreachable = hostprocs.get_many([up, down])
+
+    assert [p.name for p in host_procs[up]] == ['app-v1-local-abc123-web-5000']
+    assert down not in host_procs
+    assert unreachable == [down]
+
+
+def make_proc(hostname, config_name='prod', release_hash='abc123', port=5000):
+    proc = Mock(app_name='app', config_name=config_name, proc_name='web',
+                hash=release_hash, port=port)
+    proc.host.name = hostname
+    return proc
+
+
+def make_swarm(config_name='prod', release_hash='abc123'):
+    swarm = Mock(config_name=config_name, proc_name='web')
+    swarm.app.name = 'app'
+    swarm.release.hash = release_hash
+    return swarm
+
+
+class TestProcIndex(object):
+
+    def setup(self):
+        self.current = make_proc('host1')
+        self.stale = make_proc('host2', release_hash='old')
+        self.other = make_proc('host1', config_name='test')
+        self.index = hostprocs.ProcIndex(
+            [self.current, self.stale, self.other], unreachable=['host3'])
+        self.swarm = make_swarm()
+
+    def test_get(self):
+        assert self.index.get(self.swarm) == [self.current, self.stale]
+        assert self.index.get(self.swarm, 'host2') == [self.stale]
+
+    def test_current_and_stale(self):
+        assert self.index.current(self.swarm) == [self.current]
+        assert self.index.current(self.swarm, 'host2') == []
+        assert self.index.stale(self.swarm) == [self.stale]
+
+    def test_count(self):
+        assert self.index.count('host1') == 2
+        assert self.index.count('host3') == 0
+
+    def test_ports(self):
+        assert self.index.ports('host1') == {5000}
+        assert self.index.ports('host3') == set()
+
+    def test_lookups_are_copies(self):
+        self.index.current(self.swarm).pop()
+        assert self.index.current(self.swarm) == [self.current]
+
+
+@patch.object(hostprocs, 'get_many')
+def test_get_swarm_procs_asks_shared_hosts_once(get_many):
+    shared, other = Mock(pk=1), Mock(pk=2)
+    shared.name, other.name = 'shared', 'other'
+    prod, test = make_swarm(), make_swarm(config_name='test')
+    prod.squad.hosts.all.return_value = [shared]
+    test.squad.hosts.all.return_value = [Mock(pk=1), other]
+    prod_proc = make_proc('shared')
+    test_proc = make_proc('shared', config_name='test')
+    get_many.return_value = ({shared: [prod_proc, test_proc]}, [other])
+
+    result = hostprocs.get_swarm_procs([prod, test])
+
+    hosts = get_many.call_args[0][0]
+    assert sorted(h.pk for h in hosts) == [1, 2]
+    assert result == [([prod_proc], []), ([test_proc], [other])]
@@ -0,0 +1,96 @@
+import itertools
+import threading
+from unittest.mock import patch
+
+import pytest
+import requests
+from django.test.utils import override_settings
+
+from vr.server import logtail
+
+
+def test_split_lines():
+    chunks = ['one\ntw', 'o', '\n\nthree\n', 'four']
+    assert list(logtail.split_lines(chunks)) == ['one', 'two', '', 'three']
+
+
+class FakeLog(object):
+    """
+    Log chunks as iter_content would yield them, released one at a time.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.released = threading.Semaphore(0)
+
+    def release(self, count=1):
+        for _ in range(count):
+            self.released.release()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.released.acquire()
+            yield chunk
+
+
+@patch.object(logtail.requests, 'get')
+class TestTail(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            LOG_TAIL_BACKLOG=1, LOG_TAIL_QUEUE_SIZE=10,
+            SUPERVISOR_USERNAME=None)
+        self.settings.enable()
+        self.log = FakeLog(['first\n', 'second\n', 'third\n'])
+
+    def teardown(self):
+        self.settings.disable()
+
+    def read(self, viewer, count):
+        return list(itertools.islice(iter(viewer), count))
+
+    def test_viewers_share_connection(self, get):
+        get.return_value.iter_content.return_value = self.log
+        first = logtail.tail('host1', 'proc')
+        self.log.release(2)
+        assert self.read(first, 2) == ['first\n', 'second\n']
+
+        second = logtail.tail('host1', 'proc', logtail.format_sse)
+        self.log.release()
+
+        assert get.call_count == 1
+        assert self.read(first, 1) == ['third\n']
+        assert self.read(second, 2) == [
+            logtail.format_sse('second'), logtail.format_sse('third')]
+
+        first.close()
+        assert not get.return_value.raw.release_conn.called
+        second.close()
+        assert get.return_value.raw.release_conn.called
+
+    def test_viewers_end_with_tail(self, get):
+        get.return_value.iter_content.return_value = ['only\n']
+        viewer = logtail.tail('host2', 'proc')
+
+        assert list(viewer) == ['only\n']
+        viewer.close()
+
+        # The next viewer makes a new connection.
+        get.return_value.iter_content.return_value = ['again\n']
+        again = logtail.tail('host2', 'proc')
+        assert list(again) == ['again\n']
+        again.close()
+        assert get.call_count == 2
+
+    def test_connect_error_is_raised(self, get):
+        get.return_value.raise_for_status.side_effect = requests.HTTPError(
+            '404 Client Error')
+        with pytest.raises(requests.HTTPError):
+            logtail.tail('host3', 'proc')
+
+        # The failed tail isn't reused.
+        get.return_value.raise_for_status.side_effect = None
+        get.return_value.iter_content.return_value = ['up\n']
+        viewer = logtail.tail('host3', 'proc')
+        assert list(viewer) == ['up\n']
+        viewer.close()
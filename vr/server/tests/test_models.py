@@ -1,3 +1,10 @@
+import json
+from unittest.mock import patch
+
+import pytest
+import yaml
+from django.utils import timezone
+
 from vr.server import models as M
 
 
@@ -30,3 +37,65 @@ def test_make_hash():
             (u'\xa3', 'd99731d14c7750048538404febb0e357'),
     ]:
         assert M.make_hash(data) == expected
+
+
+UPTEST_RESULTS = [
+    {'Passed': True, 'Name': 'up', 'Output': ''},
+    {'Passed': False, 'Name': 'down', 'Output': 'boom'},
+]
+
+
+def test_test_result_from_results():
+    result = M.TestResult.from_results(1, 'host1', 'proc', UPTEST_RESULTS)
+
+    assert not result.passed
+    assert result.testcount == 2
+    assert result.failed_count == 1
+    assert json.loads(result.results) == UPTEST_RESULTS
+    assert result.get_fails() == UPTEST_RESULTS[1:]
+
+    untested = M.TestResult.from_results(1, 'host1', 'proc', [])
+    assert untested.passed
+    assert untested.get_fails() == []
+
+
+def test_test_result_reads_yaml():
+    result = M.TestResult(
+        passed=False, results=yaml.safe_dump(UPTEST_RESULTS))
+    assert result.as_dict() == UPTEST_RESULTS
+    assert result.get_fails() == UPTEST_RESULTS[1:]
+
+
+@pytest.mark.usefixtures('postgresql')
+class TestTestRunCounts(object):
+
+    def setup(self):
+        self.run = M.TestRun(start=timezone.now())
+        self.run.save()
+        M.TestResult.objects.bulk_create([
+            M.TestResult.from_results(self.run.id, 'host1', proc, results)
+            for proc, results in [
+                ('web', UPTEST_RESULTS),
+                ('worker', UPTEST_RESULTS[:1]),
+                ('cron', []),
+            ]
+        ])
+        self.counts = {'pass_count': 2, 'fail_count': 1, 'notests_count': 1}
+
+    def teardown(self):
+        self.run.delete()
+
+    def test_counts_while_running(self):
+        assert self.run.get_counts() == self.counts
+        assert self.run.has_failures()
+
+    def test_saved_counts(self):
+        self.run.end = timezone.now()
+        self.run.update_counts()
+        self.run.save()
+
+        run = M.TestRun.objects.get(id=self.run.id)
+        with patch.object(M.TestRun, 'count_results') as count_results:
+            assert run.get_counts() == self.counts
+            assert run.results['fail_count'] == 1
+            assert not count_results.called
@@ -0,0 +1,88 @@
+from unittest.mock import patch
+
+import pytest
+from django.db import IntegrityError
+from django.test.utils import override_settings
+
+from vr.common.utils import randchars
+from vr.server import ports
+from vr.server.models import Host, PortLock
+
+
+@pytest.mark.usefixtures('postgresql')
+class TestAllocatePorts(object):
+
+    def setup(self):
+        self.port_range = override_settings(
+            PORT_RANGE_START=5000, PORT_RANGE_END=5004)
+        self.port_range.enable()
+        self.host = Host(name=randchars(), active=True)
+        self.host.save()
+
+    def teardown(self):
+        PortLock.objects.filter(host=self.host).delete()
+        self.host.delete()
+        self.port_range.disable()
+
+    def test_allocates_free_ports(self):
+        PortLock(host=self.host, port=5001).save()
+
+        allocated = ports.allocate_ports(self.host, 2, used_ports={5000})
+
+        assert sorted(allocated) == [5002, 5003]
+        locked = PortLock.objects.filter(host=self.host)
+        assert sorted(lock.port for lock in locked) == [5001, 5002, 5003]
+
+    def test_not_enough_ports(self):
+        with pytest.raises(ValueError):
+            ports.allocate_ports(self.host, 2, used_ports={5000, 5001, 5002})
+        assert not PortLock.objects.filter(host=self.host).exists()
+
+    def test_retries_on_collision(self):
+        bulk_create = PortLock.objects.bulk_create
+        attempts = []
+
+        def collide_once(objs):
+            attempts.append(objs)
+            if len(attempts) == 1:
+                raise IntegrityError()
+            return bulk_create(objs)
+
+        with patch.object(PortLock.objects, 'bulk_create', collide_once):
+            allocated = ports.allocate_ports(self.host, 1, used_ports=set())
+        assert len(attempts) == 2
+        assert PortLock.objects.get(host=self.host).port == allocated[0]
+
+
+@pytest.mark.usefixtures('redis')
+class TestRedisReservations(object):
+
+    def setup(self):
+        self.backend = ports.RedisReservations(
+            {'URL': 'redis://localhost:6379/0', 'TTL': 60})
+        self.hostname = randchars()
+
+    def teardown(self):
+        self.backend.rcon.delete(self.backend._key(self.hostname))
+
+    def test_reserve_and_release(self):
+        self.backend.reserve(self.hostname, [5000, 5001])
+        assert self.backend.reserved(self.hostname) == {5000, 5001}
+
+        self.backend.release(self.hostname, [5000])
+        assert self.backend.reserved(self.hostname) == {5001}
+
+    def test_reserves_all_or_nothing(self):
+        self.backend.reserve(self.hostname, [5001])
+
+        with pytest.raises(ports.PortsTaken):
+            self.backend.reserve(self.hostname, [5000, 5001])
+        assert self.backend.reserved(self.hostname) == {5001}
+
+    def test_reservations_expire(self):
+        self.backend.reserve(self.hostname, [5000])
+        later = ports.time.time() + 61
+
+        with patch.object(ports.time, 'time', return_value=later):
+            assert self.backend.reserved(self.hostname) == set()
+            self.backend.reserve(self.hostname, [5000])
@@ -0,0 +1,96 @@
+from unittest.mock import Mock
+
+from django.test.utils import override_settings
+from six.moves import xmlrpc_client
+
+from vr.server import proclogs
+
+
+LOG = b'starting\nrequest ok\nERROR boom\nrequest ok\nerror again'
+
+# Chunks of 8 bytes split the e acute.
+UNICODE_LOG = u'ok \u2603\n\xe9 ERROR\ndone \u2603\n'.encode('utf-8')
+
+
+class FakeSupervisor(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.reads = []
+
+    def tailProcessStdoutLog(self, name, offset, length):
+        return ['', len(self.log), True]
+
+    def readProcessStdoutLog(self, name, offset, length):
+        self.reads.append((offset, length))
+        try:
+            return self.log[offset:offset + length].decode('utf-8')
+        except UnicodeDecodeError as exc:
+            raise xmlrpc_client.Fault(30, 'FAILED: %s' % exc)
+
+
+class TestProcLog(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            PROC_LOG_CHUNK_SIZE=8, PROC_LOG_WINDOW_MAX_BYTES=30,
+            PROC_LOG_SEARCH_MAX_RESULTS=10)
+        self.settings.enable()
+        self.log = self.make_log(LOG)
+
+    def make_log(self, data):
+        self.supervisor = FakeSupervisor(data)
+        host = Mock()
+        host.raw_host.supervisor = self.supervisor
+        return proclogs.ProcLog(host, 'proc')
+
+    def teardown(self):
+        self.settings.disable()
+
+    def test_window(self):
+        assert self.log.window(9, 10) == (9, len(LOG), b'request ok')
+        assert self.log.window(-11, 3) == (42, len(LOG), b'err')
+        offset, size, data = self.log.window()
+        assert data == LOG[-30:]
+
+    def test_lines(self):
+        offset, size, data = self.log.lines(2)
+        assert data == b'request ok\nerror again'
+        assert offset == LOG.index(data)
+        assert max(length for _, length in self.supervisor.reads) == 8
+
+        offset, size, data = self.log.lines(1, end=20)
+        assert data == b'request ok\n'
+        assert offset == 9
+
+    def test_search(self):
+        results = list(self.log.search('error', ignore_case=True))
+
+        matches, done = results[:-1], results[-1]
+        assert [(m['offset'], m['text']) for m in matches] == [
+            (20, 'ERROR boom'), (42, 'error again')]
+        assert matches[1]['start'] == 0 and matches[1]['end'] == 5
+        assert done == {'done': True, 'offset': len(LOG), 'size': len(LOG),
+                        'truncated': False}
+
+    def test_search_stops_at_max_results(self):
+        results = list(self.log.search('request', max_results=1))
+
+        assert [r.get('offset') for r in results[:-1]] == [9]
+        assert results[-1]['truncated']
+        assert results[-1]['offset'] == 20
+
+    def test_reads_whole_characters(self):
+        log = self.make_log(UNICODE_LOG)
+
+        assert log.window(1, 4) == (1, len(UNICODE_LOG), b'k ')
+        assert log.read(4, 4) == (6, b'\n')
+
+        offset, size, data = log.lines(1)
+        assert data == u'done \u2603\n'.encode('utf-8')
+        assert offset == 16
+
+        results = list(log.search('ERROR'))
+        assert [(r['offset'], r['text']) for r in results[:-1]] == [
+            (7, u'\xe9 ERROR')]
+        assert results[-1]['offset'] == len(UNICODE_LOG)
@@ -0,0 +1,62 @@
+from unittest.mock import Mock, patch
+
+from vr.server import sshpool
+
+
+def make_client(active=True):
+    client = Mock()
+    client.get_transport.return_value.is_active.return_value = active
+    return client
+
+
+@patch.object(sshpool.fabric.state, 'connections', {})
+class TestConnectionPool(object):
+
+    def setup(self):
+        self.pool = sshpool.ConnectionPool(max_per_host=1, idle_timeout=300)
+
+    def test_first_connection_is_a_miss(self):
+        with self.pool.connection('host1'):
+            assert 'host1' not in sshpool.fabric.state.connections
+        assert self.pool.stats()['misses'] == 1
+
+    def test_connection_is_reused(self):
+        client = make_client()
+        with self.pool.connection('host1'):
+            # Fabric connects lazily, inside the block.
+            sshpool.fabric.state.connections['host1'] = client
+        assert 'host1' not in sshpool.fabric.state.connections
+
+        with self.pool.connection('host1'):
+            assert sshpool.fabric.state.connections['host1'] is client
+        assert self.pool.stats()['hits'] == 1
+        assert not client.close.called
+
+    def test_dead_connection_is_evicted(self):
+        client = make_client(active=False)
+        self.pool.checkin('host1', client)
+        assert self.pool.checkout('host1') is None
+        client.close.assert_called_once_with()
+        assert self.pool.stats()['evictions'] == 1
+
+    def test_idle_connection_is_evicted(self):
+        client = make_client()
+        self.pool.idle_timeout = -1
+        self.pool.checkin('host1', client)
+        client.close.assert_called_once_with()
+        assert self.pool.checkout('host1') is None
+
+    def test_max_per_host(self):
+        first, second = make_client(), make_client()
+        self.pool.checkin('host1', first)
+        self.pool.checkin('host1', second)
+        second.close.assert_called_once_with()
+        assert self.pool.stats()['overflows'] == 1
+        assert self.pool.checkout('host1') is first
+
+    def test_pool_is_discarded_after_fork(self):
+        client = make_client()
+        self.pool.checkin('host1', client)
+        with patch.object(sshpool.os, 'getpid', return_value=-1):
+            assert self.pool.checkout('host1') is None
+        assert not client.close.called
@@ -0,0 +1,190 @@
+import hashlib
+import io
+import itertools
+import os
+from unittest.mock import Mock, patch
+
+import pytest
+from django.test.client import RequestFactory
+from pymongo.errors import ConnectionFailure
+
+from vr.server import storages
+
+
+CONTENT = b'0123456789' * 100
+
+
+class FakeGridOut(io.BytesIO):
+    md5 = 'abc123'
+    length = len(CONTENT)
+    content_type = None
+    name = 'builds/app.tar.gz'
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('bytes=0-9', (0, 10)),
+    ('bytes=990-', (990, 1000)),
+    ('bytes=-10', (990, 1000)),
+    ('bytes=995-2000', (995, 1000)),
+    ('bytes=0-1,5-6', None),
+    ('bytes=9-0', None),
+    ('lines=1-2', None),
+])
+def test_parse_range(header, expected):
+    assert storages.parse_range(header, 1000) == expected
+
+
+def test_parse_unsatisfiable_range():
+    with pytest.raises(ValueError):
+        storages.parse_range('bytes=1000-', 1000)
+
+
+@patch.object(storages, 'default_storage')
+class TestServeFile(object):
+
+    def setup(self):
+        self.factory = RequestFactory()
+
+    def serve(self, default_storage, method='get', **headers):
+        default_storage.open.return_value = FakeGridOut(CONTENT)
+        default_storage.cache = getattr(self, 'cache', None)
+        request = getattr(self.factory, method)('/files/x', **headers)
+        return storages.serve_file(request, 'x')
+
+    def test_streams_whole_file(self, default_storage):
+        resp = self.serve(default_storage)
+
+        assert resp.status_code == 200
+        assert resp.streaming
+        assert b''.join(resp.streaming_content) == CONTENT
+        assert resp['Content-Length'] == str(len(CONTENT))
+        assert resp['ETag'] == '"abc123"'
+        assert resp['Content-Type'] == 'application/x-tar'
+
+    def test_range(self, default_storage):
+        resp = self.serve(default_storage, HTTP_RANGE='bytes=10-19')
+
+        assert resp.status_code == 206
+        assert b''.join(resp.streaming_content) == CONTENT[10:20]
+        assert resp['Content-Range'] == 'bytes 10-19/1000'
+        assert resp['Content-Length'] == '10'
+
+    def test_stale_if_range_gets_whole_file(self, default_storage):
+        resp = self.serve(default_storage, HTTP_RANGE='bytes=10-19',
+                          HTTP_IF_RANGE='"other"')
+        assert resp.status_code == 200
+
+    def test_unsatisfiable_range(self, default_storage):
+        resp = self.serve(default_storage, HTTP_RANGE='bytes=5000-')
+
+        assert resp.status_code == 416
+        assert resp['Content-Range'] == 'bytes */1000'
+
+    def test_not_modified(self, default_storage):
+        resp = self.serve(default_storage, HTTP_IF_NONE_MATCH='"abc123"')
+        assert resp.status_code == 304
+
+    def test_head(self, default_storage):
+        resp = self.serve(default_storage, method='head')
+
+        assert resp.status_code == 200
+        assert not resp.streaming
+        assert resp.content == b''
+        assert resp['Content-Length'] == str(len(CONTENT))
+
+    def test_serves_from_cache(self, default_storage, tmpdir):
+        self.cache = storages.DiskCache(str(tmpdir), 10000)
+
+        resp = self.serve(default_storage)
+        assert b''.join(resp.streaming_content) == CONTENT
+        assert os.listdir(str(tmpdir)) == [
+            os.path.basename(self.cache.path(FakeGridOut.name, 'abc123'))]
+
+        resp = self.serve(default_storage, HTTP_RANGE='bytes=10-19')
+        assert resp.status_code == 206
+        assert b''.join(resp.streaming_content) == CONTENT[10:20]
+
+
+class TestDiskCache(object):
+
+    def test_fetch_copies_once(self, tmpdir):
+        cache = storages.DiskCache(str(tmpdir), 10000)
+
+        path = cache.fetch(FakeGridOut(CONTENT))
+        with open(path, 'rb') as f:
+            assert f.read() == CONTENT
+
+        again = FakeGridOut(b'')
+        assert cache.fetch(again) == path
+        assert again.tell() == 0
+
+    def test_new_version_gets_new_copy(self, tmpdir):
+        cache = storages.DiskCache(str(tmpdir), 10000)
+        old = cache.fetch(FakeGridOut(CONTENT))
+
+        new_version = FakeGridOut(b'new')
+        new_version.md5 = 'def456'
+        assert cache.fetch(new_version) != old
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        cache = storages.DiskCache(str(tmpdir), 3000)
+        paths = []
+        for i in range(3):
+            f = FakeGridOut(CONTENT)
+            f.name = 'file%d' % i
+            paths.append(cache.fetch(f))
+            os.utime(paths[-1], (i, i))
+        # Using the first file makes the second the oldest.
+        first = FakeGridOut(CONTENT)
+        first.name = 'file0'
+        cache.fetch(first)
+
+        f = FakeGridOut(CONTENT)
+        f.name = 'file3'
+        latest = cache.fetch(f)
+
+        assert sorted(os.listdir(str(tmpdir))) == sorted(
+            os.path.basename(p) for p in (paths[0], paths[2], latest))
+
+
+@pytest.mark.usefixtures('gridfs')
+class TestUpload(object):
+
+    def upload(self, content, name='uploads/app.tar.gz'):
+        return storages.default_storage.upload(name, content, chunk_size=64)
+
+    def test_upload(self):
+        upload = self.upload(io.BytesIO(CONTENT))
+
+        assert upload.md5 == hashlib.md5(CONTENT).hexdigest()
+        assert upload.length == len(CONTENT)
+        f = storages.default_storage.open(upload.name)
+        assert f.read() == CONTENT
+        assert f.md5 == upload.md5
+
+    def test_resumes_after_lost_connection(self):
+        put = storages.ChunkedUpload._put
+        calls = itertools.count()
+
+        def flaky_put(upload, data):
+            if next(calls) == 5:
+                raise ConnectionFailure()
+            put(upload, data)
+
+        with patch.object(storages.ChunkedUpload, '_put', flaky_put):
+            upload = self.upload(io.BytesIO(CONTENT))
+
+        assert upload.md5 == hashlib.md5(CONTENT).hexdigest()
+        assert storages.default_storage.open(upload.name).read() == CONTENT
+
+    def test_aborts_on_failure(self):
+        storage = storages.default_storage
+        chunks = storage.db[storage.collection].chunks
+        count = chunks.find().count()
+        content = Mock(**{'read.side_effect': [CONTENT[:200], IOError()]})
+
+        with pytest.raises(IOError):
+            self.upload(content, 'uploads/broken.tar.gz')
+
+        assert chunks.find().count() == count
+        assert not storage.exists('uploads/broken.tar.gz')
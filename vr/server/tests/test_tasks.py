@@ -1,21 +1,25 @@
 # pylint: disable=attribute-defined-outside-init,too-many-instance-attributes
 # pylint: disable=unused-argument,superfluous-parens,no-self-use
 # pylint: disable=protected-access
+import datetime
+import json
 import os.path
 import shutil
 import tempfile
 import textwrap
 import time
-from path import Path
 from unittest import TestCase
 from unittest.mock import MagicMock, Mock, patch, call
 
 import pytest
-from fabric.api import local
+from django.test.utils import override_settings
+from django.utils import timezone
 
 from vr.common.utils import randchars
 from vr.server import tasks, remote
-from vr.server.models import App, Build, BuildPack, OSImage, Host
+from vr.server.models import (
+    App, Build, BuildPack, OSImage, Host, TestRun, TestResult,
+    TestResultRollup)
 from vr.server.settings import MEDIA_URL
 from vr.server.tasks import (
     MissingLogError,
@@ -154,7 +158,7 @@ class TestSwarmStartBranches(object):
 
 class TestSwarmReleaseBranches(object):
 
-    @patch.object(tasks, 'PortLock', Mock())
+    @patch.object(tasks, 'allocate_ports', Mock(return_value=[5000]))
     @patch.object(tasks, 'swarm_deploy_to_host')
     @patch.object(tasks, 'Swarm')
     def test_swarm_release_calls_swarm_deploy_to_host(self,
@@ -164,7 +168,10 @@ class TestSwarmReleaseBranches(object):
         swarm = MagicMock()
         swarm.size = 2
         swarm.get_prioritized_hosts.return_value = [MagicMock(), MagicMock()]
-        swarm.get_procs.return_value = []  # no procs currently
+        # no procs currently
+        index = swarm.get_proc_index.return_value
+        index.current.return_value = []
+        index.unreachable = set()
         Swarm.objects.get.return_value = swarm
 
         tasks.swarm_release(1234, 'trace_id')
@@ -178,6 +185,52 @@ class TestSwarmReleaseBranches(object):
         # assert len(swarm_deploy_to_host.subtask.mock_calls) == 2
         assert swarm_deploy_to_host.subtask.called
 
+    @patch.object(tasks, 'chord', Mock())
+    @patch.object(tasks, 'allocate_ports')
+    @patch.object(tasks, 'Swarm')
+    def test_swarm_release_allocates_ports_per_host(self, Swarm,
+                                                    allocate_ports):
+        first, second = MagicMock(), MagicMock()
+        first.name, second.name = 'first', 'second'
+        swarm = MagicMock()
+        swarm.size = 3
+        swarm.get_prioritized_hosts.return_value = [first, second]
+        index = swarm.get_proc_index.return_value
+        index.current.return_value = []
+        index.unreachable = set()
+        Swarm.objects.get.return_value = swarm
+
+        tasks.swarm_release(1234, 'trace_id')
+
+        assert allocate_ports.call_count == 2
+        allocate_ports.assert_any_call(
+            first, 2, used_ports=index.ports.return_value)
+        allocate_ports.assert_any_call(
+            second, 1, used_ports=index.ports.return_value)
+
+    @patch.object(tasks, 'send_event')
+    @patch.object(tasks, 'swarm_finished')
+    @patch.object(tasks, 'chord')
+    @patch.object(tasks, 'allocate_ports')
+    @patch.object(tasks, 'Swarm')
+    def test_swarm_release_aborts_on_unreachable_host(
+            self, Swarm, allocate_ports, chord, swarm_finished, send_event):
+        swarm = MagicMock()
+        swarm.size = 2
+        index = swarm.get_proc_index.return_value
+        index.current.return_value = []
+        index.unreachable = {'down'}
+        Swarm.objects.get.return_value = swarm
+
+        tasks.swarm_release(1234, 'trace_id')
+        tasks.swarm_cleanup(1234, 'trace_id')
+
+        assert not allocate_ports.called
+        assert not chord.called
+        assert not swarm_finished.delay.called
+        assert send_event.call_count == 2
+        assert 'down' in send_event.call_args[0][1]
+
 
 @pytest.mark.usefixtures('postgresql')
 class TestScooper(object):
@@ -200,72 +253,47 @@ class TestScooper(object):
 
     @patch.object(tasks, '_clean_host_filesystem')
     def test_filesystem_scooper(self, mock_clean_host):
-        tasks.filesystem_scooper()
-        mock_clean_host.apply_async.assert_called_once_with(
-            (self.host.name, ), expires=1800)
-
-    @patch.object(remote, 'files')
-    @patch.object(remote, 'get_procs')
-    @patch.object(remote, 'get_old_procnames')
-    @patch.object(remote, 'get_builds')
-    @patch.object(remote, 'get_images')
-    @patch.object(remote, 'get_orphans')
-    @patch.object(remote, 'delete_build')
-    @patch.object(remote, 'teardown')
-    def test_clean_host_no_unused(
-            self, mock_teardown, mock_delete_build, mock_get_orphans,
-            mock_get_images, mock_get_builds, mock_get_procs,
-            mock_get_old_procnames, mock_files):
-        mock_get_orphans.return_value = []
-        mock_get_images.return_value = []
-        mock_get_builds.return_value = [
-            'app-build1',
-            'app-build2',
-        ]
-        mock_get_procs.return_value = mock_get_old_procnames.return_value = [
+        report = tasks.filesystem_scooper()
+        mock_clean_host.assert_called_once_with(self.host.name)
+        assert list(report['results']) == [self.host.name]
+
+    @patch.object(remote, 'get_inventory')
+    @patch.object(remote, 'sudo')
+    def test_clean_host_no_unused(self, mock_sudo, mock_get_inventory):
+        procs = [
             'app-build1-proc1',
             'app-build1-proc2',
             'app-build2-proc1',
         ]
-        mock_files.exists.return_value = True
+        mock_get_inventory.return_value = remote.Inventory(
+            procs=procs,
+            builds=['app-build1', 'app-build2'],
+            supervised=procs,
+        )
         tasks._clean_host_filesystem(self.host.name)
         tasks._clean_host_procs(self.host.name)
-        assert not mock_delete_build.called
-
-        # Order doesn't matter
-        mock_teardown.assert_any_call('app-build1-proc1', None)
-        mock_teardown.assert_any_call('app-build1-proc2', None)
-        mock_teardown.assert_any_call('app-build2-proc1', None)
-
-    @patch.object(remote, 'files')
-    @patch.object(remote, 'get_procs')
-    @patch.object(remote, 'get_old_procnames')
-    @patch.object(remote, 'get_builds')
-    @patch.object(remote, 'get_images')
-    @patch.object(remote, 'get_orphans')
-    @patch.object(remote, 'delete_build')
-    @patch.object(remote, 'teardown')
-    def test_clean_host(
-            self, mock_teardown, mock_delete_build, mock_get_images,
-            mock_get_orphans, mock_get_builds, mock_get_procs,
-            mock_get_old_procnames, mock_files):
-        mock_get_orphans.return_value = []
-        mock_get_images.return_value = []
-        mock_get_builds.return_value = [
-            'app-build1',
-            'app-build2',
-        ]
-        mock_get_procs.return_value = mock_get_old_procnames.return_value = [
+        assert not mock_sudo.called
+
+    @patch.object(remote, 'get_inventory')
+    @patch.object(remote, 'sudo')
+    def test_clean_host(self, mock_sudo, mock_get_inventory):
+        mock_get_inventory.return_value = remote.Inventory(
             # app-build1 is unused
-            'app-build2-proc1',
-        ]
-        mock_files.exists.return_value = True
+            procs=['app-build2-proc1'],
+            proc_yamls=['app-build2-proc1'],
+            builds=['app-build1', 'app-build2'],
+            supervised=[],
+        )
         tasks._clean_host_filesystem(self.host.name)
         tasks._clean_host_procs(self.host.name)
-        mock_delete_build.assert_called_once_with('app-build1')
-
-        # Order doesn't matter
-        mock_teardown.assert_any_call('app-build2-proc1', None)
+        mock_sudo.assert_has_calls([
+            call('rm -rf /apps/builds/app-build1'),
+            call('status=0; '
+                 'vrun teardown /apps/procs/app-build2-proc1/proc.yaml && '
+                 'rm -rf /apps/procs/app-build2-proc1 || status=1; '
+                 'exit $status'),
+        ])
+        assert mock_sudo.call_count == 2
 
     @patch.object(remote, 'get_build_procs')
     @patch.object(remote, 'delete_proc')
@@ -287,64 +315,39 @@ class TestScooper(object):
         ])
         mock_sudo.assert_called_once_with('rm -rf /apps/builds/app-build')
 
-    @patch.object(remote, 'get_images')
-    @patch.object(remote, '_get_builds_in_use')
-    @patch.object(remote, '_rm_image')
-    @patch.object(remote, 'files')
-    @patch.object(remote, 'sudo')
-    def test_clean_images_folders(
-            self, mock_sudo, mock_files, mock_rm_image,
-            mock_get_builds_in_use, mock_get_images):
-
-        mock_get_images.return_value = [
-            'recent_img',
-            'non_existing_img',
-            'old_img',
-        ]
-
-        def local_exists(p, *args, **kwargs):
-            return os.path.exists(p)
-        mock_files.exists.side_effect = local_exists
-
-        def local_sudo(cmd):
-            return local(cmd, capture=True)
-        mock_sudo.side_effect = local_sudo
-
-        # Make sure img is recent
-        atime = time.time() - remote.MAX_IMAGE_AGE_SECS + 10
-        (Path(remote.IMAGES_ROOT) / 'recent_img').mkdir_p().utime(
-            (atime, atime))
+    @patch.object(remote, '_rm_images')
+    def test_clean_images_folders(self, mock_rm_images):
+        now = time.time()
+        inventory = remote.Inventory(images={
+            'recent_img': now - remote.MAX_IMAGE_AGE_SECS + 10,
+            'old_img': now - remote.MAX_IMAGE_AGE_SECS - 10,
+        })
 
-        # Make sure img does not exist
-        (Path(remote.IMAGES_ROOT) / 'non_existing_img').rmtree_p()
+        remote.clean_images_folders(inventory)
+        mock_rm_images.assert_called_once_with(
+            [os.path.join(remote.IMAGES_ROOT, 'old_img')])
 
-        # Make sure img is old
-        atime = time.time() - remote.MAX_IMAGE_AGE_SECS - 10
-        old_img_path = (
-            Path(remote.IMAGES_ROOT) / 'old_img'
-        ).mkdir_p().utime((atime, atime))
-
-        mock_get_builds_in_use.return_value = []
-
-        remote.clean_images_folders()
-        mock_rm_image.assert_called_once_with(old_img_path)
-
-    @patch.object(remote, '_get_proc_settings')
-    @patch.object(remote, 'get_supervised_procnames')
-    @patch.object(remote, 'get_installed_procnames')
-    @patch.object(remote, 'teardown')
-    def test_teardown_old_procs(
-            self, mock_teardown, mock_get_installed_procnames,
-            mock_get_supervised_procnames, mock_get_proc_settings):
+    @patch.object(remote, 'sudo')
+    def test_teardown_old_procs(self, mock_sudo):
+        inventory = remote.Inventory(
+            procs=['proc1', 'proc2', 'proc3', 'proc4'],
+            proc_yamls=['proc1', 'proc2', 'proc3'],
+            supervised=['proc1', 'proc2'],
+        )
 
-        mock_get_proc_settings.return_value = None
-        mock_get_supervised_procnames.return_value = {
-            'proc1', 'proc2'}
-        mock_get_installed_procnames.return_value = {
-            'proc1', 'proc2', 'proc3'}
+        remote.teardown_old_procs(inventory)
+        mock_sudo.assert_called_once_with(
+            'status=0; '
+            'vrun teardown /apps/procs/proc3/proc.yaml && '
+            'rm -rf /apps/procs/proc3 || status=1; '
+            'rm -rf /apps/procs/proc4 || status=1; '
+            'exit $status')
 
-        remote.teardown_old_procs()
-        mock_teardown.assert_called_once_with('proc3', None)
+    @patch.object(remote, 'sudo')
+    def test_teardown_old_procs_without_supervisor(self, mock_sudo):
+        inventory = remote.Inventory(procs=['proc1'], supervised=None)
+        remote.teardown_old_procs(inventory)
+        assert not mock_sudo.called
 
     @patch.object(remote, 'get_orphans')
     @patch.object(remote, 'sudo')
@@ -355,12 +358,200 @@ class TestScooper(object):
             (1002, ('child5', 'child5')),
         ]
         remote.kill_orphans()
-        mock_sudo.assert_has_calls([
-            call('kill -9 1000'),
-            call('kill -9 1001'),
-            call('kill -9 1002'),
+        mock_sudo.assert_called_once_with('kill -9 1000 1001 1002')
+
+
+INVENTORY_OUTPUT = """\
+==> vr-inventory procs
+app-v1-local-abc123-web-5000
+app-v1-local-abc123-web-5001
+app-v1-local-abc123-web-5002.hold
+==> vr-inventory status 0
+==> vr-inventory proc_yamls
+app-v1-local-abc123-web-5000/proc.yaml
+==> vr-inventory status 0
+==> vr-inventory builds
+app-v1
+==> vr-inventory status 0
+==> vr-inventory images
+1500000000.1234567890 ubuntu-20170101
+==> vr-inventory status 0
+==> vr-inventory supervisor
+app-v1-local-abc123-web-5000   RUNNING   pid 9642, uptime 1 day, 2:03:04
+==> vr-inventory status 0
+==> vr-inventory ps
+    1     0 /sbin/init
+ 6676     1 sudo -u nobody -E -s /apps/procs/app/run
+ 6680  6676 /bin/sh /apps/procs/app/run
+ 9642  9634 su --preserve-environment nobody
+==> vr-inventory status 0
+"""
+
+
+class TestInventory(object):
+
+    def test_parse(self):
+        inventory = remote.Inventory.parse(INVENTORY_OUTPUT)
+        assert inventory.procs == [
+            'app-v1-local-abc123-web-5000',
+            'app-v1-local-abc123-web-5001',
+        ]
+        assert inventory.proc_yamls == {'app-v1-local-abc123-web-5000'}
+        assert inventory.builds == ['app-v1']
+        assert inventory.images == {'ubuntu-20170101': 1500000000}
+        assert inventory.get_builds_in_use() == {'app-v1'}
+        assert inventory.get_old_procnames() == {
+            'app-v1-local-abc123-web-5001'}
+        assert inventory.get_orphans() == {
+            (6676, ('/bin/sh /apps/procs/app/run',))}
+
+    def test_supervisor_unavailable(self):
+        output = INVENTORY_OUTPUT.replace(
+            'supervisor\napp-v1-local-abc123-web-5000   RUNNING   '
+            'pid 9642, uptime 1 day, 2:03:04\n==> vr-inventory status 0',
+            'supervisor\n==> vr-inventory status 2')
+        inventory = remote.Inventory.parse(output)
+        assert inventory.supervised is None
+        assert inventory.get_old_procnames() == set()
+
+    def test_round_trip(self):
+        inventory = remote.Inventory.parse(INVENTORY_OUTPUT)
+        data = json.loads(json.dumps(inventory.as_dict()))
+        assert remote.Inventory.from_dict(data).as_dict() == \
+            inventory.as_dict()
+
+
+def uptest_proc(name, version='v1', port=5000, image_url=None):
+    proc = Mock()
+    proc.name = name
+    proc.settings = Mock(
+        app_name='app', version=version, config_name='local',
+        release_hash='abc123', proc_name='web', port=port,
+        image_name='ubuntu', image_url=image_url)
+    return proc
+
+
+class TestUptests(object):
+
+    @patch.object(remote, 'sudo')
+    @patch.object(remote, 'Host')
+    def test_find_uptests(self, mock_host, mock_sudo):
+        mock_host.objects.get.return_value.get_procs.return_value = [
+            uptest_proc('new', image_url='http://images/ubuntu.tar.gz'),
+            uptest_proc('legacy', port=5001),
+            uptest_proc('untested', version='v2', port=5002),
+        ]
+        mock_sudo.return_value = '\n'.join(
+            remote.UPTEST_PATH_MARKER + ' ' + path for path in [
+                '/apps/procs/app-v1-local-abc123-web-5000/rootfs',
+                '/apps/procs/app-v1-local-abc123-web-5000/rootfs/app/'
+                'uptests/web',
+                '/apps/builds/app-v1-ubuntu/uptests/web',
+            ])
+
+        commands, results = remote.find_uptests(
+            'host1', ['new', 'legacy', 'untested', 'gone'],
+            ignore_missing_procs=True)
+
+        assert mock_sudo.call_count == 1
+        assert commands['new'] == (
+            'vrun uptest /apps/procs/app-v1-local-abc123-web-5000/proc.yaml')
+        assert commands['legacy'].startswith(
+            'exec lxc-start --name app-v1-local-abc123-web-5001-uptest')
+        assert results == {'untested': [], 'gone': []}
+
+    @patch.object(remote, 'sudo')
+    @patch.object(remote, 'Host')
+    def test_find_uptests_given_procs(self, mock_host, mock_sudo):
+        mock_sudo.return_value = ''
+
+        commands, results = remote.find_uptests(
+            'host1', [uptest_proc('web')])
+
+        assert not mock_host.objects.get.called
+        assert commands == {}
+        assert results == {'web': []}
+
+    def test_parse_output_with_prefix(self):
+        results = remote._parse_uptest_output(
+            'bash: /app/env.sh: No such file\n[{"Passed": true}]')
+        assert results == [
+            {'Passed': False, 'Name': 'uptester',
+             'Output': 'bash: /app/env.sh: No such file\n'},
+            {'Passed': True},
+        ]
+
+    @patch.object(tasks, 'pooled_connection', MagicMock())
+    @patch.object(remote, 'run_uptest')
+    @patch.object(remote, 'find_uptests')
+    def test_uptest_host_procs(self, mock_find, mock_run_uptest):
+        mock_find.return_value = (
+            {'web': 'uptest web', 'worker': 'uptest worker'},
+            {'cron': []},
+        )
+
+        def run_uptest(cmd):
+            if cmd == 'uptest worker':
+                raise ValueError('worker is broken')
+            return [{'Passed': True, 'Name': cmd, 'Output': ''}]
+        mock_run_uptest.side_effect = run_uptest
+
+        hostname, results = tasks.uptest_host_procs(
+            'host1', ['web', 'worker', 'cron'])
+
+        assert hostname == 'host1'
+        assert results['web'] == [
+            {'Passed': True, 'Name': 'uptest web', 'Output': ''}]
+        assert not results['worker'][0]['Passed']
+        assert 'worker is broken' in results['worker'][0]['Output']
+        assert results['cron'] == []
+
+
+@pytest.mark.usefixtures('postgresql')
+class TestCompactTestResults(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            UPTEST_RETENTION_DAYS=30, UPTEST_RETENTION_BATCH_SIZE=2)
+        self.settings.enable()
+        self.hostname = randchars()
+        old = timezone.now() - datetime.timedelta(days=40)
+        self.old_run = TestRun.objects.create(start=old)
+        self.new_run = TestRun.objects.create(start=timezone.now())
+
+        passed = [{'Passed': True, 'Name': 'test', 'Output': ''}]
+        failed = [{'Passed': False, 'Name': 'test', 'Output': 'boom'}]
+        TestResult.objects.bulk_create([
+            TestResult.from_results(
+                run.id, self.hostname, procname, results, time=run.start)
+            for run, procname, results in [
+                (self.old_run, 'web', passed),
+                (self.old_run, 'web', failed),
+                (self.old_run, 'cron', []),
+                (self.new_run, 'web', passed),
+            ]
         ])
 
+    def teardown(self):
+        TestRun.objects.filter(
+            id__in=[self.old_run.id, self.new_run.id]).delete()
+        TestResultRollup.objects.filter(hostname=self.hostname).delete()
+        self.settings.disable()
+
+    def test_compacts_old_results(self):
+        tasks.compact_test_results()
+
+        rollups = dict(
+            (r.procname, (r.day, r.pass_count, r.fail_count, r.notests_count))
+            for r in TestResultRollup.objects.filter(hostname=self.hostname))
+        day = timezone.localtime(self.old_run.start).date()
+        assert rollups == {'web': (day, 1, 1, 0), 'cron': (day, 1, 0, 1)}
+
+        remaining = TestResult.objects.filter(hostname=self.hostname)
+        assert list(remaining.values_list('run_id', flat=True)) == [
+            self.new_run.id]
+        assert not TestRun.objects.filter(id=self.old_run.id).exists()
+
 
 class BuildLogTest(TestCase):
     def setUp(self):
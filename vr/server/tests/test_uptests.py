@@ -0,0 +1,80 @@
+from unittest.mock import Mock, patch
+
+import pytest
+from django.test.utils import override_settings
+from vr.common.models import Proc
+from vr.common.utils import randchars
+
+from vr.server import models, uptests
+from vr.server.tests import make_proc_info
+
+
+def make_proc(name, **info):
+    data = make_proc_info(name)
+    data.update(info)
+    return Proc(Mock(), data)
+
+
+PASSED = [{'Passed': True, 'Name': 'test', 'Output': ''}]
+FAILED = [{'Passed': False, 'Name': 'test', 'Output': 'boom'}]
+
+
+@pytest.mark.usefixtures('redis')
+class TestUptestTracking(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            UPTEST_SAMPLE_RATE=0, UPTEST_FULL_SWEEP_INTERVAL=3600)
+        self.settings.enable()
+        self.hostname = randchars()
+        self.procs = [
+            make_proc('app-v1-local-abc123-web-5000'),
+            make_proc('app-v1-local-abc123-web-5001'),
+        ]
+
+    def teardown(self):
+        models.events_redis.delete(uptests._key(self.hostname))
+        self.settings.disable()
+
+    def names(self, procs):
+        return [proc.name for proc in procs]
+
+    def test_untested_procs_are_due(self):
+        assert uptests.due(self.hostname, self.procs) == self.names(
+            self.procs)
+
+    def test_skips_passed_procs(self):
+        web0, web1 = self.procs
+        uptests.record(self.hostname, self.procs,
+                       {web0.name: PASSED, web1.name: FAILED})
+        assert uptests.due(self.hostname, self.procs) == [web1.name]
+        assert uptests.due(self.hostname, self.procs, full=True) == \
+            self.names(self.procs)
+
+    def test_restarted_procs_are_due(self):
+        web0, web1 = self.procs
+        uptests.record(self.hostname, self.procs,
+                       {web0.name: PASSED, web1.name: PASSED})
+
+        restarted = make_proc(web1.name, pid=4321, start=1499999999)
+        stopped = make_proc(web0.name, statename='STOPPED')
+        assert uptests.due(self.hostname, [web0, restarted]) == [web1.name]
+        assert uptests.due(self.hostname, [stopped, web1]) == [web0.name]
+
+    def test_samples_passed_procs(self):
+        uptests.record(self.hostname, self.procs,
+                       dict((proc.name, PASSED) for proc in self.procs))
+
+        with patch.object(uptests.random, 'random', return_value=0.05):
+            with override_settings(UPTEST_SAMPLE_RATE=0.1):
+                assert uptests.due(self.hostname, self.procs) == \
+                    self.names(self.procs)
+
+    def test_forgets_removed_procs(self):
+        web0, web1 = self.procs
+        uptests.record(self.hostname, self.procs,
+                       {web0.name: PASSED, web1.name: PASSED})
+
+        uptests.due(self.hostname, [web0])
+        fields = models.events_redis.hkeys(uptests._key(self.hostname))
+        assert [uptests._text(field) for field in fields] == [web0.name]
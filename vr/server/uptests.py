@@ -0,0 +1,109 @@
+"""
+Keep the last scheduled uptest result of each proc, so scheduled runs can
+skip procs that passed last time and haven't changed since.
+
+A proc is due for its uptests if it has no result yet, failed last time,
+isn't running, or has been restarted or replaced since it was last tested
+(its supervisor pid or start time differ).  Of the rest, a random
+UPTEST_SAMPLE_RATE share are tested anyway.  Once every
+UPTEST_FULL_SWEEP_INTERVAL seconds a run tests every proc, so nothing goes
+untested for longer than that.
+
+Results are kept in a Redis hash per host, with a field per proc.
+"""
+
+import json
+import random
+
+from django.conf import settings
+
+from vr.server import models
+
+RESULTS_PREFIX = 'uptest_results'
+FULL_SWEEP_KEY = 'uptest_full_sweep'
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _key(hostname):
+    return ':'.join([RESULTS_PREFIX, hostname])
+
+
+def _state(proc):
+    """
+    Return what we remember about `proc`, a vr.common Proc, to tell whether
+    it has changed since it was tested.
+    """
+    return {
+        'hash': getattr(proc, 'hash', None),
+        'pid': proc.pid,
+        'start': proc.start_time.isoformat() if proc.start_time else None,
+    }
+
+
+def start_full_sweep():
+    """
+    Return True if it's time for a run to test every proc, in which case the
+    next one isn't due for another UPTEST_FULL_SWEEP_INTERVAL seconds.
+    """
+    return bool(models.events_redis.set(
+        FULL_SWEEP_KEY, 1, ex=settings.UPTEST_FULL_SWEEP_INTERVAL, nx=True))
+
+
+def due(hostname, procs, full=False):
+    """
+    Return the names of the procs in `procs`, the vr.common Procs on
+    `hostname`, that need testing, those that failed or changed first.
+    With full=True, that's all of them.
+    """
+    key = _key(hostname)
+    last = dict(
+        (_text(name), json.loads(_text(value)))
+        for name, value in models.events_redis.hgetall(key).items())
+
+    gone = set(last) - set(proc.name for proc in procs)
+    if gone:
+        models.events_redis.hdel(key, *gone)
+
+    if full:
+        return [proc.name for proc in procs]
+
+    changed = []
+    sampled = []
+    for proc in procs:
+        result = last.get(proc.name)
+        if (result is None or not result['passed'] or
+                proc.statename != 'RUNNING' or
+                result['state'] != _state(proc)):
+            changed.append(proc.name)
+        elif random.random() < settings.UPTEST_SAMPLE_RATE:
+            sampled.append(proc.name)
+    return changed + sampled
+
+
+def record(hostname, procs, results):
+    """
+    Remember the uptest `results` for procs on `hostname`, a dict of lists
+    of uptester results keyed by proc name, along with the state of each
+    proc in `procs` when it was tested.
+    """
+    fields = {}
+    for proc in procs:
+        if proc.name not in results:
+            continue
+        fields[proc.name] = json.dumps({
+            # A proc without uptests can't fail them.
+            'passed': all(r['Passed'] for r in results[proc.name]),
+            'state': _state(proc),
+        })
+    if not fields:
+        return
+
+    key = _key(hostname)
+    pipeline = models.events_redis.pipeline()
+    pipeline.hmset(key, fields)
+    # Hosts that are no longer tested drop out eventually.
+    pipeline.expire(key, 2 * settings.UPTEST_FULL_SWEEP_INTERVAL)
+    pipeline.execute()